@@ -0,0 +1,34 @@
+"""Mixing cost per period for 1-8 simultaneous voices.
+
+usage: python bench/bench_mixer.py [period_frames]
+"""
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+from mixer import Voice, mix_period  # noqa: E402
+
+RATE = 44100
+CHANNELS = 2
+
+
+def bench(n_voices: int, period_frames: int, periods: int = 2000) -> float:
+    rng = np.random.default_rng(0)
+    clip = rng.integers(-8000, 8000, size=(RATE * 60, CHANNELS), dtype=np.int16)
+    # one prompt among the voices so the ducking path is exercised
+    voices = [Voice(clip, prompt=(i == 0 and n_voices > 1)) for i in range(n_voices)]
+    start = time.perf_counter()
+    for _ in range(periods):
+        mix_period(voices, period_frames, CHANNELS, 0.25)
+    return (time.perf_counter() - start) / periods
+
+
+if __name__ == "__main__":
+    period_frames = int(sys.argv[1]) if len(sys.argv) > 1 else 1024
+    budget = period_frames / RATE
+    print(f"period {period_frames} frames = {budget * 1000:.1f} ms")
+    for n in range(1, 9):
+        cost = bench(n, period_frames)
+        print(f"{n} voice(s): {cost * 1e6:8.1f} us/period  ({100 * cost / budget:5.2f} % of real time)")
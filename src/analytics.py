@@ -0,0 +1,235 @@
+"""What is in the archive: airtime, durations, levels, near-silent and clipped takes.
+
+    python src/analytics.py recordings --out report
+    python src/analytics.py /media/usb/garten1 /media/usb/garten2 --out report   # one directory per station
+
+Per-file statistics are computed in a process pool from memory-mapped files
+(loose wavs and takes packed by segstore.py alike), vectorized over fixed
+chunks, and cached in <out>/stats-cache.json keyed by mtime and size, so a
+rerun only reads new or changed takes. The report is
+<out>/summary.json plus histograms as PNG.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from config import LogConfig
+from pathlib import Path
+import argparse
+import json
+import math
+import os
+import time
+import numpy as np
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+import loudness
+import log
+import segstore
+
+logger = log.get_logger("analytics")
+
+CACHE = "stats-cache.json"
+CHUNK_SEC = 10.0
+# silence is judged on 50 ms windows
+WINDOW_SEC = 0.05
+SILENCE_DBFS = -50.0
+# a take counts as near-silent / clipped above these ratios
+NEAR_SILENT_RATIO = 0.9
+CLIPPED_RATIO = 0.001
+
+
+def _full_scale(dtype) -> float:
+    if dtype.kind == "f":
+        return 1.0
+    return float(np.iinfo(dtype).max) + 1
+
+
+def _db(value: float) -> float:
+    return round(20 * math.log10(value), 2) if value > 0 else None
+
+
+def file_stats(path) -> dict:
+    """duration, rms, peak, clipping and silence ratio of one take, read memory-mapped."""
+    # a pool worker finds the packed takes of the archive only with its store attached
+    segstore.open_existing(Path(path).parent)
+    rate, data = segstore.read_wav(path)
+    x = data if data.ndim == 2 else data[:, None]
+    scale = _full_scale(x.dtype)
+    offset = 128.0 if x.dtype == np.uint8 else 0.0
+    clip_level = 1.0 - 1.0 / scale if x.dtype.kind != "f" else 1.0
+    window = max(1, int(rate * WINDOW_SEC))
+    # whole windows per chunk, so the silence windows never straddle two chunks
+    chunk = window * max(1, int(CHUNK_SEC / WINDOW_SEC))
+    silence_power = 10 ** (SILENCE_DBFS / 10)
+
+    sum_sq = peak = 0.0
+    clipped = windows = silent = 0
+    for start in range(0, len(x), chunk):
+        seg = (x[start:start + chunk].astype(np.float32) - offset) / scale
+        magnitude = np.abs(seg)
+        peak = max(peak, float(magnitude.max(initial=0.0)))
+        clipped += int(np.count_nonzero(magnitude >= clip_level))
+        sum_sq += float(np.einsum("ij,ij->", seg, seg, dtype=np.float64))
+        whole = len(seg) // window * window
+        if whole:
+            power = np.square(seg[:whole]).reshape(-1, window * seg.shape[1]).mean(axis=1)
+            windows += len(power)
+            silent += int(np.count_nonzero(power < silence_power))
+
+    samples = x.size
+    return {
+        "duration": round(len(x) / rate, 3),
+        "rate": rate,
+        "channels": x.shape[1],
+        "rms_dbfs": _db(math.sqrt(sum_sq / samples)) if samples else None,
+        "peak_dbfs": _db(peak),
+        "clip_ratio": round(clipped / samples, 6) if samples else 0.0,
+        "silence_ratio": round(silent / windows, 4) if windows else 1.0,
+        "integrated_lufs": (loudness.load(path) or {}).get("integrated_lufs"),
+    }
+
+
+def _stats_job(path):
+    try:
+        return path, file_stats(path), None
+    except (OSError, ValueError) as err:
+        return path, None, str(err)
+
+
+def _percentiles(values: list) -> dict:
+    if not values:
+        return {}
+    p = np.percentile(values, [5, 25, 50, 75, 95])
+    return {name: round(float(v), 2) for name, v in zip(("p5", "p25", "p50", "p75", "p95"), p)}
+
+
+class ArchiveAnalytics:
+
+    def __init__(self, archives: list, out, jobs: int | None = None):
+        self.archives = [Path(a) for a in archives]
+        self.out = Path(out)
+        self.jobs = jobs or os.cpu_count()
+        self.cache_path = self.out / CACHE
+        self.cache: dict = self._load_cache()
+
+    def _load_cache(self) -> dict:
+        try:
+            with open(self.cache_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_cache(self):
+        tmp = self.cache_path.with_suffix(".json.tmp")
+        with open(tmp, "w") as f:
+            json.dump(self.cache, f)
+        os.replace(tmp, self.cache_path)
+
+    def scan(self) -> dict[str, list]:
+        """Stats per station (archive directory name), from the cache where mtime and size still match."""
+        listing, todo = {}, []
+        for archive in self.archives:
+            for p in segstore.wav_paths(archive):
+                try:
+                    size, mtime = segstore.clip_stat(p)
+                except OSError:
+                    continue
+                key = str(p.resolve())
+                listing[key] = (archive.name, [mtime, size])
+                entry = self.cache.get(key)
+                if entry is None or entry["stamp"] != listing[key][1]:
+                    todo.append(key)
+
+        logger.info("%d takes in %d archives, %d to analyse", len(listing), len(self.archives), len(todo))
+        failed = 0
+        if todo:
+            with ProcessPoolExecutor(max_workers=self.jobs) as pool:
+                for i, (path, stats, err) in enumerate(pool.map(_stats_job, todo, chunksize=8), 1):
+                    if err:
+                        logger.error("Failed %s: %s", path, err)
+                        failed += 1
+                    else:
+                        self.cache[path] = {"stamp": listing[path][1], "stats": stats}
+                    if i % 200 == 0:
+                        logger.info("Progress %d/%d", i, len(todo))
+
+        # takes that are gone leave the cache too
+        self.cache = {key: entry for key, entry in self.cache.items() if key in listing}
+        self._save_cache()
+        if failed:
+            logger.warning("%d takes could not be read", failed)
+
+        stations: dict[str, list] = {}
+        for key, (station, _) in listing.items():
+            if key in self.cache:
+                stats = dict(self.cache[key]["stats"], name=f"{station}/{Path(key).name}")
+                stations.setdefault(station, []).append(stats)
+        return stations
+
+    def summarize(self, stats: list) -> dict:
+        durations = [s["duration"] for s in stats]
+        levels = [s["rms_dbfs"] for s in stats if s["rms_dbfs"] is not None]
+        silent = [s["name"] for s in stats if s["silence_ratio"] >= NEAR_SILENT_RATIO]
+        clipped = [s["name"] for s in stats if s["clip_ratio"] >= CLIPPED_RATIO]
+        lufs = [s["integrated_lufs"] for s in stats
+                if s["integrated_lufs"] is not None and math.isfinite(s["integrated_lufs"])]
+        return {
+            "takes": len(stats),
+            "airtime_h": round(sum(durations) / 3600, 3),
+            "duration_s": _percentiles(durations),
+            "rms_dbfs": _percentiles(levels),
+            "integrated_lufs": _percentiles(lufs),
+            "near_silent": len(silent),
+            "clipped": len(clipped),
+            "near_silent_takes": sorted(silent),
+            "clipped_takes": sorted(clipped),
+        }
+
+    def _histogram(self, stations: dict, field: str, title: str, xlabel: str, filename: str,
+                   log_y: bool = False):
+        fig, ax = plt.subplots(figsize=(8, 4.5))
+        values = {name: [s[field] for s in stats if s[field] is not None] for name, stats in stations.items()}
+        everything = [v for vs in values.values() for v in vs]
+        if everything:
+            bins = np.histogram_bin_edges(everything, bins=40)
+            ax.hist([vs for vs in values.values()], bins=bins, stacked=True, label=list(values), log=log_y)
+            if len(values) > 1:
+                ax.legend()
+        ax.set_title(title)
+        ax.set_xlabel(xlabel)
+        ax.set_ylabel("takes")
+        fig.tight_layout()
+        fig.savefig(self.out / filename, dpi=100)
+        plt.close(fig)
+
+    def report(self) -> dict:
+        self.out.mkdir(parents=True, exist_ok=True)
+        stations = self.scan()
+        everything = [s for stats in stations.values() for s in stats]
+        summary = {"generated": int(time.time()), "total": self.summarize(everything),
+                   "stations": {name: self.summarize(stats) for name, stats in sorted(stations.items())}}
+        with open(self.out / "summary.json", "w") as f:
+            json.dump(summary, f, indent=1)
+
+        self._histogram(stations, "duration", "Take duration", "seconds", "duration.png")
+        self._histogram(stations, "rms_dbfs", "Level (RMS)", "dBFS", "level.png")
+        self._histogram(stations, "silence_ratio", "Share of silence per take", "ratio", "silence.png")
+        self._histogram(stations, "clip_ratio", "Clipped samples per take", "ratio", "clipping.png", log_y=True)
+
+        total = summary["total"]
+        logger.info("%d takes, %.1f h airtime, %d near-silent, %d clipped, report in %s",
+                    total["takes"], total["airtime_h"], total["near_silent"], total["clipped"], self.out)
+        return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Statistics and histograms of one or more recording archives.")
+    parser.add_argument("archives", nargs="+", help="recording directories, one per station")
+    parser.add_argument("--out", default="report", help="output directory for summary.json, PNGs and the cache")
+    parser.add_argument("--jobs", type=int, default=None, help="worker processes (default: all cores)")
+    args = parser.parse_args()
+
+    log.setup_logging(LogConfig())
+    try:
+        ArchiveAnalytics(args.archives, args.out, args.jobs).report()
+    finally:
+        log.shutdown_logging()
@@ -0,0 +1,228 @@
+"""Incremental, checksummed copy of the recording archive to removable media.
+
+Only takes the target does not have yet are copied, at idle I/O priority with
+large sequential copies (copy_file_range where the kernel can, buffered
+otherwise). Every copy lands in <name>.part first, is resumed from its current
+size after an interruption, read back from the medium and compared by sha256
+before it is renamed and written to the target's manifest. Exported takes are
+marked in their sidecar, so they can later be evicted locally.
+
+    python src/archive_sync.py recordings                 # first mounted stick under /media, /run/media, /mnt
+    python src/archive_sync.py recordings --target /media/usb --station garten1
+    python src/archive_sync.py recordings --watch         # wait for sticks and sync each one once
+"""
+from pathlib import Path
+import argparse
+import errno
+import hashlib
+import json
+import os
+import socket
+import subprocess
+import time
+import segstore
+import sidecar
+import log
+
+logger = log.get_logger("sync")
+
+MANIFEST = "manifest.json"
+SIDECAR_KEY = "export"
+MOUNT_ROOTS = ("/media", "/run/media", "/mnt")
+CHUNK = 8 * 1024 * 1024
+
+
+def sha256_file(path, drop_cache: bool = False) -> str:
+    """sha256 of a file or packed take. drop_cache first evicts it from the page cache, so the medium is really read."""
+    digest = hashlib.sha256()
+    with segstore.open_clip(path) as (f, offset, size):
+        if drop_cache:
+            os.posix_fadvise(f.fileno(), offset, size, os.POSIX_FADV_DONTNEED)
+        end = offset + size
+        while offset < end and (chunk := os.pread(f.fileno(), min(CHUNK, end - offset), offset)):
+            digest.update(chunk)
+            offset += len(chunk)
+    return digest.hexdigest()
+
+
+def mounted_targets(roots=MOUNT_ROOTS) -> list[Path]:
+    """Writable mount points below the usual removable media roots."""
+    targets = []
+    try:
+        with open("/proc/mounts") as f:
+            mounts = [line.split()[1].replace("\\040", " ") for line in f]
+    except OSError:
+        return targets
+    for mount in mounts:
+        if any(mount.startswith(root + "/") for root in roots) and os.access(mount, os.W_OK):
+            targets.append(Path(mount))
+    return targets
+
+
+def idle_io_priority():
+    """Idle I/O class and low cpu priority, so capture and playback always win."""
+    try:
+        os.nice(10)
+    except OSError:
+        pass
+    try:
+        subprocess.run(["ionice", "-c", "3", "-p", str(os.getpid())], check=False,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    except OSError as err:
+        logger.warning("ionice not available, syncing at normal I/O priority: %s", err)
+
+
+def exported(wav_path) -> bool:
+    """True once a take has been copied and verified on at least one medium."""
+    return bool(sidecar.read(wav_path).get(SIDECAR_KEY))
+
+
+def _copy_range(src, dst, offset: int, size: int, base: int = 0):
+    """Copies src[base + offset:base + size] to dst[offset:size], in-kernel where possible."""
+    use_kernel = hasattr(os, "copy_file_range")
+    while offset < size:
+        count = min(CHUNK, size - offset)
+        if use_kernel:
+            try:
+                done = os.copy_file_range(src.fileno(), dst.fileno(), count, base + offset, offset)
+            except OSError as err:
+                if err.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                    raise
+                use_kernel = False
+                continue
+            if done == 0:
+                raise OSError(errno.EIO, f"short copy at {offset}")
+        else:
+            data = os.pread(src.fileno(), count, base + offset)
+            if not data:
+                raise OSError(errno.EIO, f"short read at {offset}")
+            done = os.pwrite(dst.fileno(), data, offset)
+        offset += done
+        # nothing of the archive is needed again soon, keep the page cache for the rotation
+        os.posix_fadvise(src.fileno(), base + offset - done, done, os.POSIX_FADV_DONTNEED)
+
+
+class ArchiveSync:
+
+    def __init__(self, rec_path, target, station: str | None = None):
+        self.rec_path = Path(rec_path)
+        self.target = Path(target) / (station or socket.gethostname())
+        self.manifest_path = self.target / MANIFEST
+        self.manifest = self._load_manifest()
+
+    def _load_manifest(self) -> dict:
+        try:
+            with open(self.manifest_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_manifest(self):
+        tmp = self.manifest_path.with_suffix(".json.tmp")
+        with open(tmp, "w") as f:
+            json.dump(self.manifest, f, indent=1, sort_keys=True)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.manifest_path)
+
+    def pending(self) -> list[Path]:
+        """Local takes that are not in the target's manifest yet, or with a different size."""
+        todo = []
+        for wav in segstore.wav_paths(self.rec_path):
+            entry = self.manifest.get(wav.name)
+            if entry is None or entry["size"] != segstore.clip_stat(wav)[0]:
+                todo.append(wav)
+        return todo
+
+    def sync(self) -> tuple[int, int]:
+        """Copies everything pending. Returns (copied, failed)."""
+        self.target.mkdir(parents=True, exist_ok=True)
+        todo = self.pending()
+        logger.info("Syncing %d recordings to %s", len(todo), self.target)
+        copied = failed = 0
+        for wav in todo:
+            try:
+                self._sync_one(wav)
+                copied += 1
+            except (OSError, ValueError) as err:
+                # a full or pulled stick ends the run, the .part is resumed next time
+                logger.error("Failed to sync %s: %s", wav.name, err)
+                failed += 1
+                if getattr(err, "errno", None) in (errno.ENOSPC, errno.EIO, errno.ENODEV, errno.ENOENT):
+                    break
+        logger.info("Sync finished: %d copied, %d failed, %d in manifest", copied, failed, len(self.manifest))
+        return copied, failed
+
+    def _sync_one(self, wav: Path):
+        dest = self.target / wav.name
+        part = dest.with_name(dest.name + ".part")
+        source_hash = sha256_file(wav)
+
+        # copied by an earlier run that was interrupted before the manifest was written
+        if dest.exists() and dest.stat().st_size == segstore.clip_stat(wav)[0] and sha256_file(dest) == source_hash:
+            self._record(wav, source_hash)
+            return
+
+        # not O_APPEND, copy_file_range and pwrite need explicit offsets
+        part_fd = os.open(part, os.O_WRONLY | os.O_CREAT, 0o644)
+        # a packed take is copied out of its segment as a plain wav
+        with segstore.open_clip(wav) as (src, base, size), open(part_fd, "wb") as dst:
+            resume = os.fstat(dst.fileno()).st_size
+            if resume > size:
+                dst.truncate(0)
+                resume = 0
+            if resume:
+                logger.info("Resuming %s at %d bytes", wav.name, resume)
+            _copy_range(src, dst, resume, size, base)
+            dst.flush()
+            os.fsync(dst.fileno())
+
+        if sha256_file(part, drop_cache=True) != source_hash:
+            # whatever was resumed was not this file, start over next time
+            os.remove(part)
+            raise ValueError(f"checksum mismatch for {wav.name}")
+        os.replace(part, dest)
+        dir_fd = os.open(self.target, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+        self._record(wav, source_hash)
+
+    def _record(self, wav: Path, digest: str):
+        self.manifest[wav.name] = {"sha256": digest, "size": segstore.clip_stat(wav)[0]}
+        self._save_manifest()
+        export = sidecar.read(wav).get(SIDECAR_KEY) or {}
+        media = set(export.get("media", [])) | {str(self.target)}
+        sidecar.update(wav, SIDECAR_KEY, {"sha256": digest, "media": sorted(media), "at": int(time.time())})
+
+
+def watch(rec_path, station: str | None, interval: float = 5.0):
+    """Syncs every newly mounted medium once, until interrupted."""
+    done = set()
+    while True:
+        current = set(mounted_targets())
+        for target in sorted(current - done):
+            ArchiveSync(rec_path, target, station).sync()
+        # a stick that was pulled is synced again when it comes back
+        done = current
+        time.sleep(interval)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Copy new recordings to removable media.")
+    parser.add_argument("recording_path")
+    parser.add_argument("--target", default=None, help="target directory (default: first mounted medium)")
+    parser.add_argument("--station", default=None, help="sub directory on the target (default: hostname)")
+    parser.add_argument("--watch", action="store_true", help="keep running and sync each medium when mounted")
+    args = parser.parse_args()
+
+    idle_io_priority()
+    if args.watch:
+        watch(args.recording_path, args.station)
+    else:
+        target = args.target or next(iter(mounted_targets()), None)
+        if target is None:
+            parser.error("no mounted medium found, pass --target")
+        _, failed = ArchiveSync(args.recording_path, target, args.station).sync()
+        raise SystemExit(1 if failed else 0)
@@ -5,6 +5,9 @@ if TYPE_CHECKING:
     from btn_manager import ButtonManager
     from player import Player
     from recorder import Recorder
+    from station import Station
+    from upload import Uploader
+    from eventlog import EventLog
 # Just for typehint & pylance (highlighting)
 # mathing all function calls & params of CmdRegistry defined in Main
 class CmdTyping(Protocol):
@@ -13,6 +16,9 @@ class CmdTyping(Protocol):
     button: "ButtonManager"
     player: "Player"
     recorder: "Recorder"
+    station: "Station"
+    uploader: "Uploader"
+    events: "EventLog"
 
     # def button_await_confirm(self) -> None: ...
 
@@ -1,5 +1,6 @@
-from dataclasses import dataclass
-from typing import List, Final
+from dataclasses import dataclass, field
+from typing import List, Final, Optional
+import yaml
 
 @dataclass
 class ButtonConfig:
@@ -12,6 +13,29 @@ class RecordingConfig:
     SFX_PATH: Final[str]
     BEEP_FILE: Final[str]
     ARECORD_CMD: Final[List[str]]
+    # pre-armed capture: keep the input open and prepend the last PREROLL_MS to each take (0 = off)
+    PREROLL_MS: Final[int] = 0
+    # continuous raw capture command, derived from ARECORD_CMD when left empty
+    CAPTURE_CMD: Final[Optional[List[str]]] = None
+    CAPTURE_RATE: Final[int] = 44100
+    CAPTURE_CHANNELS: Final[int] = 2
+    # spectral gating against hum and crowd noise, profiled on the pre-roll or the first 500 ms
+    DENOISE: Final[bool] = False
+    DENOISE_REDUCTION_DB: Final[float] = 18.0
+    # tmpfs directory for takes until they are confirmed (None = record straight to RECORDING_PATH)
+    STAGING_PATH: Final[Optional[str]] = None
+    STAGING_MAX_MB: Final[int] = 128
+    # spectral fingerprint of every take, checked against the archive for repeats and re-recorded playback
+    FINGERPRINT: Final[bool] = False
+    # what a repeat gets: "flag" only marks it in the sidecar, "demote" also plays it less often
+    DUPLICATE_ACTION: Final[str] = "flag"
+    # share of the take's hashes that must line up with an archived take
+    DUPLICATE_MIN_SCORE: Final[float] = 0.05
+    # "files": one wav (and json) per take, "segments": confirmed takes are packed into large segment files
+    STORAGE: Final[str] = "files"
+    SEGMENT_MB: Final[int] = 256
+    # a full segment is compacted once this share of it belongs to deleted takes
+    COMPACT_RATIO: Final[float] = 0.5
 
 
 @dataclass
@@ -19,12 +43,142 @@ class PlayerConfig:
     APLAY_CMD:  Final[List[str]]
     QUESTION: Final[str]
     VOICE_PATH: Final[str]
+    # mix rotation, sfx and prompts in-process into one persistent aplay instead of one aplay per clip
+    MIXER: Final[bool] = False
+    MIXER_RATE: Final[int] = 44100
+    MIXER_CHANNELS: Final[int] = 2
+    # gain of the rotation while a prompt is playing
+    DUCK_GAIN: Final[float] = 0.25
+    # playback loudness of recordings with MIXER enabled (None = play as recorded)
+    TARGET_LUFS: Final[Optional[float]] = -20.0
+    # pause between two clips of the rotation
+    GAP_SEC: Final[float] = 1.0
+    # journal of the rotation position, read at startup only (None = .rotation.jsonl in RECORDING_PATH)
+    STATE_PATH: Final[Optional[str]] = None
+    # a take demoted as a repeat plays only every DEMOTE_EVERY-th time its turn comes
+    DEMOTE_EVERY: Final[int] = 4
+    # pitch-preserving time compression of recordings while the rotation is deep, at most MAX_SPEED
+    TIME_STRETCH: Final[bool] = False
+    MAX_SPEED: Final[float] = 1.25
+    # clips still to come in the current cycle of the rotation:
+    # normal speed up to STRETCH_FROM_CLIPS, MAX_SPEED from STRETCH_FULL_CLIPS on
+    STRETCH_FROM_CLIPS: Final[int] = 100
+    STRETCH_FULL_CLIPS: Final[int] = 500
 
 @dataclass
 class LedConfig:
     DATA_PIN: Final[str]
     PIXEL_NUM: Final[int]
 
+@dataclass
+class HttpConfig:
+    # optional read-only archive API, off unless enabled in the yaml
+    ENABLED: Final[bool] = False
+    HOST: Final[str] = "0.0.0.0"
+    PORT: Final[int] = 8080
+    MAX_CLIENTS: Final[int] = 2
+    # shared limit for all downloads
+    RATE_LIMIT_KBPS: Final[int] = 2048
+
+    def __post_init__(self):
+        if self.RATE_LIMIT_KBPS <= 0:
+            raise ValueError(f"http_config RATE_LIMIT_KBPS must be > 0, got {self.RATE_LIMIT_KBPS}")
+
+@dataclass
+class LogConfig:
+    LEVEL: Final[str] = "INFO"
+    # "text" or "json" (one json object per line)
+    FORMAT: Final[str] = "text"
+    CONSOLE: Final[bool] = True
+    # optional rotated log file
+    FILE: Final[Optional[str]] = None
+    MAX_BYTES: Final[int] = 1024 * 1024
+    BACKUP_COUNT: Final[int] = 3
+    # records beyond this are dropped instead of blocking the caller
+    QUEUE_SIZE: Final[int] = 1000
+
+@dataclass
+class DiagConfig:
+    # lag monitor, blocking detector, SIGUSR1 dump and memory report
+    ENABLED: Final[bool] = False
+    LAG_INTERVAL_MS: Final[int] = 100
+    LAG_WARN_MS: Final[int] = 50
+    BLOCK_WARN_MS: Final[int] = 250
+    REPORT_INTERVAL: Final[int] = 300
+    # also trace numpy allocations (costs some cpu)
+    TRACEMALLOC: Final[bool] = False
+    # sampling profile taken on SIGUSR1
+    PROFILE_SEC: Final[float] = 5.0
+    PROFILE_HZ: Final[int] = 100
+    DUMP_PATH: Final[str] = "diagnostics"
+
+@dataclass
+class IdleConfig:
+    # activity-aware rotation, off = play around the clock
+    ENABLED: Final[bool] = False
+    # without a button press for this long the gaps between clips get longer
+    QUIET_AFTER_SEC: Final[int] = 600
+    QUIET_GAP_SEC: Final[float] = 20.0
+    # without a button press for this long the rotation stops (0 = never, only outside OPENING_HOURS)
+    SLEEP_AFTER_SEC: Final[int] = 3600
+    # e.g. ["mon-fri 10:00-18:00", "sat,sun 11:00-17:00"], empty = always open
+    OPENING_HOURS: Final[List[str]] = field(default_factory=list)
+
+@dataclass
+class UploadConfig:
+    # send confirmed takes to a collection server, off unless enabled in the yaml
+    ENABLED: Final[bool] = False
+    # e.g. "http://archive.example.org:8000/takes", a take goes to <URL>/<STATION>/<name>
+    URL: Final[Optional[str]] = None
+    # defaults to the hostname
+    STATION: Final[Optional[str]] = None
+    # sent as "Authorization: Bearer <TOKEN>"
+    TOKEN: Final[Optional[str]] = None
+    # a batch leaves when it has BATCH_SIZE takes or its oldest one waited BATCH_WAIT_SEC
+    BATCH_SIZE: Final[int] = 8
+    BATCH_WAIT_SEC: Final[float] = 10.0
+    # keep-alive connections, one batch in flight on each
+    CONNECTIONS: Final[int] = 2
+    RATE_LIMIT_KBPS: Final[int] = 256
+    # exponential backoff between failed attempts
+    RETRY_MIN_SEC: Final[float] = 5.0
+    RETRY_MAX_SEC: Final[float] = 600.0
+    TIMEOUT_SEC: Final[float] = 30.0
+
+    def __post_init__(self):
+        if self.RATE_LIMIT_KBPS <= 0:
+            raise ValueError(f"upload_config RATE_LIMIT_KBPS must be > 0, got {self.RATE_LIMIT_KBPS}")
+
+@dataclass
+class RealtimeConfig:
+    # SCHED_FIFO/RR on a dedicated core and locked buffers for aplay / arecord, off unless enabled in the yaml
+    ENABLED: Final[bool] = False
+    # "fifo" or "rr"
+    POLICY: Final[str] = "fifo"
+    # of the audio processes, 1-99
+    PRIORITY: Final[int] = 70
+    # the event loop renders the mixer's periods (0 = normal scheduling)
+    LOOP_PRIORITY: Final[int] = 0
+    # core reserved for the audio processes, everything else stays off it (None = the last core)
+    CPU: Final[Optional[int]] = None
+    # pre-fault and mlock the mixer and pre-roll buffers, at most LOCK_MB
+    LOCK_MEMORY: Final[bool] = True
+    LOCK_MB: Final[int] = 32
+    # xruns of aplay / arecord are logged this often, also with the mode off
+    REPORT_SEC: Final[int] = 300
+
+@dataclass
+class EventLogConfig:
+    # append-only binary log of presses, skips and takes for offline analysis (src/eventlog.py)
+    ENABLED: Final[bool] = False
+    PATH: Final[str] = "events/events.bin"
+    # rotated like the text log, 40 bytes per event
+    MAX_BYTES: Final[int] = 4 * 1024 * 1024
+    BACKUP_COUNT: Final[int] = 20
+    # buffered events are appended this often
+    FLUSH_SEC: Final[float] = 10.0
+
+
 # wrap everything under 1 config
 @dataclass
 class Config:
@@ -32,3 +186,28 @@ class Config:
     rec_cfg: RecordingConfig
     ply_cfg: PlayerConfig
     led_cfg: LedConfig
+    http_cfg: HttpConfig
+    log_cfg: LogConfig
+    diag_cfg: DiagConfig
+    idle_cfg: IdleConfig
+    upload_cfg: UploadConfig
+    rt_cfg: RealtimeConfig
+    events_cfg: EventLogConfig
+
+
+def load_config(path) -> Config:
+    with open(path) as f:
+        conf: dict = yaml.safe_load(f) or {}
+    return Config(
+        btn_cfg = ButtonConfig(**conf.get("button_config",{})),
+        rec_cfg = RecordingConfig(**conf.get("recorder_config",{})),
+        ply_cfg = PlayerConfig(**conf.get("player_config", {})),
+        led_cfg = LedConfig(**conf.get("led_config", {})),
+        http_cfg = HttpConfig(**(conf.get("http_config") or {})),
+        log_cfg = LogConfig(**(conf.get("log_config") or {})),
+        diag_cfg = DiagConfig(**(conf.get("diag_config") or {})),
+        idle_cfg = IdleConfig(**(conf.get("idle_config") or {})),
+        upload_cfg = UploadConfig(**(conf.get("upload_config") or {})),
+        rt_cfg = RealtimeConfig(**(conf.get("realtime_config") or {})),
+        events_cfg = EventLogConfig(**(conf.get("eventlog_config") or {}))
+    )
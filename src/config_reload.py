@@ -0,0 +1,99 @@
+from config import Config, load_config
+from dataclasses import fields
+import asyncio
+import inspect
+import os
+import signal
+import log
+
+logger = log.get_logger("reload")
+
+
+class ConfigReloader:
+    """Re-reads the station yaml on SIGHUP or when the file changes.
+
+    Sections are compared one by one and only the components registered for
+    a changed section are reconfigured, everything else (recording buffer,
+    playback position, clip caches, LEDs) keeps running untouched.
+    """
+
+    def __init__(self, path, settings: Config, event_loop: asyncio.AbstractEventLoop,
+                 poll_interval: float = 2.0):
+        self.path = path
+        self.settings = settings
+        self.event_loop = event_loop
+        self.poll_interval = poll_interval
+        self._handlers: dict[str, list] = {}
+        self._mtime = self._stat()
+        self._task: asyncio.Task | None = None
+        self._lock = asyncio.Lock()
+
+    def register(self, section: str, handler):
+        """handler(new_section_cfg), plain function or coroutine."""
+        self._handlers.setdefault(section, []).append(handler)
+
+    def _stat(self):
+        try:
+            st = os.stat(self.path)
+            return (st.st_mtime_ns, st.st_size)
+        except OSError:
+            return None
+
+    def start(self):
+        try:
+            self.event_loop.add_signal_handler(signal.SIGHUP, self.request_reload)
+        except (NotImplementedError, RuntimeError, ValueError) as err:
+            logger.warning("SIGHUP reload not available: %s", err)
+        self._task = self.event_loop.create_task(self._watch())
+
+    def stop(self):
+        try:
+            self.event_loop.remove_signal_handler(signal.SIGHUP)
+        except (NotImplementedError, RuntimeError, ValueError):
+            pass
+        if self._task is not None:
+            self._task.cancel()
+
+    def request_reload(self):
+        self.event_loop.create_task(self.reload())
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            mtime = self._stat()
+            if mtime is not None and mtime != self._mtime:
+                self._mtime = mtime
+                await self.reload()
+
+    async def reload(self) -> list:
+        """Applies the file's current content. Returns the names of the sections that changed."""
+        async with self._lock:
+            try:
+                new = load_config(self.path)
+            except Exception as err:
+                # a half saved or invalid file keeps the running configuration
+                logger.error("Config reload failed, keeping current settings: %s", err)
+                return []
+
+            changed = [f.name for f in fields(Config)
+                       if getattr(new, f.name) != getattr(self.settings, f.name)]
+            if not changed:
+                logger.info("Config reload: nothing changed.")
+                return []
+
+            applied = []
+            for section in changed:
+                cfg = getattr(new, section)
+                try:
+                    for handler in self._handlers.get(section, []):
+                        result = handler(cfg)
+                        if inspect.isawaitable(result):
+                            await result
+                except Exception as err:
+                    # the section stays "changed" and is retried on the next reload
+                    logger.exception("Error applying %s: %s", section, err)
+                    continue
+                setattr(self.settings, section, cfg)
+                applied.append(section)
+            logger.info("Config reloaded, updated: %s", ', '.join(applied) or 'nothing')
+            return applied
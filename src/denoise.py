@@ -0,0 +1,120 @@
+"""Spectral gating noise suppression.
+
+A noise profile (mean + n_std * std of the magnitude per bin and channel)
+is fitted on ambient audio, the pre-roll or the leading silence of a take.
+Bins below it are attenuated by reduction_db with a mask smoothed over time
+and frequency. Processing is overlap-add STFT with sqrt-Hann windows,
+vectorized over frames and channels. The offline path runs the streaming
+path over fixed blocks, so memory stays bounded on long takes.
+"""
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy.ndimage import uniform_filter
+
+
+class SpectralGate:
+
+    def __init__(self, rate: int, channels: int, n_fft: int = 1024, hop: int = 256,
+                 n_std: float = 1.5, reduction_db: float = 18.0,
+                 smooth_frames: int = 3, smooth_bins: int = 5):
+        assert n_fft % hop == 0
+        self.rate = rate
+        self.channels = channels
+        self.n_fft = n_fft
+        self.hop = hop
+        self.n_std = n_std
+        self.floor = np.float32(10 ** (-reduction_db / 20))
+        self.smooth = (smooth_frames, 1, smooth_bins)
+        # periodic sqrt-hann for analysis and synthesis
+        self.window = np.sqrt(np.hanning(n_fft + 1)[:-1]).astype(np.float32)
+        self.norm = (self.window ** 2).reshape(-1, hop).sum(axis=0)[:, None]
+        self.threshold: np.ndarray | None = None
+        self.reset()
+
+    def reset(self):
+        # latency of n_fft - hop samples, primed with silence
+        self._pending = np.zeros((self.n_fft - self.hop, self.channels), dtype=np.float32)
+        self._tail = np.zeros((self.n_fft - self.hop, self.channels), dtype=np.float32)
+
+    @property
+    def latency(self) -> int:
+        return self.n_fft - self.hop
+
+    def _spectra(self, x: np.ndarray) -> np.ndarray:
+        """(frames, channels, bins) complex spectra of every full frame in x."""
+        frames = sliding_window_view(x, self.n_fft, axis=0)[::self.hop]
+        return np.fft.rfft(frames * self.window, axis=-1).astype(np.complex64)
+
+    def fit(self, noise: np.ndarray, quiet_fraction: float = 0.5) -> "SpectralGate":
+        """Learns the noise profile from ambient audio.
+
+        Only the quietest frames are used, so speech that already starts
+        inside the segment does not end up in the profile.
+        """
+        x = self._as_float(noise)
+        if len(x) < self.n_fft:
+            x = np.pad(x, ((0, self.n_fft - len(x)), (0, 0)))
+        mag = np.abs(self._spectra(x))
+        energy = mag.sum(axis=(1, 2))
+        keep = max(1, int(len(energy) * quiet_fraction))
+        quiet = mag[np.argsort(energy)[:keep]]
+        self.threshold = quiet.mean(axis=0) + self.n_std * quiet.std(axis=0)
+        return self
+
+    def _as_float(self, block: np.ndarray) -> np.ndarray:
+        x = block if block.ndim == 2 else block[:, None]
+        return x.astype(np.float32, copy=False)
+
+    def process(self, block: np.ndarray) -> np.ndarray:
+        """Streaming step: takes any number of samples, returns the samples completed so far."""
+        x = np.concatenate((self._pending, self._as_float(block)))
+        n_frames = (len(x) - self.n_fft) // self.hop + 1
+        if n_frames <= 0:
+            self._pending = x
+            return np.zeros((0, self.channels), dtype=np.float32)
+
+        spec = self._spectra(x[:(n_frames - 1) * self.hop + self.n_fft])
+        if self.threshold is not None:
+            mask = (np.abs(spec) > self.threshold).astype(np.float32)
+            mask = uniform_filter(mask, size=self.smooth, mode="nearest")
+            spec *= self.floor + (1 - self.floor) * mask
+        frames = np.fft.irfft(spec, n=self.n_fft, axis=-1).astype(np.float32) * self.window
+
+        # overlap-add: every frame is n_fft / hop hop-sized pieces, shifted and summed
+        pieces = frames.transpose(0, 2, 1).reshape(n_frames, self.n_fft // self.hop, self.hop, self.channels)
+        out = np.zeros((n_frames + self.n_fft // self.hop - 1, self.hop, self.channels), dtype=np.float32)
+        for k in range(self.n_fft // self.hop):
+            out[k:k + n_frames] += pieces[:, k]
+        out = out.reshape(-1, self.channels)
+        out[:len(self._tail)] += self._tail
+
+        done = n_frames * self.hop
+        self._tail = out[done:].copy()
+        self._pending = x[done:]
+        return (out[:done].reshape(-1, self.hop, self.channels) / self.norm).reshape(-1, self.channels)
+
+    def flush(self) -> np.ndarray:
+        # enough silence to push every real sample (plus a partial hop) out of the pipeline
+        return self.process(np.zeros((self.latency + self.hop, self.channels), dtype=np.float32))
+
+    def denoise(self, data: np.ndarray, block_sec: float = 2.0) -> np.ndarray:
+        """Offline: whole take in, same length and dtype out."""
+        self.reset()
+        block = int(self.rate * block_sec)
+        out = [self.process(data[i:i + block]) for i in range(0, len(data), block)]
+        out.append(self.flush())
+        y = np.concatenate(out)[self.latency:self.latency + len(data)]
+        if data.ndim == 1:
+            y = y[:, 0]
+        if np.issubdtype(data.dtype, np.integer):
+            info = np.iinfo(data.dtype)
+            y = np.clip(np.rint(y), info.min, info.max)
+        return y.astype(data.dtype)
+
+
+def suppress(data: np.ndarray, rate: int, profile_ms: int = 500, reduction_db: float = 18.0) -> np.ndarray:
+    """Denoises a take with a profile fitted on its first profile_ms (pre-roll or leading silence)."""
+    channels = 1 if data.ndim == 1 else data.shape[1]
+    gate = SpectralGate(rate, channels, reduction_db=reduction_db)
+    gate.fit(data[:max(gate.n_fft, rate * profile_ms // 1000)])
+    return gate.denoise(data)
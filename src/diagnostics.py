@@ -0,0 +1,220 @@
+"""Runtime diagnostics for a station that feels sluggish.
+
+- event-loop lag: a task that sleeps LAG_INTERVAL_MS and measures how late it wakes up
+- blocking detector: a watchdog thread that notices when the loop stops beating and logs
+  the stack the loop thread is stuck in
+- SIGUSR1: dumps all thread stacks (also when the loop is blocked, via faulthandler) and a
+  short sampling profile of every thread in collapsed-stack format (flamegraph.pl / speedscope)
+- periodic report of RSS, lag statistics and, with TRACEMALLOC, numpy allocations
+
+Everything is off unless diag_config ENABLED is set.
+"""
+from config import DiagConfig
+from collections import Counter
+from pathlib import Path
+import asyncio
+import faulthandler
+import os
+import signal
+import sys
+import threading
+import time
+import tracemalloc
+import traceback
+import numpy as np
+import realtime
+import log
+
+logger = log.get_logger("diag")
+
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+def rss_bytes() -> int:
+    """Current resident set size (0 where /proc is not available)."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def numpy_traced_bytes(top: int = 5) -> tuple[int, list]:
+    """Bytes of live numpy buffers and the biggest allocation sites (needs tracemalloc running)."""
+    if not tracemalloc.is_tracing():
+        return 0, []
+    snapshot = tracemalloc.take_snapshot().filter_traces(
+        [tracemalloc.DomainFilter(True, np.lib.tracemalloc_domain)])
+    stats = snapshot.statistics("lineno")
+    return sum(s.size for s in stats), [(str(s.traceback[0]), s.size) for s in stats[:top]]
+
+
+def thread_stacks() -> str:
+    """Python stacks of every thread, with the thread names faulthandler does not know."""
+    names = {t.ident: t.name for t in threading.enumerate()}
+    out = []
+    for ident, frame in sys._current_frames().items():
+        out.append(f"--- {names.get(ident, '?')} ({ident}) ---\n")
+        out.extend(traceback.format_stack(frame))
+    return "".join(out)
+
+
+def _collapse(frame) -> str:
+    parts = []
+    while frame is not None:
+        code = frame.f_code
+        parts.append(f"{Path(code.co_filename).name}:{code.co_name}")
+        frame = frame.f_back
+    return ";".join(reversed(parts))
+
+
+def sample_profile(duration: float, hz: int) -> Counter:
+    """Samples every thread's stack hz times a second; counts per "thread;file:func;..." line."""
+    me = threading.get_ident()
+    counts = Counter()
+    interval = 1.0 / hz
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident != me:
+                counts[f"{names.get(ident, ident)};{_collapse(frame)}"] += 1
+        time.sleep(interval)
+    return counts
+
+
+class Diagnostics:
+
+    def __init__(self, diag_cfg: DiagConfig, event_loop: asyncio.AbstractEventLoop):
+        self.diag_cfg = diag_cfg
+        self.event_loop = event_loop
+        self._tasks: list[asyncio.Task] = []
+        self._watchdog: threading.Thread | None = None
+        self._stop = threading.Event()
+        self._profiling = threading.Lock()
+        self._stacks_file = None
+        self._loop_ident: int | None = None
+        self._beat = time.monotonic()
+        self._lag_max = 0.0
+        self._lag_sum = 0.0
+        self._lag_count = 0
+
+    def start(self):
+        if not self.diag_cfg.ENABLED:
+            return
+        Path(self.diag_cfg.DUMP_PATH).mkdir(parents=True, exist_ok=True)
+        if self.diag_cfg.TRACEMALLOC and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+        # fresh event per run, a watchdog of the previous run may still be sleeping
+        self._stop = threading.Event()
+        self._beat = time.monotonic()
+        self._tasks = [self.event_loop.create_task(self._measure_lag()),
+                       self.event_loop.create_task(self._report())]
+        self._watchdog = threading.Thread(target=self._watch_loop, args=(self._stop,), name="diag-watchdog", daemon=True)
+        self._watchdog.start()
+        self._install_signal()
+        logger.info("Diagnostics enabled, send SIGUSR1 for a stack dump and profile into %s",
+                    self.diag_cfg.DUMP_PATH)
+
+    def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+        self._stop.set()
+        if self._stacks_file is not None:
+            faulthandler.unregister(signal.SIGUSR1)
+            signal.signal(signal.SIGUSR1, signal.SIG_DFL)
+            self._stacks_file.close()
+            self._stacks_file = None
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    def reconfigure(self, diag_cfg: DiagConfig):
+        self.stop()
+        self.diag_cfg = diag_cfg
+        self.start()
+
+    # --- event loop lag and blocking ---
+
+    async def _measure_lag(self):
+        self._loop_ident = threading.get_ident()
+        interval = self.diag_cfg.LAG_INTERVAL_MS / 1000
+        while True:
+            expected = self.event_loop.time() + interval
+            await asyncio.sleep(interval)
+            lag = max(0.0, self.event_loop.time() - expected)
+            self._beat = time.monotonic()
+            self._lag_max = max(self._lag_max, lag)
+            self._lag_sum += lag
+            self._lag_count += 1
+            if lag * 1000 > self.diag_cfg.LAG_WARN_MS:
+                logger.warning("Event loop lag %.0f ms", lag * 1000, extra={"lag_ms": round(lag * 1000, 1)})
+
+    def _watch_loop(self, stop: threading.Event):
+        """Runs in its own thread, so it still sees the loop while a callback blocks it."""
+        threshold = self.diag_cfg.BLOCK_WARN_MS / 1000
+        reported = None
+        while not stop.wait(threshold / 2):
+            beat = self._beat
+            stalled = time.monotonic() - beat - self.diag_cfg.LAG_INTERVAL_MS / 1000
+            if stalled < threshold or reported == beat or self._loop_ident is None:
+                continue
+            # once per stall, the stack shows which callback holds the loop
+            reported = beat
+            frame = sys._current_frames().get(self._loop_ident)
+            stack = "".join(traceback.format_stack(frame)) if frame is not None else "?"
+            logger.warning("Event loop blocked for %.0f ms in:\n%s", stalled * 1000, stack,
+                           extra={"blocked_ms": round(stalled * 1000, 1)})
+
+    # --- periodic report ---
+
+    async def _report(self):
+        while True:
+            await asyncio.sleep(self.diag_cfg.REPORT_INTERVAL)
+            count = max(1, self._lag_count)
+            numpy_bytes, top = await self.event_loop.run_in_executor(None, numpy_traced_bytes)
+            xruns = sum(realtime.xruns.values())
+            logger.info("Health: rss %.1f MiB, numpy %.1f MiB, loop lag mean %.1f ms max %.1f ms, threads %d, "
+                        "xruns %d", rss_bytes() / 2**20, numpy_bytes / 2**20, self._lag_sum / count * 1000,
+                        self._lag_max * 1000, threading.active_count(), xruns,
+                        extra={"rss": rss_bytes(), "numpy_bytes": numpy_bytes,
+                               "lag_max_ms": round(self._lag_max * 1000, 1), "xruns": xruns})
+            for site, size in top:
+                logger.debug("numpy %8.1f KiB at %s", size / 1024, site)
+            self._lag_max = self._lag_sum = 0.0
+            self._lag_count = 0
+
+    # --- on demand dump ---
+
+    def _install_signal(self):
+        # python level handler, runs between bytecodes of the main thread even while the loop is stuck
+        signal.signal(signal.SIGUSR1, lambda signum, frame: self.request_dump())
+        # C level stack dump first, works even if the main thread never gets back to python code
+        self._stacks_file = open(Path(self.diag_cfg.DUMP_PATH) / "stacks.log", "a")
+        faulthandler.register(signal.SIGUSR1, file=self._stacks_file, all_threads=True, chain=True)
+
+    def request_dump(self):
+        threading.Thread(target=self.dump, name="diag-dump", daemon=True).start()
+
+    def dump(self) -> Path | None:
+        """Writes thread stacks and a sampling profile. Returns the profile path."""
+        if not self._profiling.acquire(blocking=False):
+            return None
+        try:
+            stamp = time.strftime("%Y%m%d-%H%M%S")
+            base = Path(self.diag_cfg.DUMP_PATH)
+            (base / f"threads-{stamp}.txt").write_text(thread_stacks())
+
+            counts = sample_profile(self.diag_cfg.PROFILE_SEC, self.diag_cfg.PROFILE_HZ)
+            profile = base / f"profile-{stamp}.folded"
+            profile.write_text("".join(f"{stack} {n}\n" for stack, n in counts.most_common()))
+
+            per_thread = Counter()
+            for stack, n in counts.items():
+                per_thread[stack.split(";", 1)[0]] += n
+            logger.warning("Diagnostics dump written to %s (samples per thread: %s)", profile,
+                           ", ".join(f"{name} {n}" for name, n in per_thread.most_common()))
+            return profile
+        finally:
+            self._profiling.release()
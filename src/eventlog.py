@@ -0,0 +1,271 @@
+"""Append-only log of how visitors use the station, for offline analysis.
+
+Every interaction is one fixed-size 40 byte record:
+
+    offset  0  t     float64  unix time
+    offset  8  dur   float32  seconds: press length, seconds of a clip played, take length
+    offset 12  kind  uint8    see KINDS
+    offset 16  clip  24 bytes clip or take name (truncated), empty if none
+
+Callers only copy a record into a preallocated buffer. A writer thread appends
+the filled buffer every FLUSH_SEC, so a power cut loses at most that much.
+When the buffer is full, records are dropped and counted instead of blocking
+the player or the event loop. Files start with a 16 byte header, are rotated
+at MAX_BYTES like the text log (events.bin, events.bin.1, ...) and are read
+straight into numpy structured arrays:
+
+    python src/eventlog.py events/events.bin             # skip rate per clip, activity per hour
+    python src/eventlog.py events/events.bin --top 50 --since 2025-06-01
+"""
+from config import EventLogConfig
+from datetime import datetime
+from pathlib import Path
+import argparse
+import os
+import struct
+import threading
+import time
+import numpy as np
+import log
+
+logger = log.get_logger("events")
+
+MAGIC = b"OHRGEV01"
+HEADER = struct.Struct("<8sII")          # magic, record size, reserved
+RECORD = np.dtype({"names": ["t", "dur", "kind", "clip"],
+                   "formats": ["<f8", "<f4", "u1", "S24"],
+                   "offsets": [0, 8, 12, 16],
+                   "itemsize": 40})
+
+# idle
+PRESS = 1           # released before the hold threshold, dur = press length
+SKIPPED = 2         # clip ended by a skip, dur = seconds it played
+PLAYED = 3          # clip played to the end, dur = its length
+INTERRUPTED = 4     # clip ended by a recording or reset, dur = seconds it played
+# takes
+RECORD_START = 5    # held, a take started
+TAKE = 6            # take ready for confirmation, dur = seconds recorded
+DISCARDED = 7       # too short or unreadable, dur = seconds recorded
+IGNORED = 8         # confirming press that was neither a tap nor a hold, dur = press length
+SAVED = 9           # dur = hold length
+DELETED = 10        # dur = tap length
+# station
+RESET = 11
+RECOVERED = 12      # a timeout or failure sent the station back to idle
+
+KINDS = {PRESS: "press", SKIPPED: "skipped", PLAYED: "played", INTERRUPTED: "interrupted",
+         RECORD_START: "record", TAKE: "take", DISCARDED: "discarded", IGNORED: "ignored",
+         SAVED: "saved", DELETED: "deleted", RESET: "reset", RECOVERED: "recovered"}
+
+# records per buffer, two of them: one fills while the other is written
+BUFFER_RECORDS = 1024
+
+
+class EventLog:
+
+    def __init__(self, events_cfg: EventLogConfig):
+        self.events_cfg = events_cfg
+        self._buffer = np.zeros(BUFFER_RECORDS, dtype=RECORD)
+        self._spare = np.zeros(BUFFER_RECORDS, dtype=RECORD)
+        self._count = 0
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+        self.dropped = 0
+        self.written = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.events_cfg.ENABLED
+
+    def start(self):
+        if not self.enabled:
+            return
+        Path(self.events_cfg.PATH).parent.mkdir(parents=True, exist_ok=True)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._write_loop, args=(self._stop,), name="eventlog", daemon=True)
+        self._thread.start()
+        logger.info("Logging interactions to %s", self.events_cfg.PATH)
+
+    def stop(self):
+        """Writes what is buffered and ends the writer thread."""
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._wake.set()
+        self._thread.join(5)
+        self._thread = None
+
+    def reconfigure(self, events_cfg: EventLogConfig):
+        self.stop()
+        self.events_cfg = events_cfg
+        self.start()
+
+    # any thread, never blocks on the disk
+    def record(self, kind: int, clip=None, dur: float = 0.0):
+        if not self.enabled:
+            return
+        name = os.path.basename(str(clip)).encode("utf-8", "replace")[:24] if clip else b""
+        with self._lock:
+            if self._count >= BUFFER_RECORDS:
+                self.dropped += 1
+                return
+            self._buffer[self._count] = (time.time(), dur, kind, name)
+            self._count += 1
+            if self._count == BUFFER_RECORDS // 2:
+                self._wake.set()
+
+    def _write_loop(self, stop: threading.Event):
+        reported = 0
+        while True:
+            self._wake.wait(self.events_cfg.FLUSH_SEC)
+            self._wake.clear()
+            self.flush()
+            if self.dropped > reported:
+                logger.warning("%d interaction events dropped, the writer could not keep up",
+                               self.dropped - reported)
+                reported = self.dropped
+            if stop.is_set():
+                return
+
+    def flush(self):
+        with self._lock:
+            full, count = self._buffer, self._count
+            self._buffer, self._spare, self._count = self._spare, self._buffer, 0
+        if not count:
+            return
+        try:
+            self._append(full[:count])
+            self.written += count
+        except OSError as err:
+            logger.error("Could not write %d interaction events: %s", count, err)
+
+    def _append(self, records: np.ndarray):
+        path = Path(self.events_cfg.PATH)
+        if path.exists() and path.stat().st_size + records.nbytes > self.events_cfg.MAX_BYTES:
+            self._rotate(path)
+        with open(path, "ab") as f:
+            size = f.tell()
+            if size < HEADER.size:
+                f.truncate(0)
+                f.write(HEADER.pack(MAGIC, RECORD.itemsize, 0))
+            elif (size - HEADER.size) % RECORD.itemsize:
+                # a record torn by a power cut, the next ones must start on a record boundary
+                f.truncate(size - (size - HEADER.size) % RECORD.itemsize)
+            f.write(records.tobytes())
+
+    def _rotate(self, path: Path):
+        # events.bin.(n-1) -> events.bin.n, ..., events.bin -> events.bin.1
+        for i in range(self.events_cfg.BACKUP_COUNT - 1, 0, -1):
+            older = path.with_name(f"{path.name}.{i}")
+            if older.exists():
+                os.replace(older, path.with_name(f"{path.name}.{i + 1}"))
+        if self.events_cfg.BACKUP_COUNT > 0:
+            os.replace(path, path.with_name(f"{path.name}.1"))
+        else:
+            path.unlink()
+
+
+# --- reading ---
+
+def read_file(path) -> np.ndarray:
+    """Records of one file, a record torn by a power cut at the end is left out."""
+    with open(path, "rb") as f:
+        head = f.read(HEADER.size)
+        if len(head) < HEADER.size:
+            return np.zeros(0, dtype=RECORD)
+        magic, size, _ = HEADER.unpack(head)
+        if magic != MAGIC or size != RECORD.itemsize:
+            raise ValueError(f"{path} is not an event log of this version")
+        data = f.read()
+    return np.frombuffer(data[:len(data) - len(data) % RECORD.itemsize], dtype=RECORD)
+
+
+def load(path) -> np.ndarray:
+    """The log and its rotated files, oldest first."""
+    path = Path(path)
+    rotated = [p for p in path.parent.glob(path.name + ".*") if p.suffix[1:].isdigit()]
+    rotated.sort(key=lambda p: int(p.suffix[1:]), reverse=True)
+    files = rotated + ([path] if path.exists() else [])
+    if not files:
+        return np.zeros(0, dtype=RECORD)
+    return np.concatenate([read_file(p) for p in files])
+
+
+def kind_counts(events: np.ndarray) -> dict:
+    counts = np.bincount(events["kind"], minlength=max(KINDS) + 1)
+    return {name: int(counts[kind]) for kind, name in KINDS.items()}
+
+
+def clip_stats(events: np.ndarray) -> list[dict]:
+    """Per clip: plays, skips, skip rate and the median seconds before a skip, most skipped first."""
+    ended = events[np.isin(events["kind"], (SKIPPED, PLAYED))]
+    if len(ended) == 0:
+        return []
+    clips, inverse = np.unique(ended["clip"], return_inverse=True)
+    skipped = ended["kind"] == SKIPPED
+    plays = np.bincount(inverse, minlength=len(clips))
+    skips = np.bincount(inverse, weights=skipped, minlength=len(clips)).astype(int)
+    # median seconds before a skip: sort the skips by clip, then by time into the clip
+    order = np.lexsort((ended["dur"][skipped], inverse[skipped]))
+    skip_ids, skip_dur = inverse[skipped][order], ended["dur"][skipped][order]
+    bounds = np.searchsorted(skip_ids, np.arange(len(clips) + 1))
+    stats = []
+    for i, clip in enumerate(clips):
+        durs = skip_dur[bounds[i]:bounds[i + 1]]
+        stats.append({"clip": clip.decode("utf-8", "replace"), "plays": int(plays[i]), "skips": int(skips[i]),
+                      "skip_rate": round(skips[i] / plays[i], 3),
+                      "median_skip_sec": round(float(np.median(durs)), 1) if len(durs) else None})
+    return sorted(stats, key=lambda s: (-s["skip_rate"], -s["plays"]))
+
+
+def hourly_activity(events: np.ndarray, kinds=(PRESS, RECORD_START)) -> np.ndarray:
+    """Visitor presses per hour of the (local) day, 24 counts."""
+    t = events["t"][np.isin(events["kind"], kinds)]
+    if len(t) == 0:
+        return np.zeros(24, dtype=int)
+    # utc offset looked up once per day, so daylight saving time is right without a python loop per event
+    days, inverse = np.unique(t // 86400, return_inverse=True)
+    offsets = np.array([datetime.fromtimestamp(d * 86400 + 43200).astimezone().utcoffset().total_seconds()
+                        for d in days])
+    local = t + offsets[inverse]
+    return np.bincount(((local // 3600) % 24).astype(int), minlength=24)
+
+
+def report(events: np.ndarray, top: int = 20):
+    if len(events) == 0:
+        print("No events.")
+        return
+    first, last = (datetime.fromtimestamp(float(events["t"][i])) for i in (0, -1))
+    print(f"{len(events)} events from {first:%Y-%m-%d %H:%M} to {last:%Y-%m-%d %H:%M}")
+    print("  " + ", ".join(f"{name} {n}" for name, n in kind_counts(events).items() if n))
+
+    stats = clip_stats(events)
+    if stats:
+        print(f"\nMost skipped clips ({len(stats)} clips played):")
+        print(f"  {'clip':<26}{'plays':>7}{'skips':>7}{'rate':>7}{'median s':>10}")
+        for s in stats[:top]:
+            median = "-" if s["median_skip_sec"] is None else f"{s['median_skip_sec']:.1f}"
+            print(f"  {s['clip']:<26}{s['plays']:>7}{s['skips']:>7}{s['skip_rate']:>7.2f}{median:>10}")
+
+    hours = hourly_activity(events)
+    if hours.any():
+        print("\nPresses per hour of day:")
+        scale = 40 / hours.max()
+        for hour, n in enumerate(hours):
+            if n:
+                print(f"  {hour:02d}:00 {n:>6} {'#' * max(1, int(n * scale))}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Summarize the interaction event log.")
+    parser.add_argument("path", help="the event log, rotated files next to it are read too")
+    parser.add_argument("--top", type=int, default=20, help="clips in the skip table")
+    parser.add_argument("--since", help="only events from this day on (YYYY-MM-DD)")
+    args = parser.parse_args()
+
+    events = load(args.path)
+    if args.since:
+        events = events[events["t"] >= datetime.strptime(args.since, "%Y-%m-%d").timestamp()]
+    report(events, args.top)
@@ -0,0 +1,288 @@
+"""Spectral fingerprints of takes, to spot repeats and re-recorded playback.
+
+A take is mixed to mono, resampled to 8 kHz and turned into a log spectrogram
+(512 point STFT, 32 ms hop). Local maxima above the take's median level are
+the peaks, the strongest PEAKS_PER_SEC of every second. Each peak is paired
+with the FAN_OUT strongest peaks in its target zone, and every pair is
+hashed as (freq anchor, freq target, time delta) into 22 bits. This is the same
+constellation idea as the classic music recognizers, and it survives room
+noise and a trip through speaker and microphone.
+
+The archive index is an inverted index kept as three arrays sorted by hash
+(hash, take id, anchor time). A lookup is one searchsorted per query hash.
+A candidate counts the hits that agree on a single time offset against the
+query, so a take of a few thousand hashes is checked against the whole
+archive in a few milliseconds. The index lives in <RECORDING_PATH>/.fingerprints.npz,
+an index of an older INDEX_VERSION is rebuilt. It can always be rebuilt from the audio:
+
+    python src/fingerprint.py recordings [--jobs N] [--rebuild]
+"""
+from concurrent.futures import ProcessPoolExecutor
+from math import gcd
+from pathlib import Path
+import argparse
+import os
+import threading
+import numpy as np
+from scipy.ndimage import maximum_filter
+from scipy.signal import resample_poly
+import segstore
+
+INDEX_FILE = ".fingerprints.npz"
+# bumped when peaks or pairs are chosen differently, an index of another version is rebuilt
+INDEX_VERSION = 2
+SIDECAR_KEY = "duplicate"
+
+FP_RATE = 8000
+N_FFT = 512
+HOP = 256
+# peak neighbourhood in frames x bins, and how far above the median a peak must be
+PEAK_SIZE = (7, 15)
+PEAK_DB = 6.0
+# peaks kept per band of about a second (in frames)
+PEAKS_PER_SEC = 30
+BAND_FRAMES = round(FP_RATE / HOP)
+# pairs per anchor, and the target zone in frames / bins
+FAN_OUT = 6
+MAX_DT = 63
+MAX_DF = 64
+# hits per take that agree on one offset, unrelated takes stay around 5
+MIN_MATCHES = 12
+
+
+def _mono(data: np.ndarray) -> np.ndarray:
+    x = data.astype(np.float32)
+    return x.mean(axis=1) if x.ndim == 2 else x
+
+
+def spectrogram(data: np.ndarray, rate: int) -> np.ndarray:
+    """Log magnitude, frames x bins (the last bin, Nyquist, is dropped)."""
+    x = _mono(data)
+    if rate != FP_RATE:
+        div = gcd(rate, FP_RATE)
+        x = resample_poly(x, FP_RATE // div, rate // div).astype(np.float32)
+    if len(x) < N_FFT:
+        return np.zeros((0, N_FFT // 2), dtype=np.float32)
+    frames = np.lib.stride_tricks.sliding_window_view(x, N_FFT)[::HOP] * np.hanning(N_FFT).astype(np.float32)
+    spec = np.abs(np.fft.rfft(frames, axis=1))[:, :N_FFT // 2]
+    return 20 * np.log10(spec + 1e-3, dtype=np.float32)
+
+
+def peaks(spec: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """(frames, bins) of the constellation, in time order."""
+    if spec.size == 0:
+        return np.zeros(0, np.int32), np.zeros(0, np.int32)
+    local = (maximum_filter(spec, size=PEAK_SIZE, mode="constant", cval=-np.inf) == spec)
+    local &= spec > np.median(spec) + PEAK_DB
+    # bin 0 is DC and rumble
+    local[:, 0] = False
+    t, f = np.nonzero(local)
+    # the strongest PEAKS_PER_SEC of every second on its own, a loud passage
+    # must not use up the peaks of the quiet ones
+    band = t // BAND_FRAMES
+    order = np.lexsort((-spec[t, f], band))
+    first = np.r_[0, np.flatnonzero(np.diff(band[order])) + 1]
+    rank = np.arange(len(order)) - np.repeat(first, np.diff(np.r_[first, len(order)]))
+    keep = np.sort(order[rank < PEAKS_PER_SEC])
+    return t[keep].astype(np.int32), f[keep].astype(np.int32)
+
+
+def fingerprint(data: np.ndarray, rate: int) -> tuple[np.ndarray, np.ndarray]:
+    """(hashes, anchor frames) of a take, both int32/uint32 arrays of the same length."""
+    spec = spectrogram(data, rate)
+    t, f = peaks(spec)
+    level = spec[t, f]
+    anchors, targets = [], []
+    # peaks are in time order, the k-th next one is a candidate as long as it is in the zone
+    for k in range(1, len(t)):
+        dt = t[k:] - t[:-k]
+        if dt.min() > MAX_DT:
+            break
+        ok = (dt > 0) & (dt <= MAX_DT) & (np.abs(f[k:] - f[:-k]) <= MAX_DF)
+        anchors.append(np.flatnonzero(ok))
+        targets.append(anchors[-1] + k)
+    if not anchors:
+        return np.zeros(0, np.uint32), np.zeros(0, np.int32)
+    anchors, targets = np.concatenate(anchors), np.concatenate(targets)
+    # at most FAN_OUT pairs per anchor: the strongest peaks in its zone, noise
+    # peaks that come first in time do not push out the ones that carry the take
+    order = np.lexsort((-level[targets], anchors))
+    anchors, targets = anchors[order], targets[order]
+    first = np.r_[0, np.flatnonzero(np.diff(anchors)) + 1]
+    rank = np.arange(len(anchors)) - np.repeat(first, np.diff(np.r_[first, len(anchors)]))
+    keep = rank < FAN_OUT
+    anchors, targets = anchors[keep], targets[keep]
+    hashes = (f[anchors].astype(np.uint32) << 14) | (f[targets].astype(np.uint32) << 6) \
+        | (t[targets] - t[anchors]).astype(np.uint32)
+    return hashes, t[anchors].astype(np.int32)
+
+
+class FingerprintIndex:
+    """Inverted index of the archive's fingerprints. Thread safe, used from the executor."""
+
+    def __init__(self, path=None):
+        self.path = Path(path) if path else None
+        self.names: list[str] = []
+        self.ids: dict[str, int] = {}
+        self.alive = np.zeros(0, dtype=bool)
+        self.hashes = np.zeros(0, np.uint32)
+        self.take_ids = np.zeros(0, np.int32)
+        self.times = np.zeros(0, np.int32)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def open(cls, path, present: list | None = None) -> "FingerprintIndex":
+        """Loads the index, dropping takes that are not in present (names) anymore."""
+        index = cls(path)
+        try:
+            with np.load(path) as f:
+                if "version" not in f or int(f["version"]) != INDEX_VERSION:
+                    return index
+                index.names = [str(n) for n in f["names"]]
+                index.alive = f["alive"].copy()
+                index.hashes, index.take_ids, index.times = f["hashes"], f["take_ids"], f["times"]
+        except (OSError, KeyError, ValueError):
+            return index
+        index.ids = {name: i for i, name in enumerate(index.names) if index.alive[i]}
+        if present is not None:
+            keep = {Path(p).name for p in present}
+            for name in [n for n in index.ids if n not in keep]:
+                index.remove(name)
+        return index
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.ids
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def add(self, name: str, hashes: np.ndarray, times: np.ndarray):
+        with self._lock:
+            if name in self.ids:
+                self.alive[self.ids[name]] = False
+            take_id = len(self.names)
+            self.names.append(name)
+            self.ids[name] = take_id
+            self.alive = np.r_[self.alive, True]
+            order = np.argsort(hashes, kind="stable")
+            new_hashes = hashes[order]
+            # merged in place of a full sort, adds are rare and the index stays sorted
+            at = np.searchsorted(self.hashes, new_hashes, side="right")
+            self.hashes = np.insert(self.hashes, at, new_hashes)
+            self.take_ids = np.insert(self.take_ids, at, np.full(len(order), take_id, np.int32))
+            self.times = np.insert(self.times, at, times[order])
+
+    def remove(self, name: str):
+        with self._lock:
+            take_id = self.ids.pop(name, None)
+            if take_id is not None:
+                self.alive[take_id] = False
+
+    def clear(self):
+        with self._lock:
+            self.__init__(self.path)
+
+    def match(self, hashes: np.ndarray, times: np.ndarray, min_matches: int = MIN_MATCHES) -> list[tuple]:
+        """(name, score, hits) of the takes that share a time-aligned part, best first.
+
+        score is the share of the query's hashes that line up with the take.
+        """
+        with self._lock:
+            if len(hashes) == 0 or len(self.hashes) == 0:
+                return []
+            left = np.searchsorted(self.hashes, hashes, side="left")
+            right = np.searchsorted(self.hashes, hashes, side="right")
+            counts = right - left
+            total = int(counts.sum())
+            if total == 0:
+                return []
+            # every (query hash, index entry) pair with the same hash, without a python loop
+            starts = np.repeat(left - np.cumsum(counts) + counts, counts)
+            hit = starts + np.arange(total)
+            ids = self.take_ids[hit]
+            delta = self.times[hit] - np.repeat(times, counts)
+            alive = self.alive[ids]
+            ids, delta = ids[alive], delta[alive]
+            names = self.names
+
+        if len(ids) == 0:
+            return []
+        # hits of one take that agree on the offset, the best offset per take
+        key = ids.astype(np.int64) << 32 | (delta.astype(np.int64) + (1 << 31))
+        uniq, votes = np.unique(key, return_counts=True)
+        take = (uniq >> 32).astype(np.int32)
+        first = np.r_[0, np.flatnonzero(np.diff(take)) + 1]
+        best = np.maximum.reduceat(votes, first)
+        results = [(names[take[i]], round(float(b) / len(hashes), 3), int(b))
+                   for i, b in zip(first, best) if b >= min_matches]
+        return sorted(results, key=lambda r: -r[1])
+
+    def save(self, path=None):
+        """Written to a temp file and renamed, dead takes are dropped on the way."""
+        path = Path(path or self.path)
+        with self._lock:
+            keep = self.alive[self.take_ids] if len(self.take_ids) else np.zeros(0, bool)
+            # renumber the live takes
+            live = np.flatnonzero(self.alive)
+            remap = np.full(len(self.names), -1, np.int32)
+            remap[live] = np.arange(len(live), dtype=np.int32)
+            self.hashes, self.times = self.hashes[keep], self.times[keep]
+            self.take_ids = remap[self.take_ids[keep]]
+            self.names = [self.names[i] for i in live]
+            self.alive = np.ones(len(self.names), dtype=bool)
+            self.ids = {name: i for i, name in enumerate(self.names)}
+            tmp = path.with_name(path.name + ".tmp")
+            with open(tmp, "wb") as f:
+                np.savez(f, version=INDEX_VERSION, names=np.array(self.names, dtype=str), alive=self.alive,
+                         hashes=self.hashes, take_ids=self.take_ids, times=self.times)
+            os.replace(tmp, path)
+
+
+def fingerprint_file(path) -> tuple[np.ndarray, np.ndarray]:
+    rate, data = segstore.read_wav(path)
+    return fingerprint(data, rate)
+
+
+def _fingerprint_job(path):
+    try:
+        return path, fingerprint_file(path), None
+    except (OSError, ValueError) as err:
+        return path, None, str(err)
+
+
+def build(rec_path, jobs: int | None = None, rebuild: bool = False) -> list[tuple]:
+    """Indexes every take that is not in the index yet, in name order so a repeat is found
+    against the take it repeats. Returns (take, repeats, score) for the repeats found."""
+    rec_path = Path(rec_path)
+    wavs = segstore.wav_paths(rec_path)
+    index = FingerprintIndex(rec_path / INDEX_FILE) if rebuild else \
+        FingerprintIndex.open(rec_path / INDEX_FILE, present=wavs)
+    todo = [str(p) for p in wavs if p.name not in index]
+    print(f"Fingerprinting {len(todo)} recordings in {rec_path}...")
+
+    repeats = []
+    # workers find packed takes through the store of rec_path
+    with ProcessPoolExecutor(max_workers=jobs or os.cpu_count(), initializer=segstore.open_existing,
+                             initargs=(rec_path,)) as pool:
+        for path, fp, err in pool.map(_fingerprint_job, todo, chunksize=4):
+            if err:
+                print(f"Failed {path}: {err}")
+                continue
+            name = Path(path).name
+            found = index.match(*fp)
+            if found:
+                repeats.append((name, found[0][0], found[0][1]))
+                print(f"{name} repeats {found[0][0]} (score {found[0][1]})")
+            index.add(name, *fp)
+    index.save()
+    print(f"{len(index)} recordings indexed, {len(repeats)} repeats found")
+    return repeats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the fingerprint index of the archive and list repeats.")
+    parser.add_argument("recording_path")
+    parser.add_argument("--jobs", type=int, default=None, help="worker processes (default: all cores)")
+    parser.add_argument("--rebuild", action="store_true", help="start from an empty index")
+    args = parser.parse_args()
+    build(args.recording_path, args.jobs, args.rebuild)
@@ -0,0 +1,261 @@
+from config import HttpConfig
+from pathlib import Path
+from urllib.parse import unquote, urlsplit
+import asyncio
+import json
+import os
+import tarfile
+from typing import TYPE_CHECKING
+import loudness
+import segstore
+import log
+
+logger = log.get_logger("http")
+
+if TYPE_CHECKING:
+    from cmd_typing import CmdTyping
+
+# sendfile slice, also the granularity of the rate limiter
+SLICE = 64 * 1024
+TAR_BLOCK = 512
+
+REASONS = {200: "OK", 206: "Partial Content", 400: "Bad Request", 404: "Not Found",
+           405: "Method Not Allowed", 416: "Range Not Satisfiable", 503: "Service Unavailable"}
+
+
+class TokenBucket:
+    """Shared byte budget for all downloads so serving never starves capture or playback I/O."""
+
+    def __init__(self, rate_bytes: float, event_loop: asyncio.AbstractEventLoop):
+        self.rate = rate_bytes
+        # at least one SLICE, below 64 KB/s a whole slice would never fit
+        self.capacity = max(rate_bytes, SLICE)
+        self.event_loop = event_loop
+        self.tokens = self.capacity
+        self.stamp = event_loop.time()
+
+    async def take(self, amount: int):
+        while True:
+            now = self.event_loop.time()
+            self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            if self.tokens >= amount:
+                self.tokens -= amount
+                return
+            await asyncio.sleep((amount - self.tokens) / self.rate)
+
+
+def parse_range(header: str, size: int) -> tuple[int, int] | None:
+    """Single "bytes=" range to (start, end inclusive). Raises ValueError if unsatisfiable."""
+    if not header.startswith("bytes=") or "," in header:
+        return None
+    first, _, last = header[6:].strip().partition("-")
+    if first:
+        start = int(first)
+        end = int(last) if last else size - 1
+    else:
+        # suffix range: the last n bytes
+        start = max(0, size - int(last))
+        end = size - 1
+    end = min(end, size - 1)
+    if start > end or start >= size:
+        raise ValueError(header)
+    return start, end
+
+
+class HttpApi:
+    """Read-only HTTP access to the recording archive, served on the station's event loop.
+
+    GET /recordings              json list of the catalog
+    GET /recordings/<name>       one take, supports Range
+    GET /archive.tar             all takes as a tar stream built on the fly
+    """
+
+    def __init__(self, http_cfg: HttpConfig, rec_path: str, event_loop):
+        self.http_cfg = http_cfg
+        self.rec_path = Path(rec_path)
+        self.event_loop: asyncio.AbstractEventLoop = event_loop
+        self.bucket = TokenBucket(http_cfg.RATE_LIMIT_KBPS * 1024, event_loop)
+        self.clients = asyncio.Semaphore(http_cfg.MAX_CLIENTS)
+        self.server: asyncio.AbstractServer | None = None
+        self.cmd: "CmdTyping | None" = None
+
+    def inject_cmd(self, cmd: "CmdTyping"):
+        self.cmd = cmd
+
+    async def start(self):
+        if not self.http_cfg.ENABLED:
+            return
+        self.server = await asyncio.start_server(self._handle, self.http_cfg.HOST, self.http_cfg.PORT)
+        logger.info("HTTP archive API listening on %s:%d", self.http_cfg.HOST, self.http_cfg.PORT)
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+    async def reconfigure(self, http_cfg: HttpConfig):
+        await self.close()
+        self.http_cfg = http_cfg
+        self.bucket = TokenBucket(http_cfg.RATE_LIMIT_KBPS * 1024, self.event_loop)
+        self.clients = asyncio.Semaphore(http_cfg.MAX_CLIENTS)
+        await self.start()
+
+    # --- catalog ---
+
+    # the filesystem work of a request runs in the executor, a listing of a
+    # large archive on a slow card would otherwise stall capture and playback
+
+    async def _catalog(self) -> dict[str, Path]:
+        if self.cmd is not None:
+            # the buffer is also changed from the executor (reset_recordings), copied under the player's lock
+            files = [Path(f) for f in self.cmd.player.copy_buffer()]
+        else:
+            files = await self.event_loop.run_in_executor(None, segstore.wav_paths, self.rec_path)
+        return {f.name: f for f in files}
+
+    @staticmethod
+    def _stat_catalog(catalog: dict[str, Path]) -> list:
+        """(name, path, size, mtime) of the takes that still exist, by name. Blocking."""
+        stats = []
+        for name, path in sorted(catalog.items()):
+            try:
+                size, mtime = segstore.clip_stat(path)
+            except OSError:
+                continue
+            stats.append((name, path, size, mtime))
+        return stats
+
+    @classmethod
+    def _listing(cls, catalog: dict[str, Path]) -> list:
+        return [{"name": name, "size": size, "mtime": mtime, "loudness": loudness.load(path)}
+                for name, path, size, mtime in cls._stat_catalog(catalog)]
+
+    # --- http ---
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            try:
+                head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 10)
+            except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError):
+                return
+            lines = head.decode("latin-1").split("\r\n")
+            try:
+                method, target, _ = lines[0].split(" ", 2)
+            except ValueError:
+                await self._respond(writer, 400)
+                return
+            headers = {}
+            for line in lines[1:]:
+                key, _, value = line.partition(":")
+                if key:
+                    headers[key.strip().lower()] = value.strip()
+
+            if method not in ("GET", "HEAD"):
+                await self._respond(writer, 405)
+                return
+            if self.clients.locked():
+                await self._respond(writer, 503)
+                return
+            async with self.clients:
+                await self._route(writer, method, unquote(urlsplit(target).path), headers)
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        except Exception as err:
+            logger.exception("HTTP API error: %s", err)
+        finally:
+            writer.close()
+
+    async def _respond(self, writer, status: int, body: bytes = b"", content_type: str = "text/plain",
+                       extra: dict | None = None, length: int | None = None, send_body: bool = True):
+        header = [f"HTTP/1.1 {status} {REASONS.get(status, '')}",
+                  f"Content-Type: {content_type}",
+                  f"Content-Length: {len(body) if length is None else length}",
+                  "Accept-Ranges: bytes",
+                  "Connection: close"]
+        header += [f"{k}: {v}" for k, v in (extra or {}).items()]
+        writer.write(("\r\n".join(header) + "\r\n\r\n").encode("latin-1"))
+        if send_body and body:
+            writer.write(body)
+        await writer.drain()
+
+    async def _route(self, writer, method: str, path: str, headers: dict):
+        send_body = method == "GET"
+        if path in ("/recordings", "/recordings/"):
+            listing = await self.event_loop.run_in_executor(None, self._listing, await self._catalog())
+            body = json.dumps(listing).encode()
+            await self._respond(writer, 200, body, "application/json", send_body=send_body)
+        elif path.startswith("/recordings/"):
+            # names are looked up in the catalog, never joined into a filesystem path
+            recording = (await self._catalog()).get(path[len("/recordings/"):])
+            if recording is None:
+                await self._respond(writer, 404, b"not found")
+                return
+            await self._send_recording(writer, recording, headers.get("range"), send_body)
+        elif path == "/archive.tar":
+            await self._send_archive(writer, send_body)
+        else:
+            await self._respond(writer, 404, b"not found")
+
+    async def _send_recording(self, writer, recording: Path, range_header: str | None, send_body: bool):
+        # a packed take is a byte range of its segment
+        with segstore.open_clip(recording) as (f, base, size):
+            start, end, status, extra = 0, size - 1, 200, {}
+            if range_header:
+                try:
+                    parsed = parse_range(range_header, size)
+                except ValueError:
+                    await self._respond(writer, 416, extra={"Content-Range": f"bytes */{size}"})
+                    return
+                if parsed:
+                    start, end = parsed
+                    status = 206
+                    extra["Content-Range"] = f"bytes {start}-{end}/{size}"
+            await self._respond(writer, status, content_type="audio/wav", extra=extra,
+                                length=end - start + 1, send_body=False)
+            if send_body:
+                await self._sendfile(writer, f, base + start, end - start + 1)
+
+    async def _sendfile(self, writer: asyncio.StreamWriter, f, offset: int, count: int):
+        """Zero-copy sendfile in throttled slices. Pauses while a take is being recorded."""
+        while count > 0:
+            if self.cmd is not None:
+                while self.cmd.recorder.is_recording():
+                    await asyncio.sleep(0.5)
+            chunk = min(SLICE, count)
+            await self.bucket.take(chunk)
+            await self.event_loop.sendfile(writer.transport, f, offset, chunk)
+            # served data should not evict the clips of the rotation from the page cache
+            try:
+                os.posix_fadvise(f.fileno(), offset, chunk, os.POSIX_FADV_DONTNEED)
+            except (AttributeError, OSError):
+                pass
+            offset += chunk
+            count -= chunk
+
+    async def _send_archive(self, writer, send_body: bool):
+        entries = []
+        stats = await self.event_loop.run_in_executor(None, self._stat_catalog, await self._catalog())
+        for name, path, size, mtime in stats:
+            info = tarfile.TarInfo(name)
+            info.size = size
+            info.mtime = int(mtime)
+            info.mode = 0o644
+            entries.append((path, info))
+
+        # exact length up front: header block + data padded to 512 per member, two zero blocks at the end
+        total = sum(TAR_BLOCK + -(-info.size // TAR_BLOCK) * TAR_BLOCK for _, info in entries) + 2 * TAR_BLOCK
+        await self._respond(writer, 200, content_type="application/x-tar", length=total, send_body=False,
+                            extra={"Content-Disposition": 'attachment; filename="recordings.tar"'})
+        if not send_body:
+            return
+
+        for path, info in entries:
+            writer.write(info.tobuf(format=tarfile.USTAR_FORMAT))
+            with segstore.open_clip(path) as (f, base, _):
+                await self._sendfile(writer, f, base, info.size)
+            if pad := -info.size % TAR_BLOCK:
+                writer.write(b"\0" * pad)
+        writer.write(b"\0" * (2 * TAR_BLOCK))
+        await writer.drain()
@@ -0,0 +1,173 @@
+"""Activity-aware rotation, so a closed or empty venue does not keep the station busy.
+
+active  normal rotation
+quiet   QUIET_AFTER_SEC without a button press, QUIET_GAP_SEC between clips
+asleep  SLEEP_AFTER_SEC without a button press, or QUIET_AFTER_SEC outside OPENING_HOURS:
+        rotation stopped, mixer output closed, clip cache dropped, LEDs off
+
+Any button edge goes straight back to active, opening time counts as activity.
+"""
+from config import IdleConfig
+from datetime import datetime
+import asyncio
+import time
+from typing import TYPE_CHECKING
+import log
+
+logger = log.get_logger("idle")
+
+if TYPE_CHECKING:
+    from cmd_typing import CmdTyping
+
+DAYS = ("mon", "tue", "wed", "thu", "fri", "sat", "sun")
+ACTIVE, QUIET, ASLEEP = "active", "quiet", "asleep"
+# longest sleep between calendar checks
+CHECK_SEC = 30.0
+
+
+def _minutes(text: str) -> int:
+    hours, _, minutes = text.partition(":")
+    value = int(hours) * 60 + int(minutes or 0)
+    if not 0 <= value <= 24 * 60:
+        raise ValueError(f"invalid time {text!r}")
+    return value
+
+
+def _days(spec: str) -> frozenset:
+    days = set()
+    for part in spec.lower().split(","):
+        first, _, last = part.partition("-")
+        names = [first.strip(), last.strip() or first.strip()]
+        if any(name not in DAYS for name in names):
+            raise ValueError(f"unknown day in {spec!r}")
+        start, end = DAYS.index(names[0]), DAYS.index(names[1])
+        # "fri-mon" wraps over the weekend
+        days.update(DAYS[(start + i) % 7] for i in range((end - start) % 7 + 1))
+    return frozenset(DAYS.index(day) for day in days)
+
+
+def parse_hours(entries: list) -> list[tuple[frozenset, int, int]]:
+    """["mon-fri 10:00-18:00", "sat,sun 11:00-02:00"] to (weekdays, start, end) in minutes.
+
+    An end before the start runs past midnight. Raises ValueError on a malformed entry.
+    """
+    hours = []
+    for entry in entries:
+        try:
+            days, span = entry.split()
+            start, end = span.split("-")
+            hours.append((_days(days), _minutes(start), _minutes(end)))
+        except ValueError as err:
+            raise ValueError(f"invalid opening hours {entry!r}: {err}") from None
+    return hours
+
+
+def is_open(hours: list, now: datetime) -> bool:
+    """True inside any of the parsed spans, always True without any."""
+    if not hours:
+        return True
+    minute = now.hour * 60 + now.minute
+    today = now.weekday()
+    for days, start, end in hours:
+        if start < end:
+            if today in days and start <= minute < end:
+                return True
+        # past midnight: the evening belongs to today, the early morning to yesterday
+        elif (today in days and minute >= start) or ((today - 1) % 7 in days and minute < end):
+            return True
+    return False
+
+
+class IdleScheduler:
+
+    def __init__(self, idle_cfg: IdleConfig, event_loop: asyncio.AbstractEventLoop):
+        self.idle_cfg = idle_cfg
+        self.event_loop = event_loop
+        self.hours = parse_hours(idle_cfg.OPENING_HOURS)
+        self.state = ACTIVE
+        self._last_activity = time.monotonic()
+        self._was_open = True
+        self._activity = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self.cmd: "CmdTyping | None" = None
+
+    def inject_cmd(self, cmd: "CmdTyping"):
+        self.cmd = cmd
+
+    def start(self):
+        if not self.idle_cfg.ENABLED:
+            return
+        self._last_activity = time.monotonic()
+        self._was_open = is_open(self.hours, datetime.now())
+        self._task = self.event_loop.create_task(self._run())
+        logger.info("Idle mode enabled (quiet after %d s, sleep after %d s, opening hours: %s)",
+                    self.idle_cfg.QUIET_AFTER_SEC, self.idle_cfg.SLEEP_AFTER_SEC,
+                    ", ".join(self.idle_cfg.OPENING_HOURS) or "always")
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self._apply(ACTIVE)
+
+    def reconfigure(self, idle_cfg: IdleConfig):
+        # parsed first, a bad calendar keeps the running one
+        hours = parse_hours(idle_cfg.OPENING_HOURS)
+        self.stop()
+        self.idle_cfg = idle_cfg
+        self.hours = hours
+        self.start()
+
+    # called from the gpio thread on every button edge
+    def activity(self):
+        if self._task is None:
+            return
+        self._last_activity = time.monotonic()
+        if self.state == ASLEEP:
+            # right away, not on the next event loop turn
+            self.cmd.player.wake()
+        self.event_loop.call_soon_threadsafe(self._activity.set)
+
+    def _target(self, idle_for: float, open_now: bool) -> str:
+        cfg = self.idle_cfg
+        if idle_for < cfg.QUIET_AFTER_SEC:
+            return ACTIVE
+        if not open_now or (cfg.SLEEP_AFTER_SEC and idle_for >= cfg.SLEEP_AFTER_SEC):
+            return ASLEEP
+        return QUIET
+
+    async def _run(self):
+        cfg = self.idle_cfg
+        while True:
+            open_now = is_open(self.hours, datetime.now())
+            if open_now and not self._was_open:
+                logger.info("Opening hours started")
+                self._last_activity = time.monotonic()
+            self._was_open = open_now
+
+            idle_for = time.monotonic() - self._last_activity
+            self._apply(self._target(idle_for, open_now))
+
+            # until the next threshold, the calendar is checked every CHECK_SEC
+            timeout = CHECK_SEC
+            for threshold in (cfg.QUIET_AFTER_SEC, cfg.SLEEP_AFTER_SEC):
+                if threshold and threshold > idle_for:
+                    timeout = min(timeout, threshold - idle_for)
+            try:
+                await asyncio.wait_for(self._activity.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            self._activity.clear()
+
+    def _apply(self, state: str):
+        if state == self.state or self.cmd is None:
+            return
+        logger.info("Idle state %s -> %s", self.state, state)
+        self.state = state
+        player = self.cmd.player
+        if state == ASLEEP:
+            player.sleep()
+            self.cmd.led.standby()
+            return
+        player.set_idle_gap(self.idle_cfg.QUIET_GAP_SEC if state == QUIET else None)
+        player.wake()
@@ -4,6 +4,9 @@ import asyncio
 from config import LedConfig
 
 from typing import TYPE_CHECKING
+import log
+
+logger = log.get_logger("led")
 
 if TYPE_CHECKING:
     from cmd_typing import CmdTyping
@@ -19,6 +22,14 @@ OFF = (0, 0, 0)
 class LedManager:
     def __init__(self, led_cfg: LedConfig, event_loop):
         
+        self._init_led(led_cfg)
+        
+        self.event_loop: asyncio.AbstractEventLoop = event_loop
+        # Debug purpose
+        #self.event_loop.create_task(self.startup_sequence())
+
+    def _init_led(self, led_cfg: LedConfig):
+        self.led_cfg = led_cfg
         self.led_pin = led_cfg.DATA_PIN
         self.led_num = led_cfg.PIXEL_NUM
 
@@ -27,11 +38,23 @@ class LedManager:
 
         else:
             self.led = None
-            print("Led not configured.")
-        
-        self.event_loop: asyncio.AbstractEventLoop = event_loop
-        # Debug purpose
-        #self.event_loop.create_task(self.startup_sequence())
+            logger.info("Led not configured.")
+
+    # hot reload: release the old pin before claiming the new one
+    def reconfigure(self, led_cfg: LedConfig):
+        old_cfg = self.led_cfg
+        self.shutdown_neopixel()
+        try:
+            self._init_led(led_cfg)
+        except Exception:
+            # the old strip comes back and the reload keeps the old led_config, as for a bad file
+            logger.error("LED %s not usable, restoring %s", led_cfg.DATA_PIN, old_cfg.DATA_PIN)
+            try:
+                self._init_led(old_cfg)
+            except Exception as err:
+                self.led = None
+                logger.error("LED %s not usable either, running without LED: %s", old_cfg.DATA_PIN, err)
+            raise
 
     async def startup_sequence(self):
         if not self.led:
@@ -123,7 +146,7 @@ class LedManager:
         if not self.led:
             return
         self.led[0] = RED
-        print("LED RED")
+        logger.debug("LED RED")
         return RED
 
     def replay_led_on(self):
@@ -143,6 +166,12 @@ class LedManager:
             return
         self.led[0] = OFF
 
+    # idle mode: every pixel dark, the pin stays claimed
+    def standby(self):
+        if not self.led:
+            return
+        self.led.fill(OFF)
+
     def led_on(self, color = (10, 10, 10)):
         if not self.led:
             return
@@ -153,5 +182,6 @@ class LedManager:
             return
         self.led.fill((0, 0, 0))
         self.led.show()
-        print(f"Freeing up LED gpio pin {self.led_pin}")
-        del self.led
+        logger.info("Freeing up LED gpio pin %s", self.led_pin)
+        # the last reference, dropping it frees the pin; None keeps the "if not self.led" checks working
+        self.led = None
@@ -0,0 +1,134 @@
+"""Station logging: per-component loggers, records handed to a background writer.
+
+Callers only pay for building the record and a put_nowait() into a bounded
+queue. Formatting and the actual writes (console, journald pipe, rotated
+file) happen in the QueueListener thread. When the writer cannot keep up,
+records are dropped instead of blocking the player thread or the event loop,
+and the number of dropped records is reported later.
+"""
+from config import LogConfig
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+import asyncio
+import json
+import logging
+import queue
+import sys
+
+ROOT = "ohrgarten"
+# attributes every LogRecord has, everything else came in through extra={...}
+_STANDARD = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+
+def get_logger(component: str) -> logging.Logger:
+    return logging.getLogger(f"{ROOT}.{component}")
+
+
+class DroppingQueueHandler(QueueHandler):
+    """QueueHandler that never blocks: a full queue drops the record and counts it."""
+
+    def __init__(self, q: queue.Queue):
+        super().__init__(q)
+        self.dropped = 0
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """One json object per line: ts, level, component, msg plus any extra fields."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "component": record.name[len(ROOT) + 1:] if record.name.startswith(ROOT + ".") else record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _STANDARD:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+_handler: DroppingQueueHandler | None = None
+_listener: QueueListener | None = None
+_reported_drops = 0
+
+# until setup_logging() runs (tools, import time, shutdown) records go straight to stderr
+_bootstrap = logging.StreamHandler(sys.stderr)
+logging.getLogger(ROOT).addHandler(_bootstrap)
+logging.getLogger(ROOT).setLevel(logging.INFO)
+logging.getLogger(ROOT).propagate = False
+
+
+def _writers(log_cfg: LogConfig) -> list:
+    text = logging.Formatter("%(asctime)s %(levelname)-7s %(name)s: %(message)s")
+    writers = []
+    if log_cfg.CONSOLE:
+        console = logging.StreamHandler(sys.stdout)
+        console.setFormatter(JsonLinesFormatter() if log_cfg.FORMAT == "json" else text)
+        writers.append(console)
+    if log_cfg.FILE:
+        rotating = RotatingFileHandler(log_cfg.FILE, maxBytes=log_cfg.MAX_BYTES,
+                                       backupCount=log_cfg.BACKUP_COUNT)
+        rotating.setFormatter(JsonLinesFormatter() if log_cfg.FORMAT == "json" else text)
+        writers.append(rotating)
+    return writers
+
+
+def setup_logging(log_cfg: LogConfig):
+    """Installs the queue handler on the ohrgarten logger tree and starts the writer thread."""
+    global _handler, _listener
+    shutdown_logging()
+
+    root = logging.getLogger(ROOT)
+    root.setLevel(log_cfg.LEVEL)
+    root.removeHandler(_bootstrap)
+
+    _handler = DroppingQueueHandler(queue.Queue(maxsize=log_cfg.QUEUE_SIZE))
+    root.addHandler(_handler)
+    _listener = QueueListener(_handler.queue, *_writers(log_cfg), respect_handler_level=True)
+    _listener.start()
+
+
+def reconfigure(log_cfg: LogConfig):
+    setup_logging(log_cfg)
+
+
+def dropped() -> int:
+    return _handler.dropped if _handler else 0
+
+
+def report_drops():
+    """Logs how many records were lost since the last report (call periodically)."""
+    global _reported_drops
+    lost = dropped() - _reported_drops
+    if lost > 0:
+        _reported_drops += lost
+        get_logger("log").warning("%d log records dropped under backpressure", lost)
+
+
+def shutdown_logging():
+    """Flushes what is queued and stops the writer thread."""
+    global _handler, _listener, _reported_drops
+    if _listener is not None:
+        _listener.stop()
+        for writer in _listener.handlers:
+            writer.close()
+        _listener = None
+    if _handler is not None:
+        logging.getLogger(ROOT).removeHandler(_handler)
+        _handler = None
+        logging.getLogger(ROOT).addHandler(_bootstrap)
+    _reported_drops = 0
+
+
+async def drop_reporter(interval: float = 60.0):
+    while True:
+        await asyncio.sleep(interval)
+        report_drops()
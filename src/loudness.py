@@ -0,0 +1,177 @@
+"""Integrated loudness (BS.1770 style, K-weighted and gated), RMS and peak per recording.
+
+Analysis runs once at ingest and is stored in the recording's sidecar, the
+player turns it into a gain at playback, so files are never rewritten.
+
+Re-analyse a whole archive:
+    python src/loudness.py recordings [--jobs N] [--force]
+"""
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import math
+import os
+import numpy as np
+from scipy.signal import sosfilt
+import segstore
+import sidecar
+
+SIDECAR_KEY = "loudness"
+# 400 ms gating blocks with 75 % overlap, built from 100 ms hops
+HOP_SEC = 0.1
+HOPS_PER_BLOCK = 4
+ABSOLUTE_GATE = -70.0
+RELATIVE_GATE = -10.0
+
+
+def k_weighting_sos(rate: int) -> np.ndarray:
+    """Pre-filter (high shelf) and RLB high-pass of BS.1770 for any sample rate."""
+    # high shelf
+    gain_db = 3.999843853973347
+    f0 = 1681.974450955533
+    q = 0.7071752369554196
+    k = math.tan(math.pi * f0 / rate)
+    vh = 10 ** (gain_db / 20)
+    vb = vh ** 0.4996667741545416
+    a0 = 1 + k / q + k * k
+    shelf = [(vh + vb * k / q + k * k) / a0, 2 * (k * k - vh) / a0, (vh - vb * k / q + k * k) / a0,
+             1.0, 2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0]
+    # high pass
+    f0 = 38.13547087602444
+    q = 0.5003270373238773
+    k = math.tan(math.pi * f0 / rate)
+    a0 = 1 + k / q + k * k
+    highpass = [1.0, -2.0, 1.0, 1.0, 2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0]
+    return np.array([shelf, highpass])
+
+
+def _full_scale(dtype) -> float:
+    if dtype == np.int16:
+        return 32768.0
+    if dtype == np.int32:
+        return 2147483648.0
+    if dtype == np.uint8:
+        return 128.0
+    return 1.0
+
+
+def _db(power: float) -> float:
+    return 10 * math.log10(power) if power > 0 else float("-inf")
+
+
+def analyze(data: np.ndarray, rate: int, chunk_sec: float = 10.0) -> dict:
+    """Loudness of a whole take, processed in fixed chunks so memory stays bounded."""
+    x = data if data.ndim == 2 else data[:, None]
+    channels = x.shape[1]
+    scale = _full_scale(x.dtype)
+    offset = 128.0 if x.dtype == np.uint8 else 0.0
+
+    hop = max(1, int(round(rate * HOP_SEC)))
+    chunk = hop * max(1, int(chunk_sec / HOP_SEC))
+    sos = k_weighting_sos(rate)
+    zi = np.zeros((sos.shape[0], 2, channels))
+
+    hop_power = []
+    peak = 0.0
+    sum_sq = 0.0
+    for start in range(0, len(x), chunk):
+        seg = (x[start:start + chunk].astype(np.float64) - offset) / scale
+        peak = max(peak, float(np.abs(seg).max(initial=0.0)))
+        sum_sq += float(np.einsum("ij,ij->", seg, seg))
+        filtered, zi = sosfilt(sos, seg, axis=0, zi=zi)
+        # channel weights are 1 for mono/stereo
+        power = np.einsum("ij,ij->i", filtered, filtered)
+        whole = len(power) // hop * hop
+        hop_power.append(power[:whole].reshape(-1, hop).sum(axis=1))
+
+    hops = np.concatenate(hop_power) if hop_power else np.zeros(0)
+    if len(hops) >= HOPS_PER_BLOCK:
+        window = np.ones(HOPS_PER_BLOCK)
+        blocks = np.convolve(hops, window, mode="valid") / (HOPS_PER_BLOCK * hop)
+    elif len(hops):
+        # shorter than one gating block, measure it as a whole
+        blocks = np.array([hops.sum() / (len(hops) * hop)])
+    else:
+        blocks = np.zeros(0)
+
+    integrated = float("-inf")
+    with np.errstate(divide="ignore"):
+        block_lufs = -0.691 + 10 * np.log10(blocks)
+    gated = blocks[block_lufs > ABSOLUTE_GATE]
+    if len(gated):
+        relative = -0.691 + _db(float(gated.mean())) + RELATIVE_GATE
+        gated = blocks[(block_lufs > ABSOLUTE_GATE) & (block_lufs > relative)]
+        if len(gated):
+            integrated = -0.691 + _db(float(gated.mean()))
+
+    samples = len(x) * channels
+    return {
+        "integrated_lufs": round(integrated, 2),
+        "rms_dbfs": round(_db(sum_sq / samples), 2) if samples else float("-inf"),
+        "peak_dbfs": round(20 * math.log10(peak), 2) if peak > 0 else float("-inf"),
+        "duration": round(len(x) / rate, 3),
+    }
+
+
+def store(wav_path, info: dict):
+    sidecar.update(wav_path, SIDECAR_KEY, info)
+
+
+def load(wav_path) -> dict | None:
+    return sidecar.read(wav_path).get(SIDECAR_KEY)
+
+
+def playback_gain(info: dict | None, target_lufs: float, max_gain_db: float = 12.0,
+                  ceiling_dbfs: float = -1.0) -> float:
+    """Linear gain that brings a take to target_lufs without pushing its peak over the ceiling."""
+    if not info:
+        return 1.0
+    lufs = info.get("integrated_lufs", float("-inf"))
+    if not math.isfinite(lufs):
+        return 1.0
+    gain_db = min(target_lufs - lufs, max_gain_db)
+    peak = info.get("peak_dbfs", float("-inf"))
+    if math.isfinite(peak):
+        gain_db = min(gain_db, ceiling_dbfs - peak)
+    return 10 ** (gain_db / 20)
+
+
+def analyze_file(wav_path) -> dict:
+    rate, data = segstore.read_wav(wav_path)
+    info = analyze(data, rate)
+    store(wav_path, info)
+    return info
+
+
+def _analyze_job(wav_path):
+    try:
+        return wav_path, analyze_file(wav_path), None
+    except (OSError, ValueError) as err:
+        return wav_path, None, str(err)
+
+
+def reanalyze(rec_path, jobs: int | None = None, force: bool = False) -> int:
+    """Analyses every recording of the archive in a process pool. Returns the number of files done."""
+    wavs = [str(p) for p in segstore.wav_paths(rec_path)]
+    if not force:
+        wavs = [w for w in wavs if load(w) is None]
+    print(f"Analysing {len(wavs)} recordings in {rec_path}...")
+
+    done = 0
+    with ProcessPoolExecutor(max_workers=jobs or os.cpu_count(), initializer=segstore.open_existing,
+                             initargs=(rec_path,)) as pool:
+        for path, info, err in pool.map(_analyze_job, wavs, chunksize=8):
+            if err:
+                print(f"Failed {path}: {err}")
+                continue
+            done += 1
+            print(f"{path}: {info['integrated_lufs']} LUFS, peak {info['peak_dbfs']} dBFS")
+    return done
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="(Re-)analyse loudness of all recordings.")
+    parser.add_argument("recording_path")
+    parser.add_argument("--jobs", type=int, default=None, help="worker processes (default: all cores)")
+    parser.add_argument("--force", action="store_true", help="also re-analyse recordings that already have values")
+    args = parser.parse_args()
+    reanalyze(args.recording_path, args.jobs, args.force)
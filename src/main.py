@@ -6,25 +6,33 @@ from led_manager import LedManager
 from datetime import datetime
 from pathlib import Path
 import asyncio
-import yaml
-from config import Config, ButtonConfig, RecordingConfig, PlayerConfig, LedConfig
+from config import load_config
+from config_reload import ConfigReloader
+from http_api import HttpApi
+from diagnostics import Diagnostics
+from idle import IdleScheduler
+from station import Station
+from upload import Uploader
+from eventlog import EventLog
 import threading
 import sys
+import realtime
+import log
+
+logger = log.get_logger("main")
 
 # Initialize
 
-conf = sys.argv[1]
-if not conf:
-    conf ='config.yaml'
+conf_path = sys.argv[1] if len(sys.argv) > 1 else 'config.yaml'
 
 # load config
-conf:dict = yaml.safe_load(open(conf))
-settings = Config(
-    btn_cfg = ButtonConfig(**conf.get("button_config",{})),
-    rec_cfg = RecordingConfig(**conf.get("recorder_config",{})),
-    ply_cfg = PlayerConfig(**conf.get("player_config", {})),
-    led_cfg = LedConfig(**conf.get("led_config", {}))
-)
+settings = load_config(conf_path)
+
+# Records are queued and written by a background thread, nothing on the hot paths blocks on stdout
+log.setup_logging(settings.log_cfg)
+
+# Opt-in real-time mode, before any component starts a thread: they inherit the affinity
+realtime.setup(settings.rt_cfg)
 
 
 # Initialize Event loop
@@ -34,10 +42,10 @@ asyncio.set_event_loop(event_loop)
 
 
 # Initialize Recorder
-recorder = Recorder(rec_cfg = settings.rec_cfg)
+recorder = Recorder(rec_cfg = settings.rec_cfg, event_loop = event_loop)
 
 # Initialize Player
-player = Player(ply_cfg = settings.ply_cfg)
+player = Player(ply_cfg = settings.ply_cfg, event_loop = event_loop)
 
 # Initialize Buttons
 btn_manager = ButtonManager(button_cfg = settings.btn_cfg,
@@ -46,12 +54,24 @@ btn_manager = ButtonManager(button_cfg = settings.btn_cfg,
 # Initialize Led
 led_manager = LedManager(led_cfg = settings.led_cfg, event_loop = event_loop)
 
+# Initialize the state machine that owns the interaction lifecycle
+station = Station(event_loop = event_loop)
+
+# Initialize optional upload of confirmed takes (only sends if enabled)
+uploader = Uploader(upload_cfg = settings.upload_cfg, rec_path = settings.rec_cfg.RECORDING_PATH, event_loop = event_loop)
+
+# Initialize optional interaction event log (only writes if enabled)
+events = EventLog(events_cfg = settings.events_cfg)
+
 class CmdRegistry:
     def __init__(self,
                  recorder: Recorder,
                  player:   Player,
                  buttons:  ButtonManager,
-                 led: LedManager):
+                 led: LedManager,
+                 station: Station,
+                 uploader: Uploader,
+                 events: EventLog):
         # self.button_await_confirm = buttons.button_await_confirm
         
         # self.get_current_recording = recorder.get_current_recording
@@ -81,20 +101,51 @@ class CmdRegistry:
         self.button = buttons
         self.player = player
         self.led = led
+        self.station = station
+        self.uploader = uploader
+        self.events = events
 
         recorder.inject_cmd(self) # type: ignore
         player.inject_cmd(self) # type: ignore
         buttons.inject_cmd(self) # type: ignore
         led.inject_cmd(self) #type: ignore
+        station.inject_cmd(self) #type: ignore
+        uploader.inject_cmd(self) #type: ignore
 
 
 # Initialize Command container allowing cross instance access of selected methods without importing whole classes
-cmd = CmdRegistry(recorder, player, btn_manager, led_manager)
+cmd = CmdRegistry(recorder, player, btn_manager, led_manager, station, uploader, events)
+
+# Initialize optional archive API (only listens if enabled)
+http_api = HttpApi(http_cfg = settings.http_cfg, rec_path = settings.rec_cfg.RECORDING_PATH, event_loop = event_loop)
+http_api.inject_cmd(cmd) # type: ignore
+
+# Initialize optional runtime diagnostics (loop lag, blocking detector, SIGUSR1 profile)
+diagnostics = Diagnostics(diag_cfg = settings.diag_cfg, event_loop = event_loop)
+
+# Initialize optional idle mode (longer gaps, sleep outside opening hours, wakes on any button press)
+idle = IdleScheduler(idle_cfg = settings.idle_cfg, event_loop = event_loop)
+idle.inject_cmd(cmd) # type: ignore
+btn_manager.on_activity = idle.activity
+
+# Reload the yaml on SIGHUP or when the file changes, only the components whose section changed are touched
+reloader = ConfigReloader(conf_path, settings, event_loop)
+reloader.register("btn_cfg", btn_manager.reconfigure)
+reloader.register("rec_cfg", recorder.reconfigure)
+reloader.register("ply_cfg", player.reconfigure)
+reloader.register("led_cfg", led_manager.reconfigure)
+reloader.register("http_cfg", http_api.reconfigure)
+reloader.register("log_cfg", log.reconfigure)
+reloader.register("diag_cfg", diagnostics.reconfigure)
+reloader.register("idle_cfg", idle.reconfigure)
+reloader.register("upload_cfg", uploader.reconfigure)
+reloader.register("rt_cfg", realtime.reconfigure)
+reloader.register("events_cfg", events.reconfigure)
 
 # --- Main loop ---
-print(f"Press and hold button to record.")
-print(f"Recordings will be saved in: {settings.rec_cfg.RECORDING_PATH}")
-print("Press Ctrl+C to exit.")
+logger.info("Press and hold button to record.")
+logger.info("Recordings will be saved in: %s", settings.rec_cfg.RECORDING_PATH)
+logger.info("Press Ctrl+C to exit.")
 
 
 
@@ -107,7 +158,16 @@ print("Press Ctrl+C to exit.")
 if __name__ == "__main__":
 
 
-    threading.Thread(target=player.play_forever, daemon=True).start()
+    events.start()
+    threading.Thread(target=player.play_forever, name="player", daemon=True).start()
+    station.start()
+    event_loop.create_task(http_api.start())
+    event_loop.create_task(uploader.start())
+    reloader.start()
+    event_loop.create_task(log.drop_reporter())
+    event_loop.create_task(realtime.xrun_reporter())
+    diagnostics.start()
+    idle.start()
 
     try:
         # Keep the script running to listen for button events
@@ -115,19 +175,32 @@ if __name__ == "__main__":
 
         event_loop.run_forever()
     except KeyboardInterrupt:
-        print("\nCtrl+C detected. Exiting...")
+        logger.info("Ctrl+C detected. Exiting...")
     finally:
         # Stop and terminate player loop
         player.stop()
+        station.stop()
+        events.stop()
+        reloader.stop()
+        idle.stop()
+        diagnostics.stop()
+        event_loop.run_until_complete(http_api.close())
+        event_loop.run_until_complete(uploader.close())
+        if player.mixer is not None:
+            event_loop.run_until_complete(player.mixer.close())
         led_manager.shutdown_neopixel()
         # Ensure recording stops if the script exits while recording
         if (proc := recorder.get_rec_process()) is not None and proc.poll() is None:
-            print("Cleaning up active recording process...")
-            recorder.stop_recording()
+            logger.info("Cleaning up active recording process...")
+            event_loop.run_until_complete(proc.stop())
+        if recorder.preroll is not None:
+            event_loop.run_until_complete(recorder.preroll.close())
+        recorder.close_fingerprints()
 
         import gc
         gc.collect()
-        print("Script finished.")
+        logger.info("Script finished.")
+        log.shutdown_logging()
 
 
 
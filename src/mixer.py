@@ -0,0 +1,339 @@
+from proc_supervisor import SupervisedProcess
+from collections import OrderedDict
+import asyncio
+import fcntl
+import threading
+import numpy as np
+from scipy.signal import resample_poly
+from wavio import PcmBuffer
+import realtime
+import segstore
+import log
+
+logger = log.get_logger("mixer")
+
+# linux only, exported by the fcntl module since python 3.10
+F_SETPIPE_SZ = getattr(fcntl, "F_SETPIPE_SZ", 1031)
+
+
+def _approach(current: float, target: float, max_step: float) -> float:
+    if target > current:
+        return min(target, current + max_step)
+    return max(target, current - max_step)
+
+
+class Voice:
+    """One sound inside the mixer with its own gain envelope.
+
+    Mirrors the parts of SupervisedProcess the player uses (poll, exited,
+    terminate), so a voice can stand in for an aplay process.
+    """
+
+    def __init__(self, data: np.ndarray, gain: float = 1.0, prompt: bool = False,
+                 fade_frames: int = 441, duck_frames: int = 4410, name: str = ""):
+        # int16 frames x channels, usually a read-only memory map of the wav file
+        self.data = data
+        self.name = name
+        self.pos = 0
+        self.gain = gain
+        # prompts duck every non-prompt voice while they play
+        self.prompt = prompt
+        self._fade = 0.0
+        self._fade_target = 1.0
+        self._fade_step = 1.0 / fade_frames
+        self._duck = 1.0
+        self._duck_step = 1.0 / duck_frames
+        self.exited = threading.Event()
+        if len(data) == 0:
+            self.exited.set()
+
+    def poll(self) -> int | None:
+        return 0 if self.exited.is_set() else None
+
+    def stop(self):
+        """Fades the voice out, it is dropped once silent."""
+        self._fade_target = 0.0
+
+    # same call signature as SupervisedProcess.terminate
+    def terminate(self, timeout: float | None = None):
+        self.stop()
+
+    def render(self, out: np.ndarray, duck_target: float):
+        """Adds the next len(out) frames of this voice into out (float32, int16 scale)."""
+        n = min(len(out), len(self.data) - self.pos)
+        if n <= 0:
+            self.exited.set()
+            return
+
+        fade_end = _approach(self._fade, self._fade_target, self._fade_step * n)
+        duck_end = _approach(self._duck, duck_target, self._duck_step * n)
+        ramp = np.arange(n, dtype=np.float32) / n
+        env = (self._fade + (fade_end - self._fade) * ramp) * (self._duck + (duck_end - self._duck) * ramp)
+        env *= self.gain
+        out[:n] += self.data[self.pos:self.pos + n] * env[:, None]
+
+        self.pos += n
+        self._fade = fade_end
+        self._duck = duck_end
+        if self.pos >= len(self.data) or (self._fade_target == 0 and self._fade == 0):
+            self.exited.set()
+
+
+def mix_period(voices: list, frames: int, channels: int, duck_gain: float,
+               out: np.ndarray | None = None, block: np.ndarray | None = None) -> np.ndarray:
+    """Renders one period of all voices into interleaved int16.
+
+    out (float32) and block (int16), frames x channels, are reused when given.
+    """
+    if out is None:
+        out = np.zeros((frames, channels), dtype=np.float32)
+    else:
+        out.fill(0)
+    ducking = any(v.prompt for v in voices)
+    for voice in voices:
+        voice.render(out, duck_gain if ducking and not voice.prompt else 1.0)
+    np.clip(out, -32768, 32767, out=out)
+    if block is None:
+        return out.astype(np.int16)
+    np.copyto(block, out, casting="unsafe")
+    return block
+
+
+class Mixer:
+    """Real-time software mixer feeding one persistent aplay through stdin.
+
+    Rotation clips, sfx and prompts are voices that play at the same time.
+    Prompt voices duck the rotation instead of interrupting it. Mixing runs
+    per period on the event loop and is paced by the aplay pipe.
+    """
+
+    def __init__(self, aplay_cmd: list, event_loop: asyncio.AbstractEventLoop,
+                 rate: int = 44100, channels: int = 2, duck_gain: float = 0.25,
+                 period_frames: int = 1024, buffer_us: int = 100000,
+                 cache_bytes: int = 64 * 1024 * 1024):
+        self.aplay_cmd = list(aplay_cmd)
+        self.event_loop = event_loop
+        self.rate = rate
+        self.channels = channels
+        self.duck_gain = duck_gain
+        self.period_frames = period_frames
+        self.period_bytes = period_frames * channels * 2
+        self.buffer_us = buffer_us
+        self.cache_bytes = cache_bytes
+
+        # mixed into in place every period, locked in real-time mode
+        self._mix = np.zeros((period_frames, channels), dtype=np.float32)
+        self._block = np.zeros((period_frames, channels), dtype=np.int16)
+        realtime.lock(self._mix)
+        realtime.lock(self._block)
+
+        self._voices: list[Voice] = []
+        self._voices_lock = threading.Lock()
+        self._cache: OrderedDict[str, np.ndarray] = OrderedDict()
+        self._cache_lock = threading.Lock()
+        # the one in-memory take being replayed, converted once
+        self._prepared: tuple[PcmBuffer, np.ndarray] | None = None
+        self.sink: SupervisedProcess | None = None
+        self._closing = False
+        # cleared by suspend(), the output device is then closed until the next voice or resume()
+        self._awake = asyncio.Event()
+        self._awake.set()
+        self._task: asyncio.Task | None = None
+
+    def sink_cmd(self) -> list:
+        cmd = self.aplay_cmd + ["-t", "raw", "-f", "S16_LE", "-r", str(self.rate), "-c", str(self.channels)]
+        if "-B" not in cmd and "--buffer-time" not in cmd:
+            # keep prompt latency low, the pipe is the only other buffer
+            cmd += ["-B", str(self.buffer_us)]
+        return cmd + ["-"]
+
+    # --- clip loading ---
+
+    def _convert(self, rate: int, data: np.ndarray) -> np.ndarray:
+        if data.dtype == np.uint8:
+            data = ((data.astype(np.int16) - 128) << 8)
+        elif data.dtype == np.int32:
+            data = (data >> 16).astype(np.int16)
+        elif data.dtype.kind == "f":
+            data = np.clip(data * 32767, -32768, 32767).astype(np.int16)
+
+        if data.ndim == 1:
+            data = data[:, None]
+        if data.shape[1] > self.channels:
+            data = data[:, :self.channels]
+        elif data.shape[1] != self.channels:
+            mono = data.mean(axis=1, keepdims=True).astype(np.int16) if data.shape[1] > 1 else data
+            # broadcasting keeps a memory mapped mono file zero-copy
+            data = np.broadcast_to(mono, (len(mono), self.channels))
+
+        if rate != self.rate:
+            data = resample_poly(data, self.rate, rate, axis=0)
+            data = np.clip(data, -32768, 32767).astype(np.int16)
+        return data
+
+    def load(self, path) -> np.ndarray:
+        """Returns the clip as int16 frames x channels, memory mapped where possible."""
+        key = str(path)
+        with self._cache_lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+
+        rate, data = segstore.read_wav(key)
+        data = self._convert(rate, data)
+
+        # read in now and kept resident, a clip never waits for the sd card while it plays
+        realtime.lock(data)
+        with self._cache_lock:
+            self._cache[key] = data
+            total = sum(d.nbytes for d in self._cache.values())
+            while total > self.cache_bytes and len(self._cache) > 1:
+                _, dropped = self._cache.popitem(last=False)
+                realtime.unlock(dropped)
+                total -= dropped.nbytes
+        return data
+
+    def preload(self, paths: list):
+        for path in paths:
+            try:
+                self.load(path)
+            except (OSError, ValueError) as err:
+                logger.warning("Could not preload %s: %s", path, err)
+
+    def forget(self, path):
+        with self._cache_lock:
+            dropped = self._cache.pop(str(path), None)
+        if dropped is not None:
+            realtime.unlock(dropped)
+
+    def clear_cache(self):
+        with self._cache_lock:
+            for dropped in self._cache.values():
+                realtime.unlock(dropped)
+            self._cache.clear()
+            self._prepared = None
+
+    def prepare(self, take: PcmBuffer) -> np.ndarray:
+        """Converts an in-memory take, repeated replays of the same buffer reuse the result."""
+        with self._cache_lock:
+            if self._prepared is not None and self._prepared[0] is take:
+                return self._prepared[1]
+        data = self._convert(take.rate, take.data)
+        with self._cache_lock:
+            self._prepared = (take, data)
+        return data
+
+    # --- voices ---
+
+    def play(self, source, gain: float = 1.0, prompt: bool = False) -> Voice:
+        """Starts a voice from a wav path, an in-memory take or an int16 array. Safe to call from any thread."""
+        if isinstance(source, PcmBuffer):
+            data, name = self.prepare(source), source.name
+        elif isinstance(source, np.ndarray):
+            data, name = source, "<buffer>"
+        else:
+            name = str(source)
+            try:
+                data = self.load(source)
+            except (OSError, ValueError) as err:
+                logger.error("Error loading %s for playback: %s", source, err)
+                data = np.zeros((0, self.channels), dtype=np.int16)
+        voice = Voice(data, gain=gain, prompt=prompt,
+                      fade_frames=self.rate // 100, duck_frames=self.rate // 10, name=name)
+        with self._voices_lock:
+            self._voices.append(voice)
+        if not self._awake.is_set():
+            self.resume()
+        return voice
+
+    def active_voices(self) -> int:
+        with self._voices_lock:
+            return len(self._voices)
+
+    def render_period(self) -> bytes:
+        with self._voices_lock:
+            voices = list(self._voices)
+        block = mix_period(voices, self.period_frames, self.channels, self.duck_gain, self._mix, self._block)
+        if any(v.exited.is_set() for v in voices):
+            with self._voices_lock:
+                self._voices = [v for v in self._voices if not v.exited.is_set()]
+        return block.tobytes()
+
+    # --- output ---
+
+    # event loop only
+    def suspend(self):
+        self._awake.clear()
+        self.clear_cache()
+
+    # any thread
+    def resume(self):
+        self.event_loop.call_soon_threadsafe(self._awake.set)
+
+    def start(self) -> asyncio.Task:
+        self._task = self.event_loop.create_task(self._run())
+        return self._task
+
+    def _shrink_pipe(self, sink: SupervisedProcess):
+        # the default 64 KiB pipe would add ~370 ms of latency to every prompt
+        try:
+            pipe = sink.process.stdin.transport.get_extra_info("pipe")
+            fcntl.fcntl(pipe.fileno(), F_SETPIPE_SZ, max(4096, 2 * self.period_bytes))
+        except (OSError, AttributeError):
+            pass
+
+    async def _drop_for(self, seconds: float):
+        # without a sink, voices still advance in real time so the player never hangs
+        period = self.period_frames / self.rate
+        for _ in range(max(1, int(seconds / period))):
+            self.render_period()
+            await asyncio.sleep(period)
+
+    async def _run(self):
+        backoff = 0.5
+        while not self._closing:
+            if not self._awake.is_set():
+                logger.info("Mixer output suspended")
+                await self._awake.wait()
+                continue
+            sink = SupervisedProcess(self.sink_cmd(), self.event_loop, stdin=True, realtime=True)
+            try:
+                pid = await sink.start()
+            except Exception as err:
+                logger.error("Error starting mixer output: %s", err)
+                await self._drop_for(backoff)
+                backoff = min(backoff * 2, 10)
+                continue
+            logger.info("Mixer output running (PID: %d)", pid)
+            self.sink = sink
+            backoff = 0.5
+            self._shrink_pipe(sink)
+            writer = sink.process.stdin
+            writer.transport.set_write_buffer_limits(high=self.period_bytes)
+
+            try:
+                while not self._closing and self._awake.is_set() and sink.poll() is None:
+                    writer.write(self.render_period())
+                    await writer.drain()
+            except (BrokenPipeError, ConnectionResetError) as err:
+                if not self._closing:
+                    logger.error("Mixer output lost: %s", err)
+
+            await sink.stop()
+            self.sink = None
+            if not self._closing and self._awake.is_set():
+                logger.error("Mixer output exited: %s", sink.stderr_text())
+                await self._drop_for(backoff)
+
+    async def close(self):
+        self._closing = True
+        self._awake.set()
+        if self.sink is not None:
+            await self.sink.stop()
+        if self._task is not None:
+            await asyncio.gather(self._task, return_exceptions=True)
+        # nobody renders them anymore, release whoever waits on them
+        with self._voices_lock:
+            for voice in self._voices:
+                voice.exited.set()
+            self._voices.clear()
@@ -1,51 +1,149 @@
 from config import PlayerConfig
+from proc_supervisor import SupervisedProcess
+from mixer import Mixer, Voice
+from wavio import PcmBuffer
+from rotation_state import RotationState
+from concurrent.futures import Future, ThreadPoolExecutor
+import timestretch
+import segstore
+import eventlog
+from fingerprint import SIDECAR_KEY as DUPLICATE_KEY
+import loudness
+import sidecar
 from pathlib import Path
 import os
 from datetime import datetime
-import time, signal, subprocess, os
+import time, os
 import threading
+import asyncio
 from typing import TYPE_CHECKING
+import log
+
+logger = log.get_logger("player")
 
 if TYPE_CHECKING:
     from cmd_typing import CmdTyping
 
 # every 7th playback is the original creators question defined by ply_cfg.QUESTION
 nth_question_repeat = 7
+STATE_FILE = ".rotation.jsonl"
 
 class Player:
 
-    def __init__(self, ply_cfg: PlayerConfig):
+    def __init__(self, ply_cfg: PlayerConfig, event_loop):
+        self.ply_cfg = ply_cfg
         self.APLAY_CMD = ply_cfg.APLAY_CMD
+        self.event_loop: asyncio.AbstractEventLoop = event_loop
         self.buffer: list
         self._idx = 0
+        self.question_counter = 0
+        # position, question cadence and play history across restarts
+        self.state: RotationState | None = None
+        # turns each demoted repeat has had, it plays on every DEMOTE_EVERY-th
+        self._demoted_turns: dict[str, int] = {}
+        # time compression, prepared one clip ahead: (filename, speed, job)
+        self._stretch_pool: ThreadPoolExecutor | None = None
+        self._stretched: tuple[str, float, Future] | None = None
         self._stop_event  = threading.Event()
+        # the rotation's gate, only the station closes and opens it
         self._pause_event = threading.Event()
         self._pause_event.set()
+        # set by skip(), tells the rotation not to advance the index a second time
         self._skip_event = threading.Event()
+        # the clip the rotation is playing, pause() and skip() end it directly
+        self._current: SupervisedProcess | Voice | None = None
+        # ends the gap between two clips early (skip, wake up)
+        self._gap_event = threading.Event()
+        # cleared while the idle scheduler has put the rotation to sleep
+        self._awake_event = threading.Event()
+        self._awake_event.set()
+        self.gap = ply_cfg.GAP_SEC
+        self.idle_gap: float | None = None
         self._lock = threading.Lock()
         #self.playing_proc: subprocess.Popen | None = None
-        self.confirmation_phase = False
+        # one stop event per confirmation run, a new run never revives the old thread
         self._stop_confirmation = threading.Event()
+        # closed while a confirm / delete prompt has the speaker
+        self._confirm_gate = threading.Event()
+        self._confirm_gate.set()
+        self._confirm_current: SupervisedProcess | Voice | None = None
         self.question = ply_cfg.VOICE_PATH + '/' + ply_cfg.QUESTION 
+        self.target_lufs = ply_cfg.TARGET_LUFS
+
+        # optional in-process mixer, prompts are then layered over the rotation instead of interrupting it
+        self.mixer: Mixer | None = self._make_mixer(ply_cfg)
+
+    def _make_mixer(self, ply_cfg: PlayerConfig) -> Mixer | None:
+        if not ply_cfg.MIXER:
+            return None
+        mixer = Mixer(ply_cfg.APLAY_CMD, self.event_loop,
+                      rate = ply_cfg.MIXER_RATE,
+                      channels = ply_cfg.MIXER_CHANNELS,
+                      duck_gain = ply_cfg.DUCK_GAIN)
+        mixer.preload(['sfx/rising.wav', 'sfx/delete.wav', 'voice/save.wav', self.question])
+        mixer.start()
+        return mixer
+
+    # hot reload: buffer, position and clip cache survive unless the output itself changes
+    async def reconfigure(self, ply_cfg: PlayerConfig):
+        old = self.ply_cfg
+        self.ply_cfg = ply_cfg
+        self.APLAY_CMD = ply_cfg.APLAY_CMD
+        self.question = ply_cfg.VOICE_PATH + '/' + ply_cfg.QUESTION
+        self.target_lufs = ply_cfg.TARGET_LUFS
+        self.gap = ply_cfg.GAP_SEC
+
+        output = ("MIXER", "MIXER_RATE", "MIXER_CHANNELS", "APLAY_CMD")
+        if any(getattr(old, name) != getattr(ply_cfg, name) for name in output):
+            if self.mixer is not None:
+                await self.mixer.close()
+            self.mixer = self._make_mixer(ply_cfg)
+        elif self.mixer is not None:
+            self.mixer.duck_gain = ply_cfg.DUCK_GAIN
+            self.mixer.preload([self.question])
+
+    def replace_buffer(self, recordings: list):
+        with self._lock:
+            self.buffer[:] = recordings
+            self._idx = 0
 
+    def copy_buffer(self) -> list:
+        # the buffer is shared with the recorder and changed from executor threads too
+        with self._lock:
+            return list(self.buffer)
 
 
     def inject_cmd(self, cmd:"CmdTyping"):
         self.cmd = cmd
         # start any cmd that are now possible as initialization step
         self.buffer = self.cmd.recorder.get_rec_buffer()
+        self.state = self._restore_state()
+
+    def _restore_state(self) -> RotationState:
+        """Continues the rotation where the last run left it."""
+        path = self.ply_cfg.STATE_PATH or os.path.join(self.cmd.recorder.rec_path, STATE_FILE)
+        state = RotationState(path)
+        if state.load():
+            self._idx = state.position(self.buffer)
+            self.question_counter = state.question_counter
+            logger.info("Rotation continues at %d of %d", self._idx + 1, len(self.buffer))
+        return state
 
 
     # extending recording buffer moved here to simplify threading lock mechanism without needing to expose the _lock to cmd
     def extend_buffer(self, recording=None):
         if not recording:
             recording = self.cmd.recorder.get_current_recording()
+        # the reset button may have wiped the take while it was being confirmed
+        if not segstore.exists(recording):
+            logger.warning("Not adding %s, file is gone", recording)
+            return
         with self._lock:
             insert_pos = (self._idx + 1) % (len(self.buffer) + 1)
             self.buffer.insert(insert_pos, recording)
 
     # plays sound until finished 
-    # useful for short sfx
+    # useful for short sfx, blocks the calling thread (never call from the event loop)
     def play_sound(self, filename):
         timeout = 20
         # only for beep sound usecase
@@ -54,104 +152,152 @@ class Player:
         #     self.playing_proc.terminate()
         # time.sleep(0.1)
 
-        print(f"Playing {filename}...")
-        try:
-            # Run aplay and wait for it to complete. Capture output to hide it unless error.
-            cmd = self.APLAY_CMD + [filename]
-            subprocess.run(cmd, check=True, capture_output=True, timeout=timeout) # Check=True raises error on fail
-            print("Play Finished.")
-        except FileNotFoundError:
-            print("Error: 'aplay' command not found. Is alsa-utils installed?")
-        except subprocess.CalledProcessError as e:
-            print(f"Error playing beep using aplay: {e}")
-            print(f"Stderr: {e.stderr.decode('utf-8', errors='ignore')}")
-        except subprocess.TimeoutExpired:
-            print(f"Recording reached {timeout} sec timeout.")
-        except Exception as e:
-            print(f"An unexpected error occurred during beep playback: {e}")
-
-    # plays soun
-    def _play_sound_non_blocking(self, filename) -> subprocess.Popen:
+        logger.debug("Playing %s...", filename)
+        if self.mixer is not None:
+            if not self.mixer.play(filename, prompt=True).exited.wait(timeout):
+                logger.warning("Playback reached %d sec timeout.", timeout)
+            return
+        cmd = self.APLAY_CMD + [filename]
+        proc = SupervisedProcess(cmd, self.event_loop, realtime=True).launch()
+        code = proc.wait_threadsafe(timeout=timeout)
+        if code is None:
+            logger.warning("Playback reached %d sec timeout.", timeout)
+            self.terminate_current_playback(proc)
+        elif code != 0 and proc.start_error is None:
+            logger.error("Error playing %s using aplay (exit code %s)", filename, code)
+            logger.error("Stderr: %s", proc.stderr_text())
+        else:
+            logger.debug("Play Finished.")
+
+    # starts playback on the event loop and returns immediately
+    def _play_sound_non_blocking(self, filename, prompt=False) -> SupervisedProcess | Voice:
             # start playback
-        print(f"Playing recording at index {self._idx}")
-        proc = subprocess.Popen(
-            self.APLAY_CMD + [filename],
-            stdout=subprocess.DEVNULL,
-            stderr=subprocess.DEVNULL
-        )
-        return proc
+        logger.debug("Playing %s at index %d", filename, self._idx)
+        if self.mixer is not None:
+            name = filename.name if isinstance(filename, PcmBuffer) else filename
+            return self.mixer.play(filename, gain=self._gain_for(name), prompt=prompt)
+        if isinstance(filename, PcmBuffer):
+            # in-memory take: streamed into aplay's stdin, nothing is read from disk
+            proc = SupervisedProcess(self.APLAY_CMD + ["-"], self.event_loop,
+                                     term_timeout=1, kill_timeout=1, stdin=True, realtime=True)
+            return proc.launch(feed=filename.wav_stream())
+        if segstore.packed(filename) is not None:
+            # aplay cannot open a slice of a segment, the mapped samples go through its stdin
+            return self._play_sound_non_blocking(segstore.read_clip(filename), prompt)
+        proc = SupervisedProcess(self.APLAY_CMD + [filename], self.event_loop,
+                                 term_timeout=1, kill_timeout=1, realtime=True)
+        return proc.launch()
     
 
-    def terminate_current_playback(self, proc: subprocess.Popen):
+    # normalization gain from the loudness measured at ingest, the file itself is never touched
+    def _gain_for(self, filename) -> float:
+        if self.target_lufs is None:
+            return 1.0
+        return loudness.playback_gain(loudness.load(filename), self.target_lufs)
+
+    # from a player thread this waits until the device is free again,
+    # on the event loop it only schedules the termination
+    def terminate_current_playback(self, proc: SupervisedProcess | Voice):
         if proc and proc.poll() is None:
-            try:
-                proc.terminate()
-                proc.wait(timeout=1)
-            except Exception as err:
-                print(f"Error during terminating playback: {str(err)}")
+            proc.terminate(timeout=2)
 
+    # holds the rotation and ends the clip it is playing
     def pause(self):
-        # terminate currently playing process
-        #self.skip_player()
-        #self._terminate_current_playback()
-        # pauses playback loop
         self._pause_event.clear()
-        print(f"pause player")
+        self.terminate_current_playback(self._current)
+        logger.debug("pause player")
 
     # unpauses playback loop
     def resume(self):
-        #! experimental
-        #self.terminate_current_playback()
         self._pause_event.set()
-        print(f"resume player")
+        logger.debug("resume player")
 
     # completely kills the loop and thus the thread
     def stop(self):
-        self.pause()
+        self._pause_event.clear()
         self._stop_event.set()
-        print(f"terminating playback")
+        if self.state is not None:
+            self.state.close()
+        if self._stretch_pool is not None:
+            self._stretch_pool.shutdown(wait=False, cancel_futures=True)
+        logger.info("terminating playback")
+
+    # silences the confirmation loop while a prompt plays, it continues on release_confirmation()
+    def hold_confirmation(self):
+        self._confirm_gate.clear()
+        self.terminate_current_playback(self._confirm_current)
 
-    def stop_confirmation_loop(self):
-        self.pause()
+    def release_confirmation(self):
+        self._confirm_gate.set()
+
+    def stop_confirmation(self):
         self._stop_confirmation.set()
-        print(f"terminating confirmation")
+        self._confirm_gate.set()
+        self.terminate_current_playback(self._confirm_current)
+        logger.debug("terminating confirmation")
+
+    # idle mode: longer gaps between clips (None = GAP_SEC)
+    def set_idle_gap(self, seconds: float | None):
+        self.idle_gap = seconds
+        self._gap_event.set()
+
+    # idle mode: stop the rotation after the current clip and release the output and clip cache
+    def sleep(self):
+        self._awake_event.clear()
+        if self.mixer is not None:
+            self.mixer.suspend()
+        logger.info("Rotation asleep")
+
+    # safe from any thread, the next clip starts without waiting out the gap
+    def wake(self):
+        if self._awake_event.is_set():
+            return
+        if self.mixer is not None:
+            self.mixer.resume()
+        self._awake_event.set()
+        self._gap_event.set()
+        logger.info("Rotation awake")
 
     # terminate currently playing process, thus skipping to next loop
     def skip(self):
-        if self.confirmation_phase:
-            return
         with self._lock:
             self._skip_event.set()
-            self._idx = (self._idx + 1) % len(self.buffer)
-
-        #self._terminate_current_playback()
-
-        print("invoke button skip")
-
-    def playback_hold_confirm(self):
-        self.pause()
-        time.sleep(0.2)
-        print("Playing sfx/rising.wav")
+            self._gap_event.set()
+            self._idx = (self._idx + 1) % max(1, len(self.buffer))
+        self.terminate_current_playback(self._current)
+        logger.debug("invoke button skip")
+
+    async def playback_hold_confirm(self):
+        if self.mixer is not None:
+            # ducks the confirmation loop instead of stopping it
+            return self._play_sound_non_blocking('sfx/rising.wav', prompt=True)
+        self.hold_confirmation()
+        # give the loop time to release the sound card
+        await asyncio.sleep(0.2)
+        logger.debug("Playing sfx/rising.wav")
         proc = self._play_sound_non_blocking('sfx/rising.wav')
 
         return proc
     
-    def playback_delete(self):
-        self.pause()
-        time.sleep(0.2)
-        print("Playing sfx/delete.wav")
+    async def playback_delete(self):
+        if self.mixer is not None:
+            return self._play_sound_non_blocking('sfx/delete.wav', prompt=True)
+        self.hold_confirmation()
+        await asyncio.sleep(0.2)
+        logger.debug("Playing sfx/delete.wav")
         proc = self._play_sound_non_blocking('sfx/delete.wav')
 
         return proc
     
-    # loop confirmation after recording
-    def _loop_recording_and_instruction(self, filename):
-        print("Loop confirmation phase")
-        loop_buffer = [filename, 'voice/save.wav']
+    # loop confirmation after recording, until the station stops it
+    def _loop_recording_and_instruction(self, filename, take: PcmBuffer | None, stop: threading.Event):
+        logger.info("Loop confirmation phase")
+        loop_buffer = [take if take is not None else filename, 'voice/save.wav']
         index = 0
-        self.resume()
-        while not self._stop_confirmation.is_set():
-            self._pause_event.wait()
+        while not stop.is_set():
+            self._confirm_gate.wait()
+            if stop.is_set():
+                break
             file = loop_buffer[index]
             if index:
                 self.cmd.led.instruction_led_on()
@@ -159,55 +305,116 @@ class Player:
                 self.cmd.led.replay_led_on()
 
             proc = self._play_sound_non_blocking(file)
-
-            while True:
-
-                if proc is None or proc.poll() is not None:
-                    break
-
-                if not self._pause_event.is_set() or self._stop_confirmation.is_set():
-                    self.terminate_current_playback(proc)
-                    break
-                time.sleep(.1)
-
+            self._confirm_current = proc
+            # hold and stop end the clip themselves, unless they came before it was visible here
+            if stop.is_set() or not self._confirm_gate.is_set():
+                self.terminate_current_playback(proc)
+            proc.exited.wait()
+            self._confirm_current = None
 
             index = (index + 1) % 2
             self.cmd.led.led_off()
-            for _ in range(10):
-                if self._stop_confirmation.is_set():
-                    break
-                time.sleep(0.1)
-
-        self._stop_confirmation.clear()
-        self.confirmation_phase = False
-        self.cmd.button.button_await_confirm(False)
+            stop.wait(1.0)
 
-    def start_confirmation(self, filename):
-
-        if self.confirmation_phase:
-            return
-
-        self.confirmation_phase = True
-        thread = threading.Thread(target=self._loop_recording_and_instruction, args = (filename,), daemon= True)
+    def start_confirmation(self, filename, take: PcmBuffer | None = None) -> threading.Thread:
+        self._stop_confirmation = threading.Event()
+        self._confirm_gate.set()
+        thread = threading.Thread(target=self._loop_recording_and_instruction,
+                                  args=(filename, take, self._stop_confirmation), name="confirmation", daemon=True)
         thread.start()
         return thread
-        #self._loop_recording_and_instruction(filename)
 
     
+    # while the clip plays: where a restart continues, after a recording the next one, after the question the same
+    def _remember(self, filename):
+        if self.state is None:
+            return
+        question = filename == self.question
+        with self._lock:
+            next_idx = self._idx if question else (self._idx + 1) % max(1, len(self.buffer))
+            next_name = Path(self.buffer[next_idx]).name if self.buffer else None
+        self.state.played(None if question else Path(filename).name, next_name, next_idx,
+                          self.question_counter + 1)
+
+    # a repeat flagged "demoted" at ingest only plays on every DEMOTE_EVERY-th turn
+    def _sits_out(self, filename) -> bool:
+        if not sidecar.read(filename).get(DUPLICATE_KEY, {}).get("demoted"):
+            return False
+        name = Path(filename).name
+        turn = self._demoted_turns.get(name, 0) + 1
+        self._demoted_turns[name] = turn
+        return self.ply_cfg.DEMOTE_EVERY > 1 and turn % self.ply_cfg.DEMOTE_EVERY != 0
+
+    # faster while many clips of the current cycle are still to come after the one at position,
+    # 1.0 when time compression is off
+    def _speed(self, position: int) -> float:
+        if not self.ply_cfg.TIME_STRETCH:
+            return 1.0
+        waiting = len(self.buffer) - 1 - position
+        return timestretch.speed_for(waiting, self.ply_cfg.MAX_SPEED,
+                                     self.ply_cfg.STRETCH_FROM_CLIPS, self.ply_cfg.STRETCH_FULL_CLIPS)
+
+    def _stretch_clip(self, filename, speed: float) -> PcmBuffer | None:
+        try:
+            rate, data = segstore.read_wav(filename)
+        except (OSError, ValueError) as err:
+            logger.warning("Could not read %s for time compression: %s", filename, err)
+            return None
+        started = time.perf_counter()
+        stretched = timestretch.stretch(data, speed, rate)
+        logger.debug("Compressed %s x%.2f in %.0f ms", filename, speed, (time.perf_counter() - started) * 1000)
+        return PcmBuffer(str(filename), rate, stretched)
+
+    # starts compressing a clip in the background, the one after the clip that just started
+    def _prepare_stretch(self, filename, position: int):
+        if filename is None or filename == self.question:
+            return
+        speed = self._speed(position)
+        if speed <= 1.0:
+            self._stretched = None
+            return
+        if self._stretched is not None and self._stretched[:2] == (str(filename), speed):
+            return
+        if self._stretch_pool is None:
+            self._stretch_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="stretch")
+        self._stretched = (str(filename), speed, self._stretch_pool.submit(self._stretch_clip, filename, speed))
+
+    # what the rotation plays for filename: its compressed version when one is due
+    def _clip_for(self, filename, position: int):
+        if filename == self.question:
+            return filename
+        self._prepare_stretch(filename, position)
+        if self._stretched is None:
+            return filename
+        try:
+            return self._stretched[2].result() or filename
+        except (ValueError, MemoryError) as err:
+            logger.error("Time compression of %s failed, playing it as recorded: %s", filename, err)
+            return filename
+
+    # how the clip ended: skipped, paused for a take, or played out
+    def _log_clip_end(self, filename, seconds: float):
+        if self._skip_event.is_set():
+            kind = eventlog.SKIPPED
+        elif not self._pause_event.is_set() or self._stop_event.is_set():
+            kind = eventlog.INTERRUPTED
+        else:
+            kind = eventlog.PLAYED
+        self.cmd.events.record(kind, filename, seconds)
+
     def play_forever(self):
-        question_counter = 0
         while not self._stop_event.is_set():
 
-            for _ in range(10):
-                if self._skip_event.is_set():
-                    break
-                time.sleep(0.1)
-
+            # one wait instead of polling, a skip or wake up ends it early
+            self._gap_event.wait(self.idle_gap if self.idle_gap is not None else self.gap)
+            self._gap_event.clear()
 
-            # waits until resume_player has been called by setting _pause_event.set()
+            # closed by the station while a take is recorded or confirmed
             self._pause_event.wait()
-            if self.confirmation_phase:
-                time.sleep(0.5)
+            # blocks while the idle scheduler has the rotation asleep
+            if not self._awake_event.is_set():
+                self.cmd.led.led_off()
+                self._awake_event.wait()
                 continue
 
             # if not self.buffer:
@@ -216,27 +423,46 @@ class Player:
 
             # play question or recroding
             
-            if not self.buffer or question_counter % nth_question_repeat == 0:
+            # reset and delete shrink the buffer from other threads, only index it under the lock
+            with self._lock:
+                # a skip during the gap already moved the index, it must not end the clip it selected
+                self._skip_event.clear()
+                position = self._idx % len(self.buffer) if self.buffer else 0
+                filename = self.buffer[position] if self.buffer else None
+
+            if filename is None or self.question_counter % nth_question_repeat == 0:
                 filename = self.question
+            elif self._sits_out(filename):
+                with self._lock:
+                    if not self._skip_event.is_set():
+                        self._idx = (self._idx + 1) % max(1, len(self.buffer))
+                # straight on to the next clip, no gap for a clip that was never played
+                self._gap_event.set()
+                continue
+
+            if filename == self.question:
                 led_color = self.cmd.led.instruction_led_on()
             else:
-                with self._lock:
-                    filename = self.buffer[self._idx]
-                    led_color = self.cmd.led.replay_led_on()
+                led_color = self.cmd.led.replay_led_on()
                 
-            proc = self._play_sound_non_blocking(filename)
-
-            while True:
-                if proc is None or proc.poll() is not None:
-                    break
-                if self._skip_event.is_set() or not self._pause_event.is_set():
-                    self.terminate_current_playback(proc=proc)
-                    break
-                time.sleep(0.1)
+            proc = self._play_sound_non_blocking(self._clip_for(filename, position))
+            self._current = proc
+            # pause and skip end the clip themselves, unless they came before it was visible here
+            if self._skip_event.is_set() or not self._pause_event.is_set():
+                self.terminate_current_playback(proc=proc)
+            self._remember(filename)
+            with self._lock:
+                position = (self._idx + (filename != self.question)) % len(self.buffer) if self.buffer else 0
+                upcoming = self.buffer[position] if self.buffer else None
+            self._prepare_stretch(upcoming, position)
+            started = time.monotonic()
+            proc.exited.wait()
+            self._current = None
+            self._log_clip_end(filename, time.monotonic() - started)
 
             if self._pause_event.is_set():
                 self.cmd.led.led_off()
-            question_counter = question_counter + 1
+            self.question_counter = self.question_counter + 1
 
             with self._lock:
                 if self._skip_event.is_set():
@@ -245,7 +471,7 @@ class Player:
                 # do not advance index if the question was repeated
                 if filename == self.question:
                     continue
-                self._idx = (self._idx + 1) % len(self.buffer)
+                self._idx = (self._idx + 1) % max(1, len(self.buffer))
             
             
            
@@ -0,0 +1,209 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+from proc_supervisor import SupervisedProcess
+from wavio import WavWriter
+import asyncio
+import numpy as np
+import realtime
+import log
+
+logger = log.get_logger("preroll")
+
+# bytes per sample of the raw capture stream (S16_LE, "-f cd")
+SAMPLE_BYTES = 2
+
+
+def capture_cmd_from_arecord(arecord_cmd: list) -> list:
+    """Turns the per-take ARECORD_CMD into an endless raw capture to stdout.
+
+    "-t wav" becomes "-t raw" and the "-d <sec>" duration limit is dropped,
+    the limit is enforced per take by PrerollCapture instead.
+    """
+    cmd = []
+    args = iter(arecord_cmd)
+    for arg in args:
+        if arg == "-d":
+            next(args, None)
+            continue
+        if arg == "-t":
+            next(args, None)
+            cmd += ["-t", "raw"]
+            continue
+        cmd.append(arg)
+    if "-t" not in cmd:
+        cmd += ["-t", "raw"]
+    return cmd
+
+
+def max_duration_from_arecord(arecord_cmd: list, default: float = 60) -> float:
+    if "-d" in arecord_cmd:
+        idx = arecord_cmd.index("-d")
+        try:
+            return float(arecord_cmd[idx + 1])
+        except (IndexError, ValueError):
+            pass
+    return default
+
+
+class PrerollCapture:
+    """Keeps the capture device open and the last preroll_ms of audio in a ring buffer.
+
+    begin_take() writes the buffered pre-roll into a new wav file and keeps
+    appending the live stream to it until end_take(). The take is written
+    crash-safe through WavWriter (.part name, periodic header commits) on a
+    single I/O thread, in order, so a slow card never stalls the event loop.
+    The ring is a fixed numpy byte array, so the idle cost is one small copy
+    per period.
+    """
+
+    def __init__(self, cmd: list, rate: int, channels: int, preroll_ms: int,
+                 max_take_sec: float, event_loop: asyncio.AbstractEventLoop,
+                 period_bytes: int = 4096):
+        self.cmd = cmd
+        self.rate = rate
+        self.channels = channels
+        self.frame_bytes = SAMPLE_BYTES * channels
+        self.event_loop = event_loop
+        self.period_bytes = period_bytes - period_bytes % self.frame_bytes
+        self.max_take_bytes = int(max_take_sec * rate) * self.frame_bytes
+
+        ring_frames = max(1, rate * preroll_ms // 1000)
+        self._ring = np.zeros(ring_frames * self.frame_bytes, dtype=np.uint8)
+        # written every period, never paged out in real-time mode
+        realtime.lock(self._ring)
+        self._ring_pos = 0
+        # total bytes captured since the device was opened
+        self._total = 0
+
+        self.process: SupervisedProcess | None = None
+        # resolves to the WavWriter of the current take once the I/O thread opened it
+        self._take: Future | None = None
+        self._take_bytes = 0
+        self._io: ThreadPoolExecutor | None = None
+        # set by the I/O thread when a write failed, the rest of that take is dropped
+        self._write_failed = False
+        self._closing = False
+        self._task: asyncio.Task | None = None
+
+    @property
+    def take_active(self) -> bool:
+        return self._take is not None
+
+    def start(self) -> asyncio.Task:
+        self._task = self.event_loop.create_task(self._run())
+        return self._task
+
+    async def _run(self):
+        # restart the capture process if the device drops out
+        backoff = 0.5
+        while not self._closing:
+            self.process = SupervisedProcess(self.cmd, self.event_loop, stdout=True, realtime=True)
+            try:
+                pid = await self.process.start()
+            except Exception as err:
+                logger.error("Error starting pre-roll capture: %s", err)
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, 10)
+                continue
+            logger.info("Pre-roll capture armed (PID: %d)", pid)
+            backoff = 0.5
+            self._ring_pos = 0
+            self._total = 0
+
+            stdout = self.process.process.stdout
+            while chunk := await stdout.read(self.period_bytes):
+                self._push(chunk)
+
+            code = await self.process.stop()
+            if not self._closing:
+                logger.error("Pre-roll capture exited (%s): %s", code, self.process.stderr_text())
+                await asyncio.sleep(backoff)
+
+    def _push(self, chunk: bytes):
+        data = np.frombuffer(chunk, dtype=np.uint8)
+        size = self._ring.size
+        if data.size >= size:
+            self._ring[:] = data[-size:]
+            self._ring_pos = 0
+        else:
+            end = self._ring_pos + data.size
+            if end <= size:
+                self._ring[self._ring_pos:end] = data
+            else:
+                split = size - self._ring_pos
+                self._ring[self._ring_pos:] = data[:split]
+                self._ring[:end - size] = data[split:]
+            self._ring_pos = end % size
+        self._total += data.size
+
+        if self._take is not None:
+            room = self.max_take_bytes - self._take_bytes
+            if room > 0:
+                # queued behind the open, at most max_take_sec of audio is ever pending
+                self._io.submit(self._write_take, self._take, chunk[:room])
+                self._take_bytes += min(room, len(chunk))
+
+    def _snapshot(self) -> bytes:
+        size = self._ring.size
+        if self._total < size:
+            return self._ring[:self._ring_pos].tobytes()
+        # the oldest byte is at stream offset total - size (size is whole frames),
+        # skip forward to the next frame boundary of the stream
+        skip = -self._total % self.frame_bytes
+        ordered = np.concatenate((self._ring[self._ring_pos:], self._ring[:self._ring_pos]))
+        return ordered[skip:].tobytes()
+
+    async def begin_take(self, filename: str):
+        if self._take is not None:
+            return
+        if self._io is None:
+            self._io = ThreadPoolExecutor(max_workers=1, thread_name_prefix="preroll-io")
+        preroll = self._snapshot()
+        self._take_bytes = len(preroll)
+        # the take is active from here on, periods pushed while the file is
+        # being opened queue up behind it
+        take = self._take = self._io.submit(self._open_take, filename, preroll)
+        try:
+            await asyncio.wrap_future(take, loop=self.event_loop)
+        except Exception:
+            if self._take is take:
+                self._take = None
+            raise
+
+    def _open_take(self, filename: str, preroll: bytes) -> WavWriter:
+        self._write_failed = False
+        take = WavWriter(filename, self.rate, self.channels, SAMPLE_BYTES)
+        take.write(preroll)
+        return take
+
+    def _write_take(self, take: Future, data: bytes):
+        if take.exception() is not None or self._write_failed:
+            return
+        try:
+            take.result().write(data)
+        except OSError as err:
+            self._write_failed = True
+            logger.error("Writing the take failed, the rest of it is lost: %s", err)
+
+    @staticmethod
+    def _close_take(take: Future):
+        if take.exception() is None:
+            take.result().close()
+
+    async def end_take(self) -> float:
+        """Finalizes the current take and returns its length in seconds."""
+        if self._take is None:
+            return 0
+        take, self._take = self._take, None
+        # after the queued writes: fsync + rename
+        await asyncio.wrap_future(self._io.submit(self._close_take, take), loop=self.event_loop)
+        return self._take_bytes / self.frame_bytes / self.rate
+
+    async def close(self):
+        self._closing = True
+        await self.end_take()
+        if self._io is not None:
+            self._io.shutdown(wait=False)
+        if self.process is not None:
+            await self.process.stop()
+        if self._task is not None:
+            await asyncio.gather(self._task, return_exceptions=True)
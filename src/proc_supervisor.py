@@ -0,0 +1,218 @@
+import asyncio
+import signal
+import threading
+from concurrent.futures import Future
+import realtime
+import log
+
+logger = log.get_logger("supervisor")
+
+
+class SupervisedProcess:
+    """One arecord/aplay child process owned by the asyncio event loop.
+
+    All process handling (spawn, signalling, reaping, stderr draining) runs on
+    the event loop via asyncio.create_subprocess_exec. Other threads interact
+    through launch()/terminate()/exited, which never block the loop.
+    """
+
+    def __init__(self, cmd: list, event_loop: asyncio.AbstractEventLoop,
+                 term_timeout: float = 0.2, kill_timeout: float = 2.0,
+                 stderr_limit: int = 4096, stdout: bool = False, stdin: bool = False,
+                 realtime: bool = False):
+        self.cmd = list(cmd)
+        self.event_loop = event_loop
+        # grace period between SIGTERM and SIGKILL
+        self.term_timeout = term_timeout
+        # how long to wait for the reaper after SIGKILL
+        self.kill_timeout = kill_timeout
+        # only the last stderr_limit bytes are kept
+        self.stderr_limit = stderr_limit
+        # pipe stdout to the caller (raw capture) instead of discarding it
+        self.stdout = stdout
+        # feed the process from the loop (raw playback) instead of DEVNULL
+        self.stdin = stdin
+        # an audio process: real-time priority and the audio core when that mode is on
+        self.realtime = realtime
+
+        self.process: asyncio.subprocess.Process | None = None
+        self.killed = False
+        self.start_error: BaseException | None = None
+        # set from the loop once the process has exited (or failed to start)
+        self.exited = threading.Event()
+
+        self._stderr = bytearray()
+        # end of the previous stderr chunk, an xrun line may be split between two reads
+        self._stderr_tail = b""
+        self._stderr_task: asyncio.Task | None = None
+        self._start_future: Future | None = None
+
+    @property
+    def pid(self) -> int | None:
+        return self.process.pid if self.process else None
+
+    @property
+    def returncode(self) -> int | None:
+        return self.process.returncode if self.process else None
+
+    async def start(self) -> int:
+        """Spawns the process and returns its pid."""
+        try:
+            self.process = await asyncio.create_subprocess_exec(
+                *self.cmd,
+                stdin=asyncio.subprocess.PIPE if self.stdin else asyncio.subprocess.DEVNULL,
+                stdout=asyncio.subprocess.PIPE if self.stdout else asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.PIPE,
+            )
+        except BaseException as err:
+            self.start_error = err
+            self.exited.set()
+            raise
+
+        if self.realtime:
+            realtime.audio_process(self.process.pid, self.cmd[0])
+        self._stderr_task = self.event_loop.create_task(self._drain_stderr())
+        self.event_loop.create_task(self._reap())
+        return self.process.pid
+
+    def launch(self, feed=None) -> "SupervisedProcess":
+        """Schedules start() on the event loop from any thread without waiting for it.
+
+        feed: optional iterable of buffers written to stdin once the process runs (needs stdin=True).
+        """
+        self._start_future = asyncio.run_coroutine_threadsafe(self.start(), self.event_loop)
+        self._start_future.add_done_callback(self._report_start_error)
+        if feed is not None:
+            asyncio.run_coroutine_threadsafe(self._feed(feed), self.event_loop)
+        return self
+
+    async def _feed(self, buffers):
+        try:
+            await self._started()
+        except Exception:
+            return
+        if self.process is None or self.process.stdin is None:
+            return
+        stdin = self.process.stdin
+        try:
+            for buf in buffers:
+                stdin.write(buf)
+                await stdin.drain()
+            stdin.close()
+        except (BrokenPipeError, ConnectionResetError):
+            # terminated before it read everything, e.g. skipped
+            pass
+
+    def _report_start_error(self, fut: Future):
+        if fut.cancelled() or fut.exception() is None:
+            return
+        err = fut.exception()
+        if isinstance(err, FileNotFoundError):
+            logger.error("Error: '%s' command not found. Is alsa-utils installed?", self.cmd[0])
+        else:
+            logger.error("Error starting %s: %s", self.cmd[0], err)
+
+    async def _started(self):
+        # stop()/wait() may be scheduled before a launch()ed start() has run
+        if self._start_future is not None and self.process is None:
+            await asyncio.wrap_future(self._start_future)
+
+    async def _drain_stderr(self):
+        assert self.process and self.process.stderr
+        while chunk := await self.process.stderr.read(1024):
+            self._stderr += chunk
+            scan = self._stderr_tail + chunk
+            if xruns := scan.count(realtime.XRUN_MARK):
+                realtime.count_xruns(self.cmd[0], xruns)
+            self._stderr_tail = scan[-len(realtime.XRUN_MARK) + 1:]
+            overflow = len(self._stderr) - self.stderr_limit
+            if overflow > 0:
+                del self._stderr[:overflow]
+
+    async def _reap(self):
+        assert self.process
+        await self.process.wait()
+        if self.realtime:
+            realtime.audio_exited(self.process.pid)
+        self.exited.set()
+
+    async def wait(self) -> int:
+        """Waits for the process to exit on its own and returns the exit code."""
+        await self._started()
+        if self.process is None:
+            return -1
+        code = await self.process.wait()
+        if self._stderr_task:
+            await self._stderr_task
+        return code
+
+    async def stop(self) -> int:
+        """SIGTERM, then SIGKILL if the process is still alive after term_timeout."""
+        try:
+            await self._started()
+        except Exception:
+            return -1
+        if self.process is None:
+            return -1
+
+        if self.process.returncode is None:
+            self.process.send_signal(signal.SIGTERM)
+            try:
+                await asyncio.wait_for(asyncio.shield(self.process.wait()), self.term_timeout)
+            except asyncio.TimeoutError:
+                logger.warning("%s (PID: %d) did not terminate, sending SIGKILL.", self.cmd[0], self.process.pid)
+                self.killed = True
+                self.process.kill()
+                try:
+                    await asyncio.wait_for(asyncio.shield(self.process.wait()), self.kill_timeout)
+                except asyncio.TimeoutError:
+                    logger.error("Error: Timeout waiting for %s to exit after SIGKILL.", self.cmd[0])
+
+        if self._stderr_task:
+            try:
+                await asyncio.wait_for(asyncio.shield(self._stderr_task), self.kill_timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self.process.returncode if self.process.returncode is not None else -1
+
+    def poll(self) -> int | None:
+        """Popen.poll() equivalent, safe to call from any thread."""
+        if self.start_error is not None:
+            return -1
+        if self.process is None:
+            return None
+        return self.process.returncode
+
+    def stderr_text(self) -> str:
+        return self._stderr.decode("utf-8", errors="ignore")
+
+    def _on_loop_thread(self) -> bool:
+        try:
+            return asyncio.get_running_loop() is self.event_loop
+        except RuntimeError:
+            return False
+
+    def terminate(self, timeout: float | None = None) -> Future:
+        """Schedules stop() from any thread.
+
+        Off the loop the caller waits up to timeout for the process to be gone,
+        so the next process can open the sound card. On the loop it returns
+        immediately.
+        """
+        fut = asyncio.run_coroutine_threadsafe(self.stop(), self.event_loop)
+        if not self._on_loop_thread():
+            try:
+                fut.result(timeout)
+            except Exception as err:
+                logger.error("Error during terminating %s: %s", self.cmd[0], err)
+        return fut
+
+    def wait_threadsafe(self, timeout: float | None = None) -> int | None:
+        """Blocks the calling (non-loop) thread until the process has exited."""
+        if self._start_future is not None:
+            try:
+                self._start_future.result(timeout)
+            except Exception:
+                return -1
+        self.exited.wait(timeout)
+        return self.poll()
@@ -0,0 +1,209 @@
+"""Opt-in real-time mode for the audio path.
+
+With realtime_config ENABLED, the aplay / arecord processes started by the
+player, the mixer, the recorder and the pre-roll capture run SCHED_FIFO (or
+RR) pinned to a core of their own. Every other thread of the station is kept
+off that core, including the executor that filters, denoises and fingerprints
+takes. The python threads of the player only wait on those processes. The
+event loop does render the mixer's periods, LOOP_PRIORITY raises it as well.
+
+The mixer's period buffers and clip cache and the pre-roll ring are pre-faulted
+and mlocked (up to LOCK_MB), so writing a period never waits for a page fault
+while the sd card stalls.
+
+Scheduling and locking need privileges, e.g. /etc/security/limits.d/ohrgarten.conf:
+
+    pi  -  rtprio   80
+    pi  -  memlock  65536
+
+Without them a warning is logged once and the station runs as usual.
+
+Xruns are counted whether the mode is on or not, from the "underrun!!!" and
+"overrun!!!" lines of aplay and arecord, and logged every REPORT_SEC, so both
+can be compared.
+"""
+from collections import Counter
+from config import RealtimeConfig
+import asyncio
+import ctypes
+import ctypes.util
+import os
+import numpy as np
+import log
+
+logger = log.get_logger("realtime")
+
+POLICIES = {"fifo": getattr(os, "SCHED_FIFO", 1), "rr": getattr(os, "SCHED_RR", 2)}
+# aplay prints "underrun!!! (at least ...)", arecord "overrun!!! ..."
+XRUN_MARK = b"run!!!"
+
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+# all cores the station may use, taken before setup() narrows the affinity
+_CPUS = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else [0]
+
+_cfg = RealtimeConfig()
+_core: int | None = None
+_loop_raised = False
+# live audio processes, pid -> command, so a reload can promote or demote them
+_audio: dict[int, str] = {}
+_locked: dict[int, int] = {}
+_warned: set[str] = set()
+_libc = None
+
+xruns: Counter = Counter()
+_reported: Counter = Counter()
+
+
+def _warn_once(what: str, err):
+    if what not in _warned:
+        _warned.add(what)
+        logger.warning("Real-time mode: could not %s (%s), continuing without", what, err)
+
+
+def _threads() -> list[int]:
+    try:
+        return [int(tid) for tid in os.listdir("/proc/self/task")]
+    except OSError:
+        return [0]
+
+
+def _set_affinity(pid: int, cpus: set) -> bool:
+    try:
+        os.sched_setaffinity(pid, cpus)
+        return True
+    except (OSError, AttributeError) as err:
+        _warn_once("set the cpu affinity", err)
+        return False
+
+
+def _set_scheduler(pid: int, priority: int) -> bool:
+    """SCHED_FIFO/RR at priority, or back to normal scheduling for priority 0."""
+    policy = POLICIES.get(_cfg.POLICY, POLICIES["fifo"]) if priority > 0 else os.SCHED_OTHER
+    try:
+        os.sched_setscheduler(pid, policy, os.sched_param(priority))
+        return True
+    except (OSError, AttributeError) as err:
+        _warn_once("raise the scheduling priority", err)
+        return False
+
+
+def audio_core(rt_cfg: RealtimeConfig) -> int | None:
+    """The core reserved for audio, None if there is none to spare."""
+    if len(_CPUS) < 2:
+        _warn_once("reserve a core", f"only {len(_CPUS)} cpu")
+        return None
+    core = rt_cfg.CPU if rt_cfg.CPU is not None else _CPUS[-1]
+    if core not in _CPUS:
+        _warn_once("reserve a core", f"cpu {core} is not available")
+        return None
+    return core
+
+
+def setup(rt_cfg: RealtimeConfig):
+    """Applies the mode to the whole process. Call from the event loop thread, early:
+    threads started later inherit its affinity."""
+    global _cfg, _core, _loop_raised
+    was_enabled = _cfg.ENABLED
+    _cfg = rt_cfg
+    if not rt_cfg.ENABLED and not was_enabled:
+        return
+    _core = audio_core(rt_cfg) if rt_cfg.ENABLED else None
+    others = set(_CPUS) - {_core}
+    # logging, gpio and whatever else runs already; the loop thread and its executor with them
+    for tid in _threads():
+        _set_affinity(tid, others)
+    loop_priority = rt_cfg.LOOP_PRIORITY if rt_cfg.ENABLED else 0
+    if loop_priority or _loop_raised:
+        _loop_raised = _set_scheduler(0, loop_priority) and loop_priority > 0
+    for pid in list(_audio):
+        _promote(pid)
+    if rt_cfg.ENABLED:
+        logger.info("Real-time mode: audio on cpu %s at %s %d, other work on %s",
+                    "any" if _core is None else _core, rt_cfg.POLICY, rt_cfg.PRIORITY, sorted(others))
+
+
+# hot reload: also applies to the audio processes that are running
+def reconfigure(rt_cfg: RealtimeConfig):
+    _warned.clear()
+    setup(rt_cfg)
+
+
+def _promote(pid: int):
+    if _cfg.ENABLED:
+        if _core is not None:
+            _set_affinity(pid, {_core})
+        _set_scheduler(pid, _cfg.PRIORITY)
+    else:
+        _set_affinity(pid, set(_CPUS))
+        _set_scheduler(pid, 0)
+
+
+def audio_process(pid: int, name: str):
+    """Called right after an aplay / arecord is spawned."""
+    _audio[pid] = name
+    if _cfg.ENABLED:
+        _promote(pid)
+
+
+def audio_exited(pid: int):
+    _audio.pop(pid, None)
+
+
+# --- locked buffers ---
+
+def _mlock(name: str, addr: int, size: int) -> bool:
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    if getattr(_libc, name)(ctypes.c_void_p(addr), ctypes.c_size_t(size)) != 0:
+        _warn_once(name, os.strerror(ctypes.get_errno()))
+        return False
+    return True
+
+
+def lock(array: np.ndarray) -> bool:
+    """Pre-faults a buffer and locks it in RAM, within LOCK_MB. False if it stays pageable."""
+    if not (_cfg.ENABLED and _cfg.LOCK_MEMORY) or not array.flags.c_contiguous or array.nbytes == 0:
+        return False
+    addr = array.ctypes.data
+    if addr in _locked:
+        return True
+    if sum(_locked.values()) + array.nbytes > _cfg.LOCK_MB * 2**20:
+        return False
+    if array.flags.writeable:
+        # one write per page, so the pages exist before the first period needs them
+        pages = array.reshape(-1).view(np.uint8)[::_PAGE_SIZE]
+        pages[:] = pages
+    if not _mlock("mlock", addr, array.nbytes):
+        return False
+    _locked[addr] = array.nbytes
+    return True
+
+
+def unlock(array: np.ndarray):
+    addr = array.ctypes.data if array.nbytes else 0
+    if _locked.pop(addr, None) is not None:
+        _mlock("munlock", addr, array.nbytes)
+
+
+# --- xruns ---
+
+def count_xruns(name: str, n: int):
+    xruns[name] += n
+
+
+def report_xruns():
+    """Logs the xruns since the last report (call periodically)."""
+    new = xruns - _reported
+    if new:
+        _reported.update(new)
+        logger.warning("Xruns since the last report: %s (total %s)",
+                       ", ".join(f"{name} {n}" for name, n in new.items()),
+                       ", ".join(f"{name} {n}" for name, n in xruns.items()),
+                       extra={"xruns": dict(new)})
+
+
+async def xrun_reporter():
+    while True:
+        await asyncio.sleep(_cfg.REPORT_SEC)
+        report_xruns()
@@ -1,39 +1,195 @@
 from config import RecordingConfig
+from proc_supervisor import SupervisedProcess
+from preroll import PrerollCapture, capture_cmd_from_arecord, max_duration_from_arecord
+import wavio
+import loudness
+import sidecar
+import denoise
+from fingerprint import FingerprintIndex, INDEX_FILE, SIDECAR_KEY, fingerprint, fingerprint_file
+from segstore import SegmentStore
+import segstore
 from pathlib import Path
 import os
 from datetime import datetime
-import time, signal, subprocess, os
+import time, os
 import numpy as np
 from scipy.io import wavfile
 from scipy.signal import butter, lfilter
 from typing import TYPE_CHECKING
-import threading
 import asyncio
+import log
+
+logger = log.get_logger("recorder")
 
 if TYPE_CHECKING:
     from cmd_typing import CmdTyping
 
+LOWPASS_HZ = 3000
+# the index is written every SAVE_EVERY new takes and at shutdown, missing takes are filled in at startup
+FP_SAVE_EVERY = 16
+
+
+def lowpass(data, cutoff_freq, sample_rate, order=5):
+    nyquist = 0.5 * sample_rate
+    norm_cutoff = cutoff_freq / nyquist
+    b, a = butter(order, norm_cutoff, btype='low', analog=False)
+    return lfilter(b, a, data)
+
+
+def filter_take(data: np.ndarray, rate: int, rec_cfg: RecordingConfig) -> np.ndarray:
+    """Denoise (if enabled) and low pass, clipped back to C-order int16. Also used by reprocess.py."""
+    if rec_cfg.DENOISE:
+        # the pre-roll is ambient sound right before the press, otherwise use the leading silence
+        data = denoise.suppress(data, rate, profile_ms=rec_cfg.PREROLL_MS or 500,
+                                reduction_db=rec_cfg.DENOISE_REDUCTION_DB)
+    if data.ndim == 1:
+        filtered = lowpass(data, cutoff_freq=LOWPASS_HZ, sample_rate=rate)
+    else:
+        filtered = np.array([lowpass(channel, LOWPASS_HZ, rate) for channel in data.T]).T
+    # C order, so the player can stream it without another copy
+    return np.clip(filtered, -32768, 32767).astype(np.int16, order="C")
 
 
 class Recorder:
 
     recording_start = 0
     
-    def __init__(self, rec_cfg: RecordingConfig):
+    def __init__(self, rec_cfg: RecordingConfig, event_loop):
         # Initialize folders
         self.rec_cfg = rec_cfg
         try:
             os.makedirs(rec_cfg.RECORDING_PATH, exist_ok=True)
         except OSError as err:
-            print(f"Error creating directory at {self.rec_path}: {err}")
+            logger.error("Error creating directory at %s: %s", rec_cfg.RECORDING_PATH, err)
             raise Exception
 
         self.rec_path = rec_cfg.RECORDING_PATH
         self.BEEP = rec_cfg.SFX_PATH + "/" +  rec_cfg.BEEP_FILE
-        self.recording_process: subprocess.Popen | None = None
+        self.recording_process: SupervisedProcess | None = None
+        self.event_loop: asyncio.AbstractEventLoop = event_loop
+        self._header_task: asyncio.Task | None = None
+        self._header_commit: asyncio.Future | None = None
+        # repair takes interrupted by SIGKILL or power loss before they are scanned
+        recovered, quarantined = wavio.recover_recordings(self.rec_path)
+        if recovered or quarantined:
+            logger.warning("Recovered %d, quarantined %d interrupted recordings.", recovered, quarantined)
+        # opt-in packed storage, confirmed takes are appended to segment files
+        self.store: SegmentStore | None = self._make_store(rec_cfg)
         self.buffer = self._load_recordings()
         self.current_filename = ''
 
+        # opt-in pre-armed capture, takes are then written from the ring buffer instead of a new arecord
+        self.preroll: PrerollCapture | None = self._make_preroll(rec_cfg)
+
+        # opt-in RAM staging, unconfirmed takes never reach the sd card
+        self.staging: str | None = self._make_staging(rec_cfg)
+
+        # opt-in fingerprint index, repeats are flagged or demoted at ingest
+        self._take_fp: tuple | None = None
+        self._fp_unsaved = 0
+        self.fingerprints: FingerprintIndex | None = self._make_fingerprints(rec_cfg)
+
+    def _make_store(self, rec_cfg: RecordingConfig) -> SegmentStore | None:
+        if rec_cfg.STORAGE != "segments":
+            return None
+        store = SegmentStore(self.rec_path, rec_cfg.SEGMENT_MB, rec_cfg.COMPACT_RATIO).open()
+        segstore.attach(store)
+        return store
+
+    def _close_store(self):
+        if self.store is not None:
+            segstore.detach(self.store)
+            self.store = None
+
+    def _make_fingerprints(self, rec_cfg: RecordingConfig) -> FingerprintIndex | None:
+        if not rec_cfg.FINGERPRINT:
+            return None
+        index = FingerprintIndex.open(os.path.join(self.rec_path, INDEX_FILE), present=self.buffer)
+        missing = [str(p) for p in self.buffer if Path(p).name not in index]
+        if missing:
+            # a few ms per take, off the event loop; commits add to the index meanwhile
+            self.event_loop.run_in_executor(None, self._index_missing, index, missing)
+        return index
+
+    def _index_missing(self, index: FingerprintIndex, paths: list):
+        logger.info("Fingerprinting %d recordings missing from the index...", len(paths))
+        for path in paths:
+            try:
+                index.add(Path(path).name, *fingerprint_file(path))
+            except (OSError, ValueError) as err:
+                logger.warning("Could not fingerprint %s: %s", path, err)
+        self._save_fingerprints(index)
+
+    def _save_fingerprints(self, index: FingerprintIndex | None = None):
+        index = index or self.fingerprints
+        if index is None:
+            return
+        try:
+            index.save()
+            self._fp_unsaved = 0
+        except OSError as err:
+            logger.warning("Could not save the fingerprint index: %s", err)
+
+    # shutdown: whatever was added since the last save
+    def close_fingerprints(self):
+        if self.fingerprints is not None and self._fp_unsaved:
+            self._save_fingerprints()
+
+    def _make_staging(self, rec_cfg: RecordingConfig) -> str | None:
+        if not rec_cfg.STAGING_PATH:
+            return None
+        os.makedirs(rec_cfg.STAGING_PATH, exist_ok=True)
+        # whatever is left was never confirmed
+        for item in Path(rec_cfg.STAGING_PATH).iterdir():
+            if item.is_file():
+                item.unlink()
+        return rec_cfg.STAGING_PATH
+
+    def _make_preroll(self, rec_cfg: RecordingConfig) -> PrerollCapture | None:
+        if not rec_cfg.PREROLL_MS:
+            return None
+        preroll = PrerollCapture(
+            cmd = rec_cfg.CAPTURE_CMD or capture_cmd_from_arecord(rec_cfg.ARECORD_CMD),
+            rate = rec_cfg.CAPTURE_RATE,
+            channels = rec_cfg.CAPTURE_CHANNELS,
+            preroll_ms = rec_cfg.PREROLL_MS,
+            max_take_sec = max_duration_from_arecord(rec_cfg.ARECORD_CMD),
+            event_loop = self.event_loop)
+        preroll.start()
+        return preroll
+
+    # hot reload: the buffer object is shared with the player and only replaced in place
+    async def reconfigure(self, rec_cfg: RecordingConfig):
+        # never switch the capture setup under a running take
+        while self.is_recording():
+            await asyncio.sleep(0.1)
+
+        old = self.rec_cfg
+        self.rec_cfg = rec_cfg
+        self.BEEP = rec_cfg.SFX_PATH + "/" +  rec_cfg.BEEP_FILE
+
+        storage = ("STORAGE", "SEGMENT_MB", "COMPACT_RATIO")
+        if rec_cfg.RECORDING_PATH != old.RECORDING_PATH or any(getattr(old, name) != getattr(rec_cfg, name) for name in storage):
+            os.makedirs(rec_cfg.RECORDING_PATH, exist_ok=True)
+            self.rec_path = rec_cfg.RECORDING_PATH
+            wavio.recover_recordings(self.rec_path)
+            self._close_store()
+            self.store = self._make_store(rec_cfg)
+            self.cmd.player.replace_buffer(self._load_recordings())
+
+        if rec_cfg.STAGING_PATH != old.STAGING_PATH:
+            self.staging = self._make_staging(rec_cfg)
+
+        if rec_cfg.FINGERPRINT != old.FINGERPRINT or rec_cfg.RECORDING_PATH != old.RECORDING_PATH:
+            await self.event_loop.run_in_executor(None, self.close_fingerprints)
+            self.fingerprints = self._make_fingerprints(rec_cfg)
+
+        capture = ("PREROLL_MS", "CAPTURE_CMD", "CAPTURE_RATE", "CAPTURE_CHANNELS", "ARECORD_CMD")
+        if any(getattr(old, name) != getattr(rec_cfg, name) for name in capture):
+            if self.preroll is not None:
+                await self.preroll.close()
+            self.preroll = self._make_preroll(rec_cfg)
+
 
     def inject_cmd(self, cmd:"CmdTyping"):
         self.cmd = cmd
@@ -41,175 +197,277 @@ class Recorder:
     def get_rec_buffer(self) -> list:
         return self.buffer
 
-    def get_rec_process(self) -> subprocess.Popen | None:
+    def get_rec_process(self) -> SupervisedProcess | None:
         return self.recording_process
     
+    def is_recording(self) -> bool:
+        return self.recording_process is not None or (self.preroll is not None and self.preroll.take_active)
+
     def get_current_recording(self) -> str:
         return self.current_filename
 
     def _load_recordings(self) -> list:
         """Scans the RECORDING_PATH for .wav files and populates the recorded_files list."""
         recorded_files = [] 
-        print(f"Scanning for recordings in: {self.rec_path}...")
+        logger.info("Scanning for recordings in: %s...", self.rec_path)
 
         path = Path(self.rec_path)
         count = 0
 
+        # with packed storage only a handful of loose files are left to scan
+        packed = set(self.store.names()) if self.store is not None else set()
         for item in path.iterdir():
             if item.is_file() and item.suffix.lower() == ".wav":
+                if item.name in packed:
+                    # packed right before a crash, the loose copy was never removed
+                    item.unlink()
+                    sidecar.sidecar_path(item).unlink(missing_ok=True)
+                    continue
                 recorded_files.append(item) 
                 count += 1
+        recorded_files += [path / name for name in packed]
 
         recorded_files.sort() # Sort alphabetically/chronologically if names allow
-        print(f"Found {count} existing recordings.")
+        if self.store is not None:
+            logger.info("Found %d existing recordings, %d of them packed.", len(recorded_files), len(packed))
+            if count:
+                logger.info("%d recordings are still single files, python src/segstore.py %s --pack moves them",
+                            count, self.rec_path)
+        else:
+            logger.info("Found %d existing recordings.", count)
+            if (path / segstore.SEGMENT_DIR / segstore.INDEX_FILE).exists():
+                logger.warning("%s has packed recordings that are not played with STORAGE: files, "
+                               "python src/segstore.py %s --unpack restores them", self.rec_path, self.rec_path)
         return recorded_files
 
     def delete_recording(self, filename = None):
         if filename is None:
             filename = self.current_filename
 
-        if os.path.exists(filename):
+        if segstore.packed(filename) is not None:
+            # an fsynced journal line and a stat of every segment, not on the loop
+            self.event_loop.run_in_executor(None, self._delete_packed, os.path.basename(filename))
+            if self.fingerprints is not None:
+                self.fingerprints.remove(os.path.basename(filename))
+            logger.info("Deleted packed recording: %s", filename)
+        elif os.path.exists(filename):
             os.remove(filename)
-            print(f"Deleted file: {filename}")
+            sidecar.remove(filename)
+            if self.fingerprints is not None:
+                self.fingerprints.remove(os.path.basename(filename))
+            logger.info("Deleted file: %s", filename)
         else:
-            print(f"File not exist: {filename}")
+            logger.warning("File not exist: %s", filename)
+
+    def _delete_packed(self, name: str):
+        self.store.delete(name)
+        if self.store.needs_compaction():
+            self.store.compact()
 
     def reset_recordings(self):
         
-        print("Clearing the in-memory list of tracked recordings.")
+        logger.info("Clearing the in-memory list of tracked recordings.")
 
         
         path = Path(self.rec_path)
         failure_count = 0
         for item in path.iterdir():
             try:
-                if item.is_file() and item.suffix.lower() == ".wav":
-                    item.unlink() # Delete the file
+                if item.is_file() and item.suffix.lower() in (".wav", ".json"):
+                    item.unlink() # Delete the file and its metadata
             except PermissionError:
-                print(f"Failed (Permission denied). Check permissions for {self.rec_path}")
+                logger.error("Failed (Permission denied). Check permissions for %s", self.rec_path)
                 failure_count += 1
             except OSError as e:
-                print(f"Failed (OS Error: {e}).") # Catch other potential file system errors
+                logger.error("Failed (OS Error: %s).", e) # Catch other potential file system errors
                 failure_count += 1
             except Exception as e:
-                print(f"Failed (Unexpected Error: {e}).")
+                logger.error("Failed (Unexpected Error: %s).", e)
                 failure_count += 1
             finally:
                 if failure_count > 0:
                     raise Exception
 
-        self.buffer.clear()
+        if self.store is not None:
+            self.store.clear()
+
+        # cleared in place under the player's lock, which also resets its position
+        self.cmd.player.replace_buffer([])
+        if self.fingerprints is not None:
+            self.fingerprints.clear()
+            self._save_fingerprints()
         
 
-    def start_recording(self):
-        print("Started rec func")
-        """Starts the arecord process."""
-        self.cmd.player.pause()
+    async def start_recording(self):
+        """Starts the arecord process. The station has paused the rotation already."""
+        logger.debug("Started rec func")
         #self.cmd.play_sound(self.BEEP)
-        if self.recording_process is None: 
+        if not self.is_recording(): 
             self.cmd.led.recording_led_on()
+            self._take_fp = None
 
 
             try:
                 # Generate a unique filename with timestamp
                 timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                self.current_filename = os.path.join(self.rec_path, f"rec_{timestamp}.wav")
-                full_command = self.rec_cfg.ARECORD_CMD + [self.current_filename]
+                self.current_filename = os.path.join(self._take_dir(), f"rec_{timestamp}.wav")
 
-                print(f"Starting recording to: {self.current_filename}")
-                print(f"Command: {' '.join(full_command)}")
+                if self.preroll is not None:
+                    # input is already open, the take starts with the buffered pre-roll
+                    await self.preroll.begin_take(self.current_filename)
+                    Recorder.recording_start = time.time()
+                    logger.info("Recording started with %d ms pre-roll to: %s", self.rec_cfg.PREROLL_MS, self.current_filename)
+                    return
 
-                # Start arecord as a background process using Popen
+                # arecord writes under a temporary name until the take is finalized
+                part_name = self.current_filename + wavio.PART_SUFFIX
+                full_command = self.rec_cfg.ARECORD_CMD + [part_name]
+
+                logger.info("Starting recording to: %s", self.current_filename)
+                logger.debug("Command: %s", full_command)
+
+                # Start arecord as a background process supervised by the event loop
                 # Duration of recording limited to config defined arecord cmd duration
-                self.recording_process = subprocess.Popen(full_command, stderr=subprocess.PIPE)
+                self.recording_process = SupervisedProcess(full_command, self.event_loop,
+                                                           term_timeout=0.2, kill_timeout=2, realtime=True)
+                pid = await self.recording_process.start()
                 Recorder.recording_start = time.time()
-                print(f"Recording started (PID: {self.recording_process.pid})... Press and hold button.")
+                self._header_task = self.event_loop.create_task(self._commit_headers(part_name))
+                logger.info("Recording started (PID: %d)... Press and hold button.", pid)
 
             except FileNotFoundError:
-                print("Error: 'arecord' command not found. Is alsa-utils installed?")
+                logger.error("Error: 'arecord' command not found. Is alsa-utils installed?")
                 self.recording_process = None 
             except Exception as e:
-                print(f"Error starting recording process: {e}")
+                logger.error("Error starting recording process: %s", e)
                 self.recording_process = None 
         else:
-            print("Already recording.") 
+            logger.warning("Already recording.") 
+
 
+    async def stop_recording(self) -> wavio.PcmBuffer | None:
+        """Stops the arecord process. Returns the filtered take to confirm, None if it was discarded."""
 
-    def stop_recording(self):
-        """Stops the arecord process."""
+        if self.preroll is not None and self.preroll.take_active:
+            rec_duration = time.time() - Recorder.recording_start
+            take_len = await self.preroll.end_take()
+            logger.info("Recording stopped (%.2fs incl. pre-roll). File saved: %s", take_len, self.current_filename)
+            return await self._process_take(rec_duration)
 
-        if self.recording_process is not None:
-            print(f"Stopping recording (PID: {self.recording_process.pid})...")
+        elif self.recording_process is not None:
+            logger.info("Stopping recording (PID: %s)...", self.recording_process.pid)
+            rec_duration = time.time() - Recorder.recording_start
             try:
-                # Send SIGTERM signal first (allows arecord to potentially clean up)
-                rec_duration = time.time() - Recorder.recording_start
-                self.recording_process.terminate()
-                time.sleep(0.2)
-                
-                if self.recording_process.poll() is None: # Check if process is still running
-                    print("Process did not terminate, sending SIGKILL.")
-                    self.recording_process.kill()
-
-                # Wait for the process to actually finish and retrieve output/errors
-                stdout, stderr = self.recording_process.communicate(timeout=2) 
-
-                print(f"Recording stopped. File saved: {self.current_filename}")
-                if stderr:
-                    print(f"Recording process stderr:\n{stderr.decode('utf-8', errors='ignore')}")
-
-            except subprocess.TimeoutExpired:
-                print("Error: Timeout waiting for arecord process to terminate after signaling.")
-                # Force kill if timeout occurred during communicate()
-                self.recording_process.kill()
-                self.recording_process.wait() # Ensure it's cleaned up
-                print("Process killed due to timeout.")
+                # SIGTERM first (allows arecord to finalize the wav header), SIGKILL after the grace timer
+                await self.recording_process.stop()
+
+                if stderr := self.recording_process.stderr_text():
+                    logger.debug("Recording process stderr:\n%s", stderr)
+
             except Exception as e:
-                print(f"Error stopping recording process: {e}")
-                # Ensure we try to kill it if an error occurred during termination steps
-                if self.recording_process.poll() is None:
-                    self.recording_process.kill()
-                    self.recording_process.wait()
+                logger.error("Error stopping recording process: %s", e)
 
+            if self._header_task is not None:
+                self._header_task.cancel()
+                self._header_task = None
+            # a commit already running in the executor must not race the rename below
+            if self._header_commit is not None:
+                await asyncio.wait([self._header_commit])
+                self._header_commit = None
 
             # Reset the global variable
             self.recording_process = None
-            
-            #self.supress_background_noise(self.current_filename)
-
-            if self.check_len(duration = rec_duration, threshold = 1.5):
-                print("Include recording")
-                self.apply_filter(self.current_filename)
-
-                print("Start confrimation phase")
-                self.cmd.led.led_off()
-                
-                self.confirm_routine()
-                #self.cmd.start_confirmation(self.current_filename)
 
+            # arecord only rewrites the header on a clean exit, always fix it before the rename
+            part_name = self.current_filename + wavio.PART_SUFFIX
+            if await self.event_loop.run_in_executor(None, wavio.finalize_partial, part_name, self.rec_path):
+                logger.info("Recording stopped. File saved: %s", self.current_filename)
+                return await self._process_take(rec_duration)
+            logger.error("Recording stopped. Take was unrecoverable: %s", self.current_filename)
 
         else:
-            print("Not currently recording.")
-
-        self.cmd.player.resume()
-        #self.cmd.start()
-
-    def confirm_routine(self):
-        self.cmd.button.button_await_confirm(True)
-
-        thread = self.cmd.player.start_confirmation(self.current_filename)
-
-        def _watch():
-            thread.join()
-            self.cmd.button.button_await_confirm(False)
-            self.cmd.player.resume()
+            logger.warning("Not currently recording.")
+        return None
+
+    def _take_dir(self) -> str:
+        """Staging while it has room for a take of the maximum length, RECORDING_PATH otherwise."""
+        if self.staging is None:
+            return self.rec_path
+        take_bytes = (max_duration_from_arecord(self.rec_cfg.ARECORD_CMD)
+                      * self.rec_cfg.CAPTURE_RATE * self.rec_cfg.CAPTURE_CHANNELS * 2)
+        staged = sum(f.stat().st_size for f in Path(self.staging).iterdir() if f.is_file())
+        if staged + take_bytes > self.rec_cfg.STAGING_MAX_MB * 1024 * 1024:
+            logger.warning("Staging area full, recording straight to %s", self.rec_path)
+            return self.rec_path
+        return self.staging
+
+    async def commit_recording(self) -> str:
+        """Moves the confirmed take (and its sidecar) from staging to RECORDING_PATH, or packs it. Returns the final path."""
+        filename = self.current_filename
+        if self.store is not None:
+            # straight from staging into the open segment, the take never exists as a file in RECORDING_PATH
+            self.current_filename = await self.event_loop.run_in_executor(None, self._pack, filename)
+            logger.info("Packed recording: %s", self.current_filename)
+        elif self._is_staged(filename):
+            # fsync on the sd card, keep it off the event loop
+            self.current_filename = await self.event_loop.run_in_executor(None, self._commit_file, filename)
+            logger.info("Committed recording: %s", self.current_filename)
+
+        # only confirmed takes go into the index, a discarded one is never a repeat of anything
+        if (self.fingerprints is not None and self._take_fp is not None
+                and self._take_fp[0] == os.path.basename(self.current_filename)):
+            await self.event_loop.run_in_executor(None, self._index_take)
+        return self.current_filename
 
-        threading.Thread(target=_watch, daemon=True).start()
-    
+    def _is_staged(self, filename) -> bool:
+        return self.staging is not None and os.path.normpath(os.path.dirname(filename)) == os.path.normpath(self.staging)
+
+    def _commit_file(self, filename) -> str:
+        final = os.path.join(self.rec_path, os.path.basename(filename))
+        meta = sidecar.sidecar_path(filename)
+        if meta.exists():
+            wavio.commit_file(str(meta), str(sidecar.sidecar_path(final)))
+        return wavio.commit_file(filename, final)
+
+    def _pack(self, filename) -> str:
+        if segstore.pack(self.store, [filename]):
+            return os.path.join(self.rec_path, os.path.basename(filename))
+        # logged by pack(), the take stays a single file rather than being lost
+        return self._commit_file(filename) if self._is_staged(filename) else filename
+
+    def _index_take(self):
+        name, hashes, times = self._take_fp
+        self._take_fp = None
+        self.fingerprints.add(name, hashes, times)
+        self._fp_unsaved += 1
+        if self._fp_unsaved >= FP_SAVE_EVERY:
+            self._save_fingerprints()
+
+    # keeps the header of the growing arecord file valid so a power cut loses at most one interval
+    async def _commit_headers(self, part_name, interval = 2.0):
+        while True:
+            await asyncio.sleep(interval)
+            self._header_commit = self.event_loop.run_in_executor(None, wavio.repair_header, part_name, False, True)
+            await asyncio.shield(self._header_commit)
+
+    async def _process_take(self, rec_duration) -> wavio.PcmBuffer | None:
+
+        if self.check_len(duration = rec_duration, threshold = 1.5):
+            logger.info("Include recording")
+            # filtering is cpu bound, keep it off the event loop
+            take = await self.event_loop.run_in_executor(None, self.apply_filter, self.current_filename)
+            if take is not None:
+                self.cmd.led.led_off()
+            return take
+        # never enters the rotation, so it must not stay on disk either
+        logger.info("Discard recording, too short")
+        self.delete_recording()
+        return None
 
     def check_len(self, duration, threshold = 3.0) -> bool:
 
 
-        print(duration)
+        logger.debug("Recording duration %.2fs", duration)
         if duration < threshold:
             
             # do not include recording, most likely mistake
@@ -217,21 +475,40 @@ class Recorder:
         # include recording
         return True
 
-    def apply_filter(self, filename):
-        rate, data = wavfile.read(filename)
-        if data.ndim == 1:
-            filtered = self.lowpass(data, cutoff_freq=3000, sample_rate=rate)
-        else:
-            filtered = np.array([self.lowpass(channel, 3000, rate) for channel in data.T]).T
-
-        filtered = np.clip(filtered, -32768, 32767).astype(np.int16)
-        wavfile.write(filename, rate, filtered)
-
+    def apply_filter(self, filename) -> wavio.PcmBuffer | None:
+        """Filters the take in place on disk. Returns the processed audio, None if unreadable."""
+        try:
+            rate, data = wavfile.read(filename)
+        except ValueError as err:
+            logger.error("Unreadable recording %s: %s", filename, err)
+            wavio.quarantine(filename, self.rec_path)
+            return None
+        filtered = filter_take(data, rate, self.rec_cfg)
+        # rewrite next to the original and swap atomically, a crash never leaves a half written take
+        tmp_name = filename + wavio.PART_SUFFIX
+        wavfile.write(tmp_name, rate, filtered)
+        os.replace(tmp_name, filename)
+
+        # measured once here while the take is in memory, the player applies the gain
+        loudness.store(filename, loudness.analyze(filtered, rate))
+        if self.fingerprints is not None:
+            self._check_repeat(filename, filtered, rate)
+        return wavio.PcmBuffer(filename, rate, filtered)
+
+    def _check_repeat(self, filename, data: np.ndarray, rate: int):
+        """Looks the take up in the archive, a match is noted in its sidecar."""
+        name = os.path.basename(filename)
+        hashes, times = fingerprint(data, rate)
+        self._take_fp = (name, hashes, times)
+        found = [m for m in self.fingerprints.match(hashes, times)
+                 if m[0] != name and m[1] >= self.rec_cfg.DUPLICATE_MIN_SCORE]
+        if not found:
+            return
+        of, score, hits = found[0]
+        demoted = self.rec_cfg.DUPLICATE_ACTION == "demote"
+        logger.warning("%s repeats %s (score %.3f, %d hits)%s", name, of, score, hits,
+                       ", demoted" if demoted else "")
+        sidecar.update(filename, SIDECAR_KEY, {"of": of, "score": score, "demoted": demoted})
 
-    def lowpass(self, data, cutoff_freq, sample_rate, order=5):
-        nyquist = 0.5 * sample_rate
-        norm_cutoff = cutoff_freq / nyquist
-        b, a = butter(order, norm_cutoff, btype='low', analog=False)
-        return lfilter(b, a, data)
 
 
@@ -0,0 +1,310 @@
+"""Offline re-run of a processing chain over the whole recording archive.
+
+    python src/reprocess.py config.yaml --chain filter,normalize [--jobs N]
+    python src/reprocess.py config.yaml --chain trim,transcode --rate 22050 --channels 1
+
+Steps, applied in the given order:
+    filter      denoise (if DENOISE) and low pass, exactly like the live recorder
+    trim        cut leading and trailing silence below --trim-db, keep --pad-ms
+    normalize   gain to the player's TARGET_LUFS, peaks kept below --ceiling-db
+    transcode   resample to --rate and/or mix to --channels (stays 16 bit wav)
+
+Takes are read memory-mapped and processed in a process pool at idle priority.
+Every result is written to <name>.reprocess, fsynced and swapped in with a rename,
+so a live station keeps playing the old or the new file, never a partial one.
+The progress journal (.reprocess.jsonl in RECORDING_PATH) records each swap
+before it happens, an interrupted run resumes with the same chain and never
+processes a take twice. Takes newer than the start of the run are skipped, they
+were recorded with the current settings. filter is applied on top of the
+existing processing, the originals are not kept.
+"""
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from config import Config, LogConfig, RecordingConfig, load_config
+from dataclasses import asdict, dataclass
+from math import gcd, isfinite
+from pathlib import Path
+import argparse
+import json
+import os
+import time
+import numpy as np
+from scipy.io import wavfile
+from scipy.signal import resample_poly
+from archive_sync import idle_io_priority
+from recorder import LOWPASS_HZ, filter_take
+import loudness
+import sidecar
+import log
+
+logger = log.get_logger("reprocess")
+
+JOURNAL = ".reprocess.jsonl"
+TMP_SUFFIX = ".reprocess"
+SIDECAR_KEY = "reprocess"
+# silence detection resolution for trim
+TRIM_WINDOW_SEC = 0.01
+
+
+@dataclass
+class Chain:
+    steps: list
+    rec_cfg: RecordingConfig
+    target_lufs: float = -20.0
+    ceiling_db: float = -1.0
+    trim_db: float = -50.0
+    pad_ms: int = 150
+    rate: int | None = None
+    channels: int | None = None
+
+    def describe(self) -> dict:
+        """What the journal compares on resume, only the settings the result depends on."""
+        options = {k: v for k, v in asdict(self).items() if k != "rec_cfg"}
+        if "filter" in self.steps:
+            options["filter"] = {"lowpass_hz": LOWPASS_HZ, "denoise": self.rec_cfg.DENOISE,
+                                 "reduction_db": self.rec_cfg.DENOISE_REDUCTION_DB,
+                                 "profile_ms": self.rec_cfg.PREROLL_MS or 500}
+        return options
+
+
+# --- steps: (data, rate, chain) -> (data, rate) ---
+
+def _filter(data: np.ndarray, rate: int, chain: Chain):
+    return filter_take(data, rate, chain.rec_cfg), rate
+
+
+def _trim(data: np.ndarray, rate: int, chain: Chain):
+    window = max(1, int(rate * TRIM_WINDOW_SEC))
+    frames = len(data) // window
+    if frames == 0:
+        return data, rate
+    mono = np.abs(data[:frames * window].reshape(frames, window, -1)).max(axis=(1, 2))
+    loud = np.flatnonzero(mono > 32768 * 10 ** (chain.trim_db / 20))
+    if len(loud) == 0:
+        # nothing above the threshold, leave it to the listener
+        return data, rate
+    pad = rate * chain.pad_ms // 1000
+    start = max(0, loud[0] * window - pad)
+    end = min(len(data), (loud[-1] + 1) * window + pad)
+    return data[start:end], rate
+
+
+def _normalize(data: np.ndarray, rate: int, chain: Chain):
+    # earlier steps may hand over float samples on the int16 scale
+    info = loudness.analyze(_to_int16(data), rate)
+    if not isfinite(info["integrated_lufs"]):
+        return data, rate
+    gain_db = min(chain.target_lufs - info["integrated_lufs"], chain.ceiling_db - info["peak_dbfs"])
+    return data * 10 ** (gain_db / 20), rate
+
+
+def _transcode(data: np.ndarray, rate: int, chain: Chain):
+    if chain.channels:
+        current = 1 if data.ndim == 1 else data.shape[1]
+        if chain.channels == 1 and current > 1:
+            data = data.mean(axis=1)
+        elif chain.channels > 1 and current != chain.channels:
+            mono = data if data.ndim == 1 else data.mean(axis=1)
+            data = np.repeat(mono[:, None], chain.channels, axis=1)
+    if chain.rate and chain.rate != rate:
+        div = gcd(chain.rate, rate)
+        data = resample_poly(data, chain.rate // div, rate // div, axis=0)
+        rate = chain.rate
+    return data, rate
+
+
+def _to_int16(data: np.ndarray) -> np.ndarray:
+    if data.dtype == np.int16:
+        return data
+    return np.clip(np.rint(data), -32768, 32767).astype(np.int16, order="C")
+
+
+STEPS = {"filter": _filter, "trim": _trim, "normalize": _normalize, "transcode": _transcode}
+
+
+def process_file(path: str, chain: Chain) -> dict:
+    """Runs the chain on one take and leaves the fsynced result in <path>.reprocess. Worker side."""
+    rate, data = wavfile.read(path, mmap=True)
+    before = len(data) / rate
+    for step in chain.steps:
+        data, rate = STEPS[step](data, rate, chain)
+    out = np.ascontiguousarray(_to_int16(data))
+    with open(path + TMP_SUFFIX, "wb") as f:
+        wavfile.write(f, rate, out)
+        f.flush()
+        os.fsync(f.fileno())
+    return {"before": round(before, 2), "after": round(len(out) / rate, 2),
+            "loudness": loudness.analyze(out, rate)}
+
+
+def _job(path: str, chain: Chain):
+    try:
+        return path, process_file(path, chain), None
+    except FileNotFoundError:
+        return path, None, "gone"
+    except (OSError, ValueError) as err:
+        try:
+            os.remove(path + TMP_SUFFIX)
+        except FileNotFoundError:
+            pass
+        return path, None, str(err)
+
+
+class Reprocessor:
+
+    def __init__(self, rec_path, chain: Chain, jobs: int | None = None):
+        self.rec_path = Path(rec_path)
+        self.chain = chain
+        self.jobs = jobs or os.cpu_count()
+        self.journal_path = self.rec_path / JOURNAL
+        self.started = time.time()
+        self.done: set[str] = set()
+        self.staged: set[str] = set()
+
+    def _append(self, entry: dict):
+        # one fsynced line per state change, it is the only record of a swap in progress
+        with open(self.journal_path, "a") as f:
+            f.write(json.dumps(entry) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _open_journal(self, restart: bool):
+        entries = []
+        if self.journal_path.exists() and not restart:
+            with open(self.journal_path) as f:
+                for line in f:
+                    try:
+                        entries.append(json.loads(line))
+                    except ValueError:
+                        # torn last line of a crash
+                        break
+        if not entries:
+            self.journal_path.unlink(missing_ok=True)
+            self._append({"steps": self.chain.steps, "options": self.chain.describe(), "started": self.started})
+            return
+
+        header = entries[0]
+        if header.get("steps") != self.chain.steps or header.get("options") != self.chain.describe():
+            raise ValueError(f"{self.journal_path} belongs to an unfinished run with a different chain "
+                             f"({', '.join(header.get('steps', []))}), rerun it or pass --restart")
+        self.started = header["started"]
+        for entry in entries[1:]:
+            if entry.get("state") == "staged":
+                self.staged.add(entry["name"])
+            elif entry.get("state") in ("done", "gone"):
+                self.done.add(entry["name"])
+        logger.info("Resuming run from %s, %d takes already done", time.ctime(self.started), len(self.done))
+
+    def _recover(self):
+        """Finishes swaps that were journaled but interrupted, drops unjournaled worker output."""
+        for name in sorted(self.staged - self.done):
+            wav = self.rec_path / name
+            tmp = wav.with_name(name + TMP_SUFFIX)
+            if tmp.exists():
+                os.replace(tmp, wav)
+            if not wav.exists():
+                self._append({"name": name, "state": "gone"})
+                continue
+            loudness.analyze_file(wav)
+            self._finish(name, None)
+        for tmp in self.rec_path.glob("*" + TMP_SUFFIX):
+            tmp.unlink()
+
+    def pending(self) -> list[str]:
+        wavs = []
+        for p in sorted(self.rec_path.iterdir()):
+            if not p.is_file() or p.suffix.lower() != ".wav" or p.name in self.done:
+                continue
+            # recorded after the run started, already with the current settings
+            if p.stat().st_mtime >= self.started:
+                continue
+            wavs.append(str(p))
+        return wavs
+
+    def _commit(self, path: str, result: dict):
+        name = os.path.basename(path)
+        self._append({"name": name, "state": "staged"})
+        os.replace(path + TMP_SUFFIX, path)
+        loudness.store(path, result["loudness"])
+        self._finish(name, result)
+
+    def _finish(self, name: str, result: dict | None):
+        sidecar.update(self.rec_path / name, SIDECAR_KEY,
+                       {"steps": self.chain.steps, "run": int(self.started), "at": int(time.time())})
+        self._append({"name": name, "state": "done"})
+        self.done.add(name)
+        if result is not None:
+            logger.info("%s: %.1fs -> %.1fs, %s LUFS", name, result["before"], result["after"],
+                        result["loudness"].get("integrated_lufs"))
+
+    def run(self, restart: bool = False) -> tuple[int, int]:
+        """Processes every pending take. Returns (done, failed)."""
+        self._open_journal(restart)
+        self._recover()
+        todo = self.pending()
+        logger.info("Reprocessing %d takes in %s with %s on %d workers",
+                    len(todo), self.rec_path, " -> ".join(self.chain.steps), self.jobs)
+
+        done = failed = 0
+        with ProcessPoolExecutor(max_workers=self.jobs) as pool:
+            futures = [pool.submit(_job, path, self.chain) for path in todo]
+            for future in as_completed(futures):
+                path, result, err = future.result()
+                if err == "gone":
+                    # deleted by the station during the run
+                    self._append({"name": os.path.basename(path), "state": "gone"})
+                elif err:
+                    logger.error("Failed %s: %s", path, err)
+                    self._append({"name": os.path.basename(path), "state": "failed", "error": err})
+                    failed += 1
+                else:
+                    self._commit(path, result)
+                    done += 1
+                if (done + failed) % 50 == 0:
+                    logger.info("Progress %d/%d", done + failed, len(todo))
+
+        if failed:
+            logger.warning("%d takes failed, run again to retry them", failed)
+        else:
+            # complete, the next run starts from scratch
+            self.journal_path.unlink()
+        logger.info("Reprocessing finished: %d done, %d failed", done, failed)
+        return done, failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Re-run a processing chain over all recordings.")
+    parser.add_argument("config", help="station yaml, for RECORDING_PATH, the filter and the loudness target")
+    parser.add_argument("--chain", required=True, help=f"comma separated steps out of {', '.join(STEPS)}")
+    parser.add_argument("--jobs", type=int, default=None, help="worker processes (default: all cores)")
+    parser.add_argument("--restart", action="store_true", help="discard the journal of an unfinished run")
+    parser.add_argument("--trim-db", type=float, default=-50.0)
+    parser.add_argument("--pad-ms", type=int, default=150)
+    parser.add_argument("--ceiling-db", type=float, default=-1.0)
+    parser.add_argument("--rate", type=int, default=None)
+    parser.add_argument("--channels", type=int, default=None)
+    args = parser.parse_args()
+
+    steps = [s.strip() for s in args.chain.split(",") if s.strip()]
+    if not steps or any(s not in STEPS for s in steps):
+        parser.error(f"--chain takes {', '.join(STEPS)}")
+    if "transcode" in steps and not (args.rate or args.channels):
+        parser.error("transcode needs --rate and/or --channels")
+
+    settings: Config = load_config(args.config)
+    if settings.rec_cfg.STORAGE == "segments":
+        # takes are rewritten in place, packed ones have no file of their own
+        parser.error(f"packed recordings cannot be reprocessed, run python src/segstore.py "
+                     f"{settings.rec_cfg.RECORDING_PATH} --unpack first and --pack afterwards")
+    log.setup_logging(LogConfig())
+    chain = Chain(steps, settings.rec_cfg, target_lufs=settings.ply_cfg.TARGET_LUFS or -20.0,
+                  ceiling_db=args.ceiling_db, trim_db=args.trim_db, pad_ms=args.pad_ms,
+                  rate=args.rate, channels=args.channels)
+    try:
+        idle_io_priority()
+        _, failed = Reprocessor(settings.rec_cfg.RECORDING_PATH, chain, args.jobs).run(args.restart)
+    except ValueError as err:
+        logger.error("%s", err)
+        failed = 1
+    finally:
+        log.shutdown_logging()
+    raise SystemExit(1 if failed else 0)
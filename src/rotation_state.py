@@ -0,0 +1,127 @@
+"""Where the rotation was, so a restart continues instead of starting over.
+
+The player appends one line per clip to a small journal,
+
+    {"p": "rec_a.wav", "n": "rec_b.wav", "i": 12, "q": 40}
+
+the clip just started (p, None for the question), the recording due next
+(n, at index i) and the question cadence counter (q). Lines are written
+without fsync, an fsync at most every SYNC_SEC bounds what a power cut can
+lose. Every COMPACT_LINES lines the journal is replaced by a single
+snapshot line that also carries the recent play history (h), so a restore
+never reads more than COMPACT_LINES + 1 lines however long the station ran.
+"""
+from collections import deque
+from pathlib import Path
+import json
+import os
+import threading
+import time
+import log
+
+logger = log.get_logger("rotation")
+
+COMPACT_LINES = 256
+HISTORY = 32
+SYNC_SEC = 60.0
+
+
+class RotationState:
+
+    def __init__(self, path, sync_sec: float = SYNC_SEC):
+        self.path = Path(path)
+        self.sync_sec = sync_sec
+        self.next_name: str | None = None
+        self.next_idx = 0
+        self.question_counter = 0
+        self.history: deque[str] = deque(maxlen=HISTORY)
+        self._lines = 0
+        self._synced = time.monotonic()
+        self._file = None
+        self._lock = threading.Lock()
+
+    def load(self) -> bool:
+        """Replays the journal. False if there was none."""
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # torn or unsynced last line of a power cut
+                        break
+                    self._apply(entry)
+                    self._lines += 1
+        except FileNotFoundError:
+            return False
+        return True
+
+    def _apply(self, entry: dict):
+        if "h" in entry:
+            self.history.clear()
+            self.history.extend(entry["h"])
+        if entry.get("p"):
+            self.history.append(entry["p"])
+        self.next_name = entry.get("n")
+        self.next_idx = entry.get("i", 0)
+        self.question_counter = entry.get("q", 0)
+
+    def position(self, buffer: list) -> int:
+        """Index of the clip to continue with in the current buffer."""
+        names = [Path(p).name for p in buffer]
+        if not names:
+            return 0
+        # the archive did not change since: no search
+        if 0 <= self.next_idx < len(names) and names[self.next_idx] == self.next_name:
+            return self.next_idx
+        if self.next_name in names:
+            return names.index(self.next_name)
+        # the next take is gone, continue after the most recent one that is still there
+        for played in reversed(self.history):
+            if played in names:
+                return (names.index(played) + 1) % len(names)
+        return 0
+
+    def played(self, played: str | None, next_name: str | None, next_idx: int, question_counter: int):
+        """Records one clip start. Called from the player thread."""
+        entry = {"p": played, "n": next_name, "i": next_idx, "q": question_counter}
+        with self._lock:
+            self._apply(entry)
+            try:
+                if self._lines >= COMPACT_LINES:
+                    self._compact()
+                    return
+                if self._file is None:
+                    self._file = open(self.path, "a")
+                self._file.write(json.dumps(entry) + "\n")
+                self._file.flush()
+                self._lines += 1
+                if time.monotonic() - self._synced >= self.sync_sec:
+                    os.fsync(self._file.fileno())
+                    self._synced = time.monotonic()
+            except OSError as err:
+                # losing the position is no reason to stop playing
+                logger.warning("Could not write the rotation state: %s", err)
+
+    def _compact(self):
+        snapshot = {"p": None, "n": self.next_name, "i": self.next_idx, "q": self.question_counter,
+                    "h": list(self.history)}
+        tmp = self.path.with_suffix(".tmp")
+        with open(tmp, "w") as f:
+            f.write(json.dumps(snapshot) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._lines = 1
+        self._synced = time.monotonic()
+
+    def close(self):
+        """Leaves a single fsynced snapshot."""
+        with self._lock:
+            try:
+                self._compact()
+            except OSError as err:
+                logger.warning("Could not write the rotation state: %s", err)
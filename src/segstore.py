@@ -0,0 +1,560 @@
+"""Packed storage of the archive: takes appended to a few large segment files instead of one file each.
+
+With recording_config STORAGE: segments, a confirmed take is appended whole
+(header included, byte for byte) to the open segment in
+<RECORDING_PATH>/segments, seg_000001.bin, seg_000002.bin, ... each up to
+SEGMENT_MB. The journal next to them (index.jsonl, one fsynced line per
+change) is the offset index and holds what would be the take's sidecar:
+
+    {"op": "add", "name": "rec_x.wav", "seg": 3, "offset": 1048576, "size": 882044, "data": 44, ...}
+    {"op": "meta", "name": "rec_x.wav", "key": "loudness", "value": {...}}
+    {"op": "del", "name": "rec_x.wav"}
+
+A packed take keeps its path, RECORDING_PATH/<name>, everywhere in the
+station. read_wav(), open_clip() and the sidecar module resolve it to a memory
+mapped slice or a byte range of its segment, so startup reads one journal
+instead of scanning tens of thousands of files. A delete only writes a
+journal line. Once a full segment is more than COMPACT_RATIO dead, its live
+takes are copied to the open segment, the journal is rewritten and the old
+segment removed.
+
+Metadata changed by a tool while the station runs (archive_sync, upload --all,
+loudness) is appended to the journal too. Every process appends and rewrites
+the journal under an flock on segments/index.lock and first replays what the
+others appended since it last read it, so a compaction or a startup rewrite
+never drops a tool's line and the station picks it up with its next write.
+
+    python src/segstore.py recordings                     # segments, live and dead bytes
+    python src/segstore.py recordings --pack              # move the loose wavs (and their json) into segments
+    python src/segstore.py recordings --export out/ [names...]
+    python src/segstore.py recordings --unpack            # back to one file per take
+    python src/segstore.py recordings --compact
+"""
+from contextlib import contextmanager
+from pathlib import Path
+import argparse
+import fcntl
+import json
+import os
+import threading
+import numpy as np
+from scipy.io import wavfile
+import wavio
+import log
+
+logger = log.get_logger("segstore")
+
+SEGMENT_DIR = "segments"
+INDEX_FILE = "index.jsonl"
+# flocked around every journal write, the journal itself is replaced by rewrites
+LOCK_FILE = "index.lock"
+# takes start on this boundary, so the samples of every take are aligned
+ALIGN = 16
+CHUNK = 8 * 1024 * 1024
+# the journal is rewritten at startup once it has this many lines more than there are takes
+REWRITE_SLACK = 256
+DTYPES = {1: np.dtype("u1"), 2: np.dtype("<i2"), 4: np.dtype("<i4")}
+
+
+def _copy(src, src_offset: int, dst, size: int):
+    """size bytes from src_offset of src to the current position of dst."""
+    while size > 0:
+        data = os.pread(src.fileno(), min(CHUNK, size), src_offset)
+        if not data:
+            raise OSError(f"short read at {src_offset} of {src.name}")
+        dst.write(data)
+        src_offset += len(data)
+        size -= len(data)
+
+
+class SegmentStore:
+
+    def __init__(self, rec_path, segment_mb: int = 256, compact_ratio: float = 0.5):
+        self.rec_path = Path(rec_path)
+        self.root = self.rec_path / SEGMENT_DIR
+        self.index_path = self.root / INDEX_FILE
+        self.lock_path = self.root / LOCK_FILE
+        self.segment_bytes = segment_mb * 2**20
+        self.compact_ratio = compact_ratio
+        self.entries: dict[str, dict] = {}
+        self._lines = 0
+        # bytes of the journal replayed into entries, lines past it were appended by another process;
+        # a journal with another inode was rewritten by the station and is replayed from the start
+        self._offset = 0
+        self._inode = None
+        # the segment new takes are appended to, 0 before the first
+        self._tail = 0
+        # index and journal; appends to a segment and compaction also hold _write_lock, always taken first
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.entries
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def names(self) -> list[str]:
+        return sorted(self.entries)
+
+    def segment_path(self, seg: int) -> Path:
+        return self.root / f"seg_{seg:06d}.bin"
+
+    def _segments(self) -> dict[int, Path]:
+        found = {}
+        for path in self.root.glob("seg_*.bin"):
+            if path.stem[4:].isdigit():
+                found[int(path.stem[4:])] = path
+        return found
+
+    # --- index ---
+
+    def open(self, repair: bool = True) -> "SegmentStore":
+        """Reads the journal. repair is for the owner only, never for a reader next to a running
+        station: it cuts off torn appends, removes segments without live takes and rewrites the journal."""
+        if repair:
+            self.root.mkdir(parents=True, exist_ok=True)
+        with self._lock:
+            self._inode = None
+            torn = self._replay()
+            if repair:
+                dropped = self._repair()
+                if torn or dropped or self._lines > len(self.entries) + REWRITE_SLACK:
+                    self._rewrite_index()
+        return self
+
+    @contextmanager
+    def _journal_lock(self):
+        """Exclusive against the journal writes of other processes (tools next to the station)."""
+        with open(self.lock_path, "a") as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def _replay(self) -> bool:
+        """Applies the journal from _offset on to entries. True if it holds a torn line."""
+        torn = False
+        try:
+            with open(self.index_path, "rb") as f:
+                inode = os.fstat(f.fileno()).st_ino
+                if inode != self._inode:
+                    self.entries, self._lines, self._offset, self._inode = {}, 0, 0, inode
+                f.seek(self._offset)
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        # an append cut short, possibly still being written, left for later
+                        return True
+                    self._offset += len(line)
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # the rest of a torn append, a later append starts on a new line
+                        torn = True
+                        continue
+                    self._lines += 1
+                    op, name = entry.pop("op", None), entry.pop("name", None)
+                    if op == "add":
+                        self.entries[name] = entry
+                    elif op == "meta" and name in self.entries:
+                        self.entries[name]["meta"][entry["key"]] = entry["value"]
+                    elif op == "del":
+                        self.entries.pop(name, None)
+        except FileNotFoundError:
+            pass
+        return torn
+
+    def _repair(self) -> int:
+        """Makes the segments match the journal. Returns the number of takes lost."""
+        segments = self._segments()
+        sizes = {seg: path.stat().st_size for seg, path in segments.items()}
+        ends: dict[int, int] = {}
+        lost = 0
+        for name, entry in list(self.entries.items()):
+            end = entry["offset"] + entry["size"]
+            if sizes.get(entry["seg"], 0) < end:
+                logger.error("Packed take %s is missing from segment %d, dropped", name, entry["seg"])
+                del self.entries[name]
+                lost += 1
+                continue
+            ends[entry["seg"]] = max(ends.get(entry["seg"], 0), end)
+        for seg, path in segments.items():
+            if seg not in ends:
+                # emptied by deletes, or written by a compaction that never reached the journal
+                path.unlink()
+            elif sizes[seg] > ends[seg]:
+                # an append or a compaction cut short, nothing in the journal points there
+                os.truncate(path, ends[seg])
+        self._tail = max(ends, default=0)
+        return lost
+
+    def _journal(self, entry: dict):
+        # fsynced, the journal is the only record of where a take is
+        with self._journal_lock():
+            self._replay()
+            with open(self.index_path, "ab") as f:
+                # behind a torn append, the new line must not be glued to it
+                if f.tell() != self._offset:
+                    f.write(b"\n")
+                f.write(json.dumps(entry).encode() + b"\n")
+                f.flush()
+                os.fsync(f.fileno())
+                self._offset = f.tell()
+                self._inode = os.fstat(f.fileno()).st_ino
+        self._lines += 1
+
+    def _rewrite_index(self):
+        tmp = self.index_path.with_suffix(".jsonl.tmp")
+        # what other processes appended goes into the rewrite, not away with the old journal
+        with self._journal_lock():
+            self._replay()
+            with open(tmp, "wb") as f:
+                for name, entry in self.entries.items():
+                    f.write(json.dumps({"op": "add", "name": name, **entry}).encode() + b"\n")
+                f.flush()
+                os.fsync(f.fileno())
+                self._offset = f.tell()
+                self._inode = os.fstat(f.fileno()).st_ino
+            os.replace(tmp, self.index_path)
+        self._lines = len(self.entries)
+
+    # --- writing ---
+
+    def _append_target(self, size: int) -> tuple[int, int]:
+        """(segment, offset) for size bytes, a new segment once the open one is full."""
+        if self._tail:
+            try:
+                length = self.segment_path(self._tail).stat().st_size
+            except FileNotFoundError:
+                length = 0
+            offset = -(-length // ALIGN) * ALIGN
+            if length == 0 or offset + size <= self.segment_bytes:
+                return self._tail, offset
+        self._tail += 1
+        return self._tail, 0
+
+    def _write(self, src, src_offset: int, size: int) -> tuple[int, int]:
+        seg, offset = self._append_target(size)
+        with open(self.segment_path(seg), "ab") as dst:
+            dst.write(b"\0" * (offset - dst.tell()))
+            _copy(src, src_offset, dst, size)
+            dst.flush()
+            os.fsync(dst.fileno())
+        return seg, offset
+
+    def add_file(self, path, meta: dict | None = None) -> str:
+        """Appends a wav as it is, under its file name. The file itself is left alone."""
+        name = os.path.basename(path)
+        with open(path, "rb") as src:
+            info = wavio.read_header(src)
+            if info is None:
+                raise ValueError(f"{path} is not a usable wav")
+            st = os.fstat(src.fileno())
+            data_bytes = min(info.data_size, st.st_size - info.data_offset)
+            entry = {"size": st.st_size, "data": info.data_offset,
+                     "bytes": data_bytes - data_bytes % info.block_align,
+                     "rate": info.rate, "channels": info.channels, "width": info.sampwidth,
+                     "mtime": st.st_mtime, "meta": meta or {}}
+            with self._write_lock:
+                entry["seg"], entry["offset"] = self._write(src, 0, st.st_size)
+                with self._lock:
+                    self._journal({"op": "add", "name": name, **entry})
+                    self.entries[name] = entry
+        return name
+
+    def update_meta(self, name: str, key: str, value) -> bool:
+        with self._lock:
+            entry = self.entries.get(name)
+            if entry is None:
+                return False
+            # journaled first: the replay of a rewritten journal starts entries over
+            self._journal({"op": "meta", "name": name, "key": key, "value": value})
+            if name in self.entries:
+                self.entries[name]["meta"][key] = value
+        return True
+
+    def delete(self, name: str) -> bool:
+        """Only a journal line, the bytes are reclaimed by compact()."""
+        with self._lock:
+            if name not in self.entries:
+                return False
+            self._journal({"op": "del", "name": name})
+            self.entries.pop(name, None)
+        return True
+
+    def clear(self):
+        with self._write_lock, self._lock:
+            for path in self._segments().values():
+                path.unlink()
+            self.index_path.unlink(missing_ok=True)
+            self.entries, self._lines, self._tail, self._offset, self._inode = {}, 0, 0, 0, None
+
+    # --- reading ---
+
+    def _entry(self, name: str) -> dict:
+        entry = self.entries.get(name)
+        if entry is None:
+            raise FileNotFoundError(f"{name} is not in {self.root}")
+        return entry
+
+    def meta(self, name: str) -> dict | None:
+        entry = self.entries.get(name)
+        return None if entry is None else entry["meta"]
+
+    def locate(self, name: str) -> tuple[Path, int, int]:
+        """(segment, offset, size) of the take's wav bytes."""
+        entry = self._entry(name)
+        return self.segment_path(entry["seg"]), entry["offset"], entry["size"]
+
+    def read(self, name: str) -> tuple[int, np.ndarray]:
+        """(rate, data) like wavfile.read, the samples memory mapped from the segment."""
+        entry = self._entry(name)
+        dtype = DTYPES.get(entry["width"])
+        if dtype is None:
+            raise ValueError(f"{name}: {entry['width'] * 8} bit samples are not supported")
+        frames = entry["bytes"] // (entry["width"] * entry["channels"])
+        shape = (frames,) if entry["channels"] == 1 else (frames, entry["channels"])
+        if frames == 0:
+            return entry["rate"], np.zeros(shape, dtype)
+        data = np.memmap(self.segment_path(entry["seg"]), dtype=dtype, mode="r",
+                         offset=entry["offset"] + entry["data"], shape=shape)
+        return entry["rate"], data
+
+    def export(self, name: str, dest_dir, with_meta: bool = False) -> Path | None:
+        """Writes the take as a plain wav (and its json sidecar) to dest_dir. None if it is not in the store."""
+        # _write_lock first, as in compact(): its segment is not unlinked before the copy is done,
+        # and one snapshot of the entry, a delete meanwhile does not tear the export
+        with self._write_lock:
+            with self._lock:
+                entry = self.entries.get(name)
+            if entry is None:
+                return None
+            dest = Path(dest_dir) / name
+            part = dest.with_name(dest.name + wavio.PART_SUFFIX)
+            with open(self.segment_path(entry["seg"]), "rb") as src, open(part, "wb") as dst:
+                _copy(src, entry["offset"], dst, entry["size"])
+                dst.flush()
+                os.fsync(dst.fileno())
+        os.replace(part, dest)
+        os.utime(dest, (entry["mtime"],) * 2)
+        meta = entry["meta"]
+        if with_meta and meta:
+            # the sidecar layout of sidecar.py
+            with open(dest.with_suffix(".json"), "w") as f:
+                json.dump(meta, f)
+        return dest
+
+    # --- compaction ---
+
+    def usage(self) -> dict[int, tuple[int, int]]:
+        """Per segment: (bytes of live takes, length)."""
+        live: dict[int, int] = {}
+        for entry in list(self.entries.values()):
+            live[entry["seg"]] = live.get(entry["seg"], 0) + entry["size"]
+        return {seg: (live.get(seg, 0), path.stat().st_size) for seg, path in sorted(self._segments().items())}
+
+    def _victims(self, usage: dict, ratio: float) -> list[int]:
+        # the open segment is still filling up
+        return [seg for seg, (live, length) in usage.items()
+                if seg != self._tail and length > live and (length - live) / length >= ratio]
+
+    def needs_compaction(self) -> bool:
+        return bool(self._victims(self.usage(), self.compact_ratio))
+
+    def compact(self, ratio: float | None = None) -> int:
+        """Moves the live takes out of segments that are at least ratio dead. Returns the bytes freed.
+
+        Readers that have a take mapped or open keep the old segment until they let go of it.
+        """
+        ratio = self.compact_ratio if ratio is None else ratio
+        with self._write_lock:
+            usage = self.usage()
+            victims = self._victims(usage, ratio)
+            if not victims:
+                return 0
+            moving = sorted(((name, entry) for name, entry in list(self.entries.items()) if entry["seg"] in victims),
+                            key=lambda item: (item[1]["seg"], item[1]["offset"]))
+            moved = []
+            for name, entry in moving:
+                with open(self.segment_path(entry["seg"]), "rb") as src:
+                    moved.append((name, entry, self._write(src, entry["offset"], entry["size"])))
+            with self._lock:
+                for name, entry, (seg, offset) in moved:
+                    # deleted meanwhile: the copy is dead already
+                    if self.entries.get(name) is entry:
+                        self.entries[name] = dict(entry, seg=seg, offset=offset)
+                self._rewrite_index()
+            for seg in victims:
+                self.segment_path(seg).unlink()
+        freed = sum(length - live for seg, (live, length) in usage.items() if seg in victims)
+        logger.info("Compacted %d segments, %d takes moved, %.1f MB freed",
+                    len(victims), len(moved), freed / 2**20)
+        return freed
+
+
+# --- the stores of this process, by RECORDING_PATH; packed takes are found by their path ---
+
+_stores: dict[str, SegmentStore] = {}
+
+
+def _key(path) -> str:
+    return os.path.normpath(os.path.abspath(path))
+
+
+def attach(store: SegmentStore):
+    _stores[_key(store.rec_path)] = store
+
+
+def detach(store: SegmentStore):
+    if _stores.get(_key(store.rec_path)) is store:
+        del _stores[_key(store.rec_path)]
+
+
+def open_existing(rec_path) -> SegmentStore | None:
+    """The store of rec_path, if it has one: the attached one, or its journal read (without repair) and attached."""
+    store = _stores.get(_key(rec_path))
+    if store is None and (Path(rec_path) / SEGMENT_DIR / INDEX_FILE).exists():
+        store = SegmentStore(rec_path).open(repair=False)
+        attach(store)
+    return store
+
+
+def packed(path) -> tuple[SegmentStore, str] | None:
+    """(store, name) if path is a packed take."""
+    if not _stores:
+        return None
+    path = os.fspath(path)
+    store = _stores.get(_key(os.path.dirname(path)))
+    name = os.path.basename(path)
+    if store is not None and name in store:
+        return store, name
+    return None
+
+
+def exists(path) -> bool:
+    return packed(path) is not None or os.path.exists(path)
+
+
+def read_wav(path) -> tuple[int, np.ndarray]:
+    """(rate, data) like wavfile.read, memory mapped where possible."""
+    found = packed(path)
+    if found is not None:
+        return found[0].read(found[1])
+    try:
+        rate, data = wavfile.read(path, mmap=True)
+    except ValueError:
+        # a data size past the end of the file, or a format mmap cannot map
+        if wavio.repair_damaged(path):
+            return wavfile.read(path, mmap=True)
+        return wavfile.read(path)
+    # a data size of 0 reads as an empty take
+    if len(data) == 0 and wavio.repair_damaged(path):
+        return wavfile.read(path, mmap=True)
+    return rate, data
+
+
+def read_clip(path) -> wavio.PcmBuffer:
+    rate, data = read_wav(path)
+    return wavio.PcmBuffer(str(path), rate, data)
+
+
+@contextmanager
+def open_clip(path):
+    """(file, offset, size) of the take's wav bytes, for sendfile and copies."""
+    found = packed(path)
+    if found is None:
+        with open(path, "rb") as f:
+            yield f, 0, os.fstat(f.fileno()).st_size
+        return
+    segment, offset, size = found[0].locate(found[1])
+    with open(segment, "rb") as f:
+        yield f, offset, size
+
+
+def clip_stat(path) -> tuple[int, float]:
+    """(size, mtime) of a take, raises OSError if there is none."""
+    found = packed(path)
+    if found is None:
+        st = os.stat(path)
+        return st.st_size, st.st_mtime
+    entry = found[0]._entry(found[1])
+    return entry["size"], entry["mtime"]
+
+
+def meta(path) -> dict | None:
+    found = packed(path)
+    return None if found is None else found[0].meta(found[1])
+
+
+def update_meta(path, key: str, value) -> bool:
+    found = packed(path)
+    return found is not None and found[0].update_meta(found[1], key, value)
+
+
+def wav_paths(rec_path) -> list[Path]:
+    """The loose wavs and the packed takes of an archive, sorted. Empty if there is no archive (yet)."""
+    rec_path = Path(rec_path)
+    store = open_existing(rec_path)
+    names = set(store.names()) if store is not None else set()
+    try:
+        loose = [p for p in rec_path.iterdir() if p.is_file() and p.suffix.lower() == ".wav" and p.name not in names]
+    except FileNotFoundError:
+        loose = []
+    return sorted(loose + [rec_path / name for name in names])
+
+
+def pack(store: SegmentStore, paths: list) -> int:
+    """Moves wav files (and their json sidecars) into the store. Returns the number packed."""
+    done = 0
+    for path in paths:
+        path = Path(path)
+        try:
+            with open(path.with_suffix(".json")) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            meta = {}
+        try:
+            store.add_file(path, meta)
+        except (OSError, ValueError) as err:
+            logger.error("Could not pack %s: %s", path, err)
+            continue
+        path.unlink()
+        path.with_suffix(".json").unlink(missing_ok=True)
+        done += 1
+    return done
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect and maintain the packed recording store. "
+                                                 "Stop the station for --pack, --unpack and --compact.")
+    parser.add_argument("recording_path")
+    parser.add_argument("--segment-mb", type=int, default=256)
+    action = parser.add_mutually_exclusive_group()
+    action.add_argument("--pack", action="store_true", help="move the loose wavs into segments")
+    action.add_argument("--unpack", action="store_true", help="export every take with its json and empty the store")
+    action.add_argument("--export", metavar="DIR", help="write takes as plain wavs to DIR")
+    action.add_argument("--compact", action="store_true", help="reclaim the space of deleted takes")
+    parser.add_argument("--ratio", type=float, default=0.5, help="with --compact: share of a segment that must be dead")
+    parser.add_argument("names", nargs="*", help="with --export: only these takes")
+    args = parser.parse_intermixed_args()
+
+    store = SegmentStore(args.recording_path, args.segment_mb).open(repair=args.pack or args.unpack or args.compact)
+    if args.pack:
+        loose = sorted(p for p in Path(args.recording_path).iterdir() if p.is_file() and p.suffix.lower() == ".wav")
+        print(f"Packed {pack(store, loose)} of {len(loose)} recordings")
+    elif args.unpack:
+        unpacked = [name for name in store.names() if store.export(name, args.recording_path, with_meta=True)]
+        print(f"Unpacked {len(unpacked)} recordings")
+        store.clear()
+    elif args.export:
+        os.makedirs(args.export, exist_ok=True)
+        names = args.names or store.names()
+        for name in names:
+            print(store.export(name, args.export) or f"{name}: not in the store")
+    elif args.compact:
+        print(f"{store.compact(args.ratio) / 2**20:.1f} MB freed")
+    usage = store.usage()
+    for seg, (live, length) in usage.items():
+        print(f"  {store.segment_path(seg).name}  {length / 2**20:8.1f} MB  {live / max(1, length):6.1%} live")
+    print(f"{len(store)} takes in {len(usage)} segments")
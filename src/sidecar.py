@@ -0,0 +1,42 @@
+import json
+import os
+from pathlib import Path
+import segstore
+
+# per-recording metadata lives next to the take: rec_x.wav -> rec_x.json,
+# a take packed into segments keeps it in the segment index instead
+
+
+def sidecar_path(wav_path) -> Path:
+    return Path(wav_path).with_suffix(".json")
+
+
+def read(wav_path) -> dict:
+    packed = segstore.meta(wav_path)
+    if packed is not None:
+        return dict(packed)
+    try:
+        with open(sidecar_path(wav_path)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def update(wav_path, key: str, value):
+    """Sets one section of the sidecar, written to a temp file and renamed atomically."""
+    if segstore.update_meta(wav_path, key, value):
+        return
+    path = sidecar_path(wav_path)
+    meta = read(wav_path)
+    meta[key] = value
+    tmp = path.with_suffix(".json.tmp")
+    with open(tmp, "w") as f:
+        json.dump(meta, f)
+    os.replace(tmp, path)
+
+
+def remove(wav_path):
+    try:
+        os.remove(sidecar_path(wav_path))
+    except FileNotFoundError:
+        pass
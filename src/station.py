@@ -0,0 +1,360 @@
+"""The station's interaction lifecycle as one state machine.
+
+Button edges, timers and finished work are events in one queue, handled by a
+single actor task on the event loop. Only the actor changes the state, pauses
+or resumes the rotation and starts or stops the confirmation loop, the other
+components no longer keep flags about each other.
+
+    idle --hold--> recording --release--> processing --take ready--> confirming
+      ^  (tap = skip)                          |                      |    |
+      |                                  too short / failed     hold 2.8 s  tap
+      |                                        v                      v    v
+      +--------------------------------------- + ---------------- saving  deleting
+
+Actions that take time (capture, filtering, saving) run as tasks one after
+another and post their result as the next event, so the actor keeps handling
+edges meanwhile and an edge no state expects is simply dropped. Every
+transition is timed, transient states fall back to idle after a timeout.
+"""
+from collections import defaultdict
+from dataclasses import dataclass
+import asyncio
+import inspect
+from typing import TYPE_CHECKING
+import eventlog
+import log
+
+logger = log.get_logger("station")
+
+if TYPE_CHECKING:
+    from cmd_typing import CmdTyping
+
+# states
+IDLE = "idle"
+RECORDING = "recording"
+PROCESSING = "processing"
+CONFIRMING = "confirming"
+SAVING = "saving"
+DELETING = "deleting"
+ANY = "*"
+
+# events
+PRESS = "press"
+RELEASE = "release"
+HOLD = "hold"
+TAKE_READY = "take_ready"
+TAKE_DISCARDED = "take_discarded"
+DONE = "done"
+RESET = "reset"
+FAILED = "failed"
+TIMEOUT = "timeout"
+
+# a press longer than this records instead of skipping
+HOLD_SEC = 0.15
+# confirming: hold this long to save (LED turns green a bit earlier), tap shorter than DELETE_TAP_SEC to delete
+SAVE_HOLD_SEC = 2.8
+CONFIRM_LED_SEC = 2.5
+DELETE_TAP_SEC = 0.23
+# after saving or deleting, before the rotation continues
+OUTRO_SEC = 2.0
+# transient states that never wait for the visitor
+TIMEOUTS = {PROCESSING: 120.0, SAVING: 30.0, DELETING: 30.0}
+
+
+@dataclass(frozen=True)
+class Transition:
+    source: str
+    event: str
+    target: str | None          # None stays in the current state
+    action: str | None = None
+    guard: str | None = None    # the first row whose guard passes wins
+
+
+TRANSITIONS = (
+    Transition(IDLE,       PRESS,          IDLE,       "_arm_hold"),
+    Transition(IDLE,       RELEASE,        IDLE,       "_skip",               guard="_hold_armed"),
+    Transition(IDLE,       HOLD,           RECORDING,  "_start_recording",    guard="_hold_armed"),
+    Transition(RECORDING,  RELEASE,        PROCESSING, "_stop_recording"),
+    Transition(PROCESSING, TAKE_READY,     CONFIRMING, "_start_confirmation"),
+    Transition(PROCESSING, TAKE_DISCARDED, IDLE,       "_resume_rotation"),
+    Transition(CONFIRMING, PRESS,          CONFIRMING, "_confirm_press"),
+    Transition(CONFIRMING, RELEASE,        SAVING,     "_save",               guard="_held_to_save"),
+    Transition(CONFIRMING, RELEASE,        DELETING,   "_delete",             guard="_tapped_to_delete"),
+    Transition(CONFIRMING, RELEASE,        CONFIRMING, "_ignore_press"),
+    Transition(SAVING,     DONE,           IDLE,       "_resume_rotation"),
+    Transition(DELETING,   DONE,           IDLE,       "_resume_rotation"),
+    Transition(ANY,        TIMEOUT,        IDLE,       "_recover",            guard="_timeout_current"),
+    Transition(ANY,        FAILED,         IDLE,       "_recover"),
+    Transition(ANY,        RESET,          None,       "_reset"),
+)
+
+
+class Station:
+
+    def __init__(self, event_loop: asyncio.AbstractEventLoop, transitions=TRANSITIONS):
+        self.event_loop = event_loop
+        self.state = IDLE
+        self._table: dict[tuple, list[Transition]] = defaultdict(list)
+        for t in transitions:
+            for name in (t.action, t.guard):
+                if name is not None and not callable(getattr(self, name, None)):
+                    raise ValueError(f"transition {t} refers to unknown method {name}")
+            self._table[(t.source, t.event)].append(t)
+
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._task: asyncio.Task | None = None
+        # the running chain of actions, each one waits for the previous
+        self._work: asyncio.Task | None = None
+        self._entered = event_loop.time()
+        self._generation = 0
+        self._timeout: asyncio.TimerHandle | None = None
+        # (source, event, target) -> [count, total sec in source, max sec in source]
+        self.timings: dict[tuple, list] = defaultdict(lambda: [0, 0.0, 0.0])
+
+        self._hold_timer: asyncio.TimerHandle | None = None
+        # idle press and take start, for the durations in the event log
+        self._idle_press_at = 0.0
+        self._recording_at = 0.0
+        self._press_at: float | None = None
+        self._press_task: asyncio.Task | None = None
+        self._hold_sfx = None
+        self._led_task: asyncio.Task | None = None
+        self._green_timer: asyncio.TimerHandle | None = None
+        self.cmd: "CmdTyping | None" = None
+
+    def inject_cmd(self, cmd: "CmdTyping"):
+        self.cmd = cmd
+
+    def start(self):
+        self._task = self.event_loop.create_task(self._run())
+
+    def stop(self):
+        for task in (self._task, self._work, self._press_task):
+            if task is not None:
+                task.cancel()
+
+    # --- events ---
+
+    def post(self, event: str, payload=None):
+        """Queues an event, safe from any thread. The time is taken here, at the edge."""
+        self.event_loop.call_soon_threadsafe(self._queue.put_nowait, (event, payload, self.event_loop.time()))
+
+    async def _run(self):
+        while True:
+            event, payload, at = await self._queue.get()
+            try:
+                self._dispatch(event, payload, at)
+            except Exception as err:
+                logger.exception("Error handling %s in %s: %s", event, self.state, err)
+                self.post(FAILED)
+
+    def _dispatch(self, event: str, payload, at: float):
+        for t in self._table.get((self.state, event), []) + self._table.get((ANY, event), []):
+            if t.guard is None or getattr(self, t.guard)(payload, at):
+                break
+        else:
+            logger.debug("Dropped %s in %s", event, self.state)
+            return
+
+        if t.target is not None and t.target != self.state:
+            self._enter(t.target, event)
+        if t.action is None:
+            return
+        result = getattr(self, t.action)(payload, at)
+        if inspect.iscoroutine(result):
+            self._work = self.event_loop.create_task(self._chain(result, t.action, self._work))
+
+    def _enter(self, target: str, event: str):
+        now = self.event_loop.time()
+        spent = now - self._entered
+        stats = self.timings[(self.state, event, target)]
+        stats[0] += 1
+        stats[1] += spent
+        stats[2] = max(stats[2], spent)
+        logger.debug("%s -> %s on %s after %.0f ms", self.state, target, event, spent * 1000)
+
+        self.state = target
+        self._entered = now
+        self._generation += 1
+        if self._timeout is not None:
+            self._timeout.cancel()
+            self._timeout = None
+        if target in TIMEOUTS:
+            self._timeout = self.event_loop.call_later(TIMEOUTS[target], self.post, TIMEOUT, self._generation)
+
+    async def _chain(self, coro, name: str, previous: asyncio.Task | None):
+        """Runs one action after the previous one, its return value is the next event."""
+        if previous is not None and not previous.done():
+            await asyncio.wait([previous])
+        started = self.event_loop.time()
+        try:
+            result = await coro
+        except asyncio.CancelledError:
+            raise
+        except Exception as err:
+            logger.exception("Error in %s: %s", name, err)
+            self.post(FAILED)
+            return
+        logger.debug("%s took %.0f ms", name, (self.event_loop.time() - started) * 1000)
+        if isinstance(result, tuple):
+            self.post(*result)
+        elif result is not None:
+            self.post(result)
+
+    def summary(self) -> str:
+        return ", ".join(f"{src}->{dst} on {ev}: n={n} mean={total / n * 1000:.0f}ms max={peak * 1000:.0f}ms"
+                         for (src, ev, dst), (n, total, peak) in sorted(self.timings.items()))
+
+    # --- guards ---
+
+    def _hold_armed(self, payload, at) -> bool:
+        return self._hold_timer is not None
+
+    def _held_to_save(self, payload, at) -> bool:
+        return self._press_at is not None and at - self._press_at >= SAVE_HOLD_SEC
+
+    def _tapped_to_delete(self, payload, at) -> bool:
+        return self._press_at is not None and at - self._press_at <= DELETE_TAP_SEC
+
+    def _timeout_current(self, generation, at) -> bool:
+        # a timeout armed for an earlier visit of the state is stale
+        return generation == self._generation
+
+    # --- idle rotation ---
+
+    def _arm_hold(self, payload, at):
+        self.cmd.led.led_off()
+        self._cancel_hold()
+        self._idle_press_at = at
+        self._hold_timer = self.event_loop.call_at(at + HOLD_SEC, self.post, HOLD)
+
+    def _cancel_hold(self):
+        if self._hold_timer is not None:
+            self._hold_timer.cancel()
+            self._hold_timer = None
+
+    def _skip(self, payload, at):
+        self._cancel_hold()
+        self.cmd.events.record(eventlog.PRESS, dur=at - self._idle_press_at)
+        self.cmd.player.skip()
+
+    def _resume_rotation(self, payload, at):
+        self.cmd.player.resume()
+
+    # --- recording ---
+
+    def _start_recording(self, payload, at):
+        self._hold_timer = None
+        self._recording_at = at
+        self.cmd.events.record(eventlog.RECORD_START)
+        self.cmd.player.pause()
+        return self.cmd.recorder.start_recording()
+
+    def _stop_recording(self, payload, at):
+        return self._finish_take(at - self._recording_at)
+
+    async def _finish_take(self, held: float):
+        take = await self.cmd.recorder.stop_recording()
+        if take is None:
+            self.cmd.events.record(eventlog.DISCARDED, dur=held)
+            return TAKE_DISCARDED
+        self.cmd.events.record(eventlog.TAKE, self.cmd.recorder.get_current_recording(), held)
+        return TAKE_READY, take
+
+    # --- confirming ---
+
+    def _start_confirmation(self, take, at):
+        logger.debug("Start confirmation phase")
+        # the filtered take is still in memory, the confirmation loop replays it from there
+        self.cmd.player.start_confirmation(self.cmd.recorder.get_current_recording(), take)
+
+    def _confirm_press(self, payload, at):
+        self._end_confirm_press()
+        self._press_at = at
+        self.cmd.led.led_off()
+        self._led_task = self.cmd.led.start_confirm_led_seq(SAVE_HOLD_SEC)
+        self._green_timer = self.event_loop.call_at(at + CONFIRM_LED_SEC, self.cmd.led.led_on, (0, 20, 0))
+        self._press_task = self.event_loop.create_task(self._hold_sound())
+
+    async def _hold_sound(self):
+        self._hold_sfx = await self.cmd.player.playback_hold_confirm()
+
+    def _end_confirm_press(self):
+        """Undoes the feedback of a confirm press: sound, LED sequence and the held confirmation loop."""
+        self._press_at = None
+        if self._press_task is not None:
+            self._press_task.cancel()
+            self._press_task = None
+        if self._hold_sfx is not None:
+            self.cmd.player.terminate_current_playback(self._hold_sfx)
+            self._hold_sfx = None
+        if self._green_timer is not None:
+            self._green_timer.cancel()
+            self._green_timer = None
+        self.cmd.led.stop_led_task(self._led_task)
+        self._led_task = None
+        self.cmd.player.release_confirmation()
+
+    def _ignore_press(self, payload, at):
+        if self._press_at is not None:
+            logger.info("Ignored press duration: %.2fs", at - self._press_at)
+            self.cmd.events.record(eventlog.IGNORED, self.cmd.recorder.get_current_recording(), at - self._press_at)
+        self._end_confirm_press()
+
+    def _save(self, payload, at):
+        logger.info("Confirmed via hold")
+        self.cmd.events.record(eventlog.SAVED, self.cmd.recorder.get_current_recording(), at - self._press_at)
+        self._end_confirm_press()
+        self.cmd.player.stop_confirmation()
+        return self._commit_take()
+
+    async def _commit_take(self):
+        # only now the take leaves the staging area for the sd card
+        recording = await self.cmd.recorder.commit_recording()
+        self.cmd.player.extend_buffer(recording)
+        self.cmd.uploader.enqueue(recording)
+        self.cmd.led.start_delayed_led_off(1)
+        await asyncio.sleep(OUTRO_SEC)
+        return DONE
+
+    def _delete(self, payload, at):
+        logger.info("Deleted via short press")
+        self.cmd.events.record(eventlog.DELETED, self.cmd.recorder.get_current_recording(), at - self._press_at)
+        self._end_confirm_press()
+        self.cmd.player.stop_confirmation()
+        return self._delete_take()
+
+    async def _delete_take(self):
+        await self.cmd.player.playback_delete()
+        self.cmd.recorder.delete_recording()
+        self.cmd.led.start_deleted_led_seq(1.5)
+        await asyncio.sleep(OUTRO_SEC)
+        return DONE
+
+    # --- any state ---
+
+    def _reset(self, payload, at):
+        self.cmd.events.record(eventlog.RESET)
+        return self._reset_archive()
+
+    async def _reset_archive(self):
+        await self.event_loop.run_in_executor(None, self.cmd.recorder.reset_recordings)
+
+    def _recover(self, payload, at):
+        """Back to a playing rotation from wherever the station got stuck."""
+        logger.warning("Recovering to idle")
+        self.cmd.events.record(eventlog.RECOVERED)
+        if self._work is not None:
+            self._work.cancel()
+            self._work = None
+        self._cancel_hold()
+        self._end_confirm_press()
+        self.cmd.player.stop_confirmation()
+        self.cmd.led.led_off()
+        self.cmd.player.resume()
+        if self.cmd.recorder.is_recording():
+            return self._discard_take()
+
+    async def _discard_take(self):
+        if await self.cmd.recorder.stop_recording() is not None:
+            self.cmd.recorder.delete_recording()
@@ -0,0 +1,114 @@
+"""Pitch-preserving time compression of clips (WSOLA), so a deep rotation cycles faster.
+
+The output is built from 30 ms Hann frames overlapped by half. Frame k is
+taken from around k * hop * speed in the input, shifted by up to a quarter
+frame to where it best continues the previous frame (the offset with the
+highest cross-correlation). Voices keep their pitch, pauses and syllables
+simply come closer together. Only the search runs frame by frame, on a mono
+copy decimated by SEARCH_DECIMATE; gathering the frames and the overlap-add
+are single numpy operations over the whole clip.
+
+The real-time cost on this machine:
+
+    python src/timestretch.py recordings/rec_x.wav --speed 1.25 [--out stretched.wav]
+"""
+from scipy.io import wavfile
+import argparse
+import time
+import numpy as np
+
+FRAME_SEC = 0.03
+# the similarity search runs on every n-th sample of the mono mix
+SEARCH_DECIMATE = 4
+
+
+def frame_size(rate: int) -> int:
+    # even, so the hop is exactly half a frame
+    return max(64, int(rate * FRAME_SEC) // 2 * 2)
+
+
+def _offsets(mono: np.ndarray, nominal: np.ndarray, hop: int, tolerance: int, size: int) -> np.ndarray:
+    """Shift of every frame from its nominal start, each one continuing the previous choice as closely as possible.
+
+    mono is the decimated mono mix.
+    """
+    d = SEARCH_DECIMATE
+    n, tol = size // d, tolerance // d
+    # padded at both ends, so no candidate window leaves the signal
+    x = np.pad(mono, (tol, n + tol + hop // d + 1))
+    windows = np.lib.stride_tricks.sliding_window_view(x, n)
+    offsets = np.zeros(len(nominal), dtype=np.int64)
+    for k in range(1, len(nominal)):
+        # where the previous frame would naturally continue
+        template = windows[(nominal[k - 1] + offsets[k - 1] + hop) // d + tol]
+        # candidates from nominal - tolerance to nominal + tolerance, in padded coordinates
+        base = nominal[k] // d
+        scores = windows[base:base + 2 * tol + 1] @ template
+        offsets[k] = (int(np.argmax(scores)) - tol) * d
+    return offsets
+
+
+def stretch(data: np.ndarray, speed: float, rate: int) -> np.ndarray:
+    """data (frames or frames x channels, any dtype) played speed times faster, same dtype and pitch."""
+    if speed <= 1.0 or len(data) < 4 * frame_size(rate):
+        return data
+    size = frame_size(rate)
+    hop = size // 2
+    tolerance = size // 4
+    x = data.astype(np.float32)
+    if x.ndim == 1:
+        x = x[:, None]
+
+    count = int((len(x) - size - 2 * tolerance) / (hop * speed)) + 1
+    nominal = (np.arange(count) * hop * speed).astype(np.int64) + tolerance
+    positions = nominal + _offsets(x[::SEARCH_DECIMATE].mean(axis=1), nominal, hop, tolerance, size)
+
+    # frames x samples x channels, windowed; a periodic Hann at half overlap sums to one
+    window = (0.5 - 0.5 * np.cos(2 * np.pi * np.arange(size) / size)).astype(np.float32)
+    frames = x[positions[:, None] + np.arange(size)] * window[None, :, None]
+    # overlap-add: the second half of every frame plus the first half of the next
+    halves = frames.reshape(count, 2, hop, x.shape[1])
+    out = np.empty((count + 1, hop, x.shape[1]), dtype=np.float32)
+    out[:-1] = halves[:, 0]
+    out[1:-1] += halves[:-1, 1]
+    out[-1] = halves[-1, 1]
+    out = out.reshape(-1, x.shape[1])
+
+    if data.dtype.kind in "iu":
+        info = np.iinfo(data.dtype)
+        out = np.clip(np.round(out), info.min, info.max)
+    out = out.astype(data.dtype)
+    return out[:, 0] if data.ndim == 1 else out
+
+
+def speed_for(waiting: int, max_speed: float, from_clips: int, full_clips: int) -> float:
+    """1.0 up to from_clips waiting, rising linearly to max_speed at full_clips."""
+    if max_speed <= 1.0 or waiting <= from_clips:
+        return 1.0
+    share = min(1.0, (waiting - from_clips) / max(1, full_clips - from_clips))
+    return round(1.0 + share * (max_speed - 1.0), 2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark (and listen to) the playback time compression.")
+    parser.add_argument("wav")
+    parser.add_argument("--speed", type=float, default=1.25)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--out", help="write the stretched clip here")
+    args = parser.parse_args()
+
+    rate, data = wavfile.read(args.wav)
+    stretch(data[:rate], args.speed, rate)
+    timings = []
+    for _ in range(args.repeat):
+        started = time.perf_counter()
+        result = stretch(data, args.speed, rate)
+        timings.append(time.perf_counter() - started)
+    clip_sec = len(data) / rate
+    best = min(timings)
+    print(f"{args.wav}: {clip_sec:.1f} s at {rate} Hz, {1 if data.ndim == 1 else data.shape[1]} ch, "
+          f"x{args.speed} -> {len(result) / rate:.1f} s")
+    print(f"stretch took {best * 1000:.0f} ms (median {np.median(timings) * 1000:.0f} ms), "
+          f"{best / clip_sec * 1000:.1f} ms per second of audio, {clip_sec / best:.0f}x real time")
+    if args.out:
+        wavfile.write(args.out, rate, result)
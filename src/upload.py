@@ -0,0 +1,556 @@
+"""Background upload of confirmed takes to a collection server.
+
+Every confirmed take is hashed and appended to a durable queue
+(.upload.jsonl in RECORDING_PATH, one fsynced line per change) before
+anything is sent. The queue is drained in batches: up to BATCH_SIZE takes
+go back to back over pooled keep-alive connections, each one as
+
+    PUT <URL>/<station>/<name>
+    Transfer-Encoding: chunked
+    X-Content-SHA256: <hex>
+
+and the whole batch is marked done with a single journal line. Bodies are
+streamed from disk under a shared byte budget and held back while a take is
+being recorded. Failed uploads are retried with exponential backoff (and
+Retry-After), the server's 4xx answers other than 408/429 drop the take.
+
+A restart resumes the queue. Takes that may have been sent before the
+crash are checked with a HEAD first and only sent again if the server does
+not have them with the same sha256, the PUT itself is idempotent on the
+server side. test/upload_server.py is a stand-in server for testing.
+
+    python src/upload.py config.yaml --all     # queue every take not uploaded yet, exit when done
+"""
+from collections import deque
+from config import Config, LogConfig, UploadConfig, load_config
+from pathlib import Path
+from urllib.parse import quote, urlsplit
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import threading
+import time
+from typing import TYPE_CHECKING
+from archive_sync import sha256_file
+from http_api import SLICE, TokenBucket
+import segstore
+import sidecar
+import log
+
+logger = log.get_logger("upload")
+
+if TYPE_CHECKING:
+    from cmd_typing import CmdTyping
+
+JOURNAL = ".upload.jsonl"
+SIDECAR_KEY = "upload"
+
+
+class UploadError(Exception):
+
+    def __init__(self, message: str, retry: bool = True, retry_after: float | None = None):
+        super().__init__(message)
+        self.retry = retry
+        self.retry_after = retry_after
+
+
+class _Connection:
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+        self.used = False
+
+    def close(self):
+        self.writer.close()
+
+
+class ConnectionPool:
+    """Keep-alive connections to one host, the last one returned is reused first."""
+
+    def __init__(self, url: str, size: int, timeout: float):
+        parts = urlsplit(url)
+        if parts.scheme not in ("http", "https") or not parts.hostname:
+            raise ValueError(f"upload URL must be http(s)://host[:port]/path, got {url!r}")
+        self.host = parts.hostname
+        self.ssl = parts.scheme == "https"
+        self.port = parts.port or (443 if self.ssl else 80)
+        self.netloc = parts.netloc
+        self.path = parts.path.rstrip("/")
+        self.size = size
+        self.timeout = timeout
+        self._idle: list[_Connection] = []
+
+    async def acquire(self) -> _Connection:
+        while self._idle:
+            conn = self._idle.pop()
+            # closed by the server while it was idle
+            if not conn.writer.is_closing() and not conn.reader.at_eof():
+                return conn
+            conn.close()
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port, ssl=self.ssl or None), self.timeout)
+        return _Connection(reader, writer)
+
+    def release(self, conn: _Connection, reuse: bool):
+        if reuse and not conn.writer.is_closing() and len(self._idle) < self.size:
+            conn.used = True
+            self._idle.append(conn)
+        else:
+            conn.close()
+
+    def close(self):
+        for conn in self._idle:
+            conn.close()
+        self._idle.clear()
+
+
+async def read_response(reader: asyncio.StreamReader) -> tuple[int, dict, bytes]:
+    """Status, lower-cased headers and body of one HTTP/1.1 response."""
+    head = await reader.readuntil(b"\r\n\r\n")
+    lines = head.decode("latin-1").split("\r\n")
+    try:
+        status = int(lines[0].split(" ", 2)[1])
+    except (IndexError, ValueError):
+        raise UploadError(f"malformed status line {lines[0]!r}") from None
+    headers = {}
+    for line in lines[1:]:
+        key, _, value = line.partition(":")
+        if key:
+            headers[key.strip().lower()] = value.strip()
+
+    if headers.get("transfer-encoding", "").lower() == "chunked":
+        body = bytearray()
+        while True:
+            size = int((await reader.readuntil(b"\r\n")).split(b";")[0], 16)
+            if size == 0:
+                await reader.readuntil(b"\r\n")
+                break
+            body += await reader.readexactly(size)
+            await reader.readexactly(2)
+        return status, headers, bytes(body)
+    length = int(headers.get("content-length", 0))
+    return status, headers, await reader.readexactly(length) if length else b""
+
+
+class Uploader:
+
+    def __init__(self, upload_cfg: UploadConfig, rec_path, event_loop: asyncio.AbstractEventLoop):
+        self.upload_cfg = upload_cfg
+        self.rec_path = Path(rec_path)
+        self.event_loop = event_loop
+        self.journal_path = self.rec_path / JOURNAL
+        self.station = upload_cfg.STATION or socket.gethostname()
+        # entries {"name", "sha256", "size", "mtime", "check"} in upload order
+        self.pending: deque[dict] = deque()
+        self._queued: set[str] = set()
+        self._in_flight = 0
+        self._done_lines = 0
+        self._journal_lock = threading.Lock()
+        self._wake = asyncio.Event()
+        self._idle = asyncio.Event()
+        self._failures = 0
+        self._retry_at = 0.0
+        self._slots: asyncio.Semaphore | None = None
+        self._task: asyncio.Task | None = None
+        self._batches: set[asyncio.Task] = set()
+        self._adding: set[asyncio.Task] = set()
+        self.pool: ConnectionPool | None = None
+        self.bucket: TokenBucket | None = None
+        self.stats = {"uploaded": 0, "skipped": 0, "dropped": 0, "retries": 0, "bytes": 0}
+        self.cmd: "CmdTyping | None" = None
+
+    def inject_cmd(self, cmd: "CmdTyping"):
+        self.cmd = cmd
+
+    async def start(self):
+        cfg = self.upload_cfg
+        if not cfg.ENABLED:
+            return
+        if not cfg.URL:
+            logger.error("Upload enabled without a URL, not uploading")
+            return
+        try:
+            self.pool = ConnectionPool(cfg.URL, cfg.CONNECTIONS, cfg.TIMEOUT_SEC)
+        except ValueError as err:
+            logger.error("%s, not uploading", err)
+            return
+        # one batch per connection, that bounds what is in flight
+        self._slots = asyncio.Semaphore(cfg.CONNECTIONS)
+        self.bucket = TokenBucket(cfg.RATE_LIMIT_KBPS * 1024, self.event_loop)
+        await self.event_loop.run_in_executor(None, self._load_journal)
+        self._task = self.event_loop.create_task(self._run())
+        logger.info("Uploading to %s as %s, %d takes queued", cfg.URL, self.station, len(self.pending))
+
+    async def close(self):
+        tasks = [t for t in (self._task, *self._batches, *self._adding) if t is not None]
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.wait(tasks)
+        self._task = None
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
+        # whatever was in flight is checked with a HEAD on the next start
+        self.pending.clear()
+        self._queued.clear()
+        self._in_flight = 0
+
+    async def reconfigure(self, upload_cfg: UploadConfig):
+        await self.close()
+        self.upload_cfg = upload_cfg
+        self.station = upload_cfg.STATION or socket.gethostname()
+        await self.start()
+
+    # --- queue ---
+
+    def enqueue(self, wav_path):
+        """Queues a confirmed take. Returns at once, hashing and the journal write run in the executor."""
+        if self._task is None:
+            return
+        task = self.event_loop.create_task(self._add(Path(wav_path)))
+        self._adding.add(task)
+        task.add_done_callback(self._adding.discard)
+
+    async def _add(self, wav: Path):
+        if wav.name in self._queued:
+            return
+        self._queued.add(wav.name)
+        try:
+            entry = await self.event_loop.run_in_executor(None, self._journal_add, wav)
+        except OSError as err:
+            logger.error("Could not queue %s for upload: %s", wav.name, err)
+            entry = None
+        if entry is None:
+            self._queued.discard(wav.name)
+            return
+        self.pending.append(entry)
+        self._idle.clear()
+        self._wake.set()
+
+    def _journal_add(self, wav: Path) -> dict | None:
+        # stat before hashing, a rewrite in between shows as a changed mtime later
+        size, mtime = segstore.clip_stat(wav)
+        entry = {"name": wav.name, "sha256": sha256_file(wav), "size": size, "mtime": mtime}
+        if sidecar.read(wav).get(SIDECAR_KEY, {}).get("sha256") == entry["sha256"]:
+            # this very content was uploaded already
+            return None
+        self._append({"state": "queued", **entry})
+        return dict(entry, check=False, at=time.monotonic())
+
+    def _append(self, entry: dict):
+        # fsynced, the journal is the only record of what still has to go
+        with self._journal_lock, open(self.journal_path, "a") as f:
+            f.write(json.dumps(entry) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _read_journal(self) -> dict[str, dict]:
+        """The takes still queued, in queue order."""
+        queued: dict[str, dict] = {}
+        try:
+            with open(self.journal_path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # torn last line of a crash
+                        break
+                    if entry.get("state") == "queued":
+                        queued[entry["name"]] = entry
+                    elif entry.get("state") in ("done", "dropped"):
+                        for name in entry.get("names", []):
+                            queued.pop(name, None)
+        except FileNotFoundError:
+            pass
+        return queued
+
+    def _compact(self) -> dict[str, dict]:
+        """Rewrites the journal with the takes still queued and returns them."""
+        tmp = self.journal_path.with_suffix(".jsonl.tmp")
+        # under the lock, a take queued meanwhile is either read here or appended after the swap
+        with self._journal_lock:
+            queued = self._read_journal()
+            with open(tmp, "w") as f:
+                for entry in queued.values():
+                    f.write(json.dumps(entry) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.journal_path)
+        self._done_lines = 0
+        return queued
+
+    def _load_journal(self):
+        # anything left may have reached the server before the crash, check first
+        for name, entry in self._compact().items():
+            self.pending.append({"name": name, "sha256": entry["sha256"], "size": entry["size"],
+                                 "mtime": entry.get("mtime"), "check": True, "at": float("-inf")})
+            self._queued.add(name)
+
+    def _finish(self, done: list[dict], dropped: list[dict]):
+        """One journal line per outcome for the whole batch, then the sidecars. Executor side."""
+        if done:
+            self._append({"state": "done", "names": [e["name"] for e in done]})
+        if dropped:
+            self._append({"state": "dropped", "names": [e["name"] for e in dropped]})
+        for entry in done:
+            wav = self.rec_path / entry["name"]
+            if segstore.exists(wav):
+                sidecar.update(wav, SIDECAR_KEY, {"sha256": entry["sha256"], "url": self.upload_cfg.URL,
+                                                  "station": self.station, "at": int(time.time())})
+        self._done_lines += len(done) + len(dropped)
+
+    # --- sending ---
+
+    async def _run(self):
+        cfg = self.upload_cfg
+        while True:
+            if not self.pending:
+                if self._in_flight == 0:
+                    # everything arrived, the journal starts over empty
+                    if self._done_lines:
+                        await self.event_loop.run_in_executor(None, self._compact)
+                    self._idle.set()
+                self._wake.clear()
+                await self._wake.wait()
+                continue
+
+            # back off after failures, a new take does not cut it short
+            delay = self._retry_at - self.event_loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+
+            # a batch leaves when it is full or its oldest take has waited BATCH_WAIT_SEC
+            wait = self.pending[0]["at"] + cfg.BATCH_WAIT_SEC - time.monotonic()
+            if len(self.pending) < cfg.BATCH_SIZE and wait > 0:
+                self._wake.clear()
+                try:
+                    await asyncio.wait_for(self._wake.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            # with every connection busy the takes wait here, in the queue
+            await self._slots.acquire()
+            if not self.pending or self._retry_at > self.event_loop.time():
+                self._slots.release()
+                continue
+            batch = [self.pending.popleft() for _ in range(min(cfg.BATCH_SIZE, len(self.pending)))]
+            self._in_flight += 1
+            task = self.event_loop.create_task(self._send_batch(batch))
+            self._batches.add(task)
+            task.add_done_callback(self._batches.discard)
+
+    async def _send_batch(self, batch: list[dict]):
+        done, dropped, retry = [], [], []
+        conn = None
+        try:
+            for i, entry in enumerate(batch):
+                try:
+                    if conn is None or conn.writer.is_closing():
+                        if conn is not None:
+                            self.pool.release(conn, reuse=False)
+                        conn = await self.pool.acquire()
+                    conn = await self._upload(conn, entry)
+                    done.append(entry)
+                except FileNotFoundError:
+                    # deleted or reset locally in the meantime
+                    logger.info("%s is gone, not uploading it", entry["name"])
+                    dropped.append(entry)
+                except UploadError as err:
+                    if not err.retry:
+                        logger.error("Server rejected %s: %s", entry["name"], err)
+                        dropped.append(entry)
+                        continue
+                    logger.warning("Upload of %s failed: %s", entry["name"], err)
+                    retry = batch[i:]
+                    self._back_off(err.retry_after)
+                    break
+                except (OSError, asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+                        asyncio.TimeoutError) as err:
+                    logger.warning("Upload of %s failed: %s", entry["name"], str(err) or type(err).__name__)
+                    retry = batch[i:]
+                    self._back_off(None)
+                    break
+        finally:
+            if conn is not None:
+                self.pool.release(conn, reuse=not retry)
+            # on close a batch is cancelled, what was sent is still recorded, the rest stays queued
+            if done or dropped:
+                await asyncio.shield(self.event_loop.run_in_executor(None, self._finish, done, dropped))
+            self._in_flight -= 1
+            self._slots.release()
+            self._wake.set()
+
+        if done:
+            self._failures = 0
+            logger.info("Uploaded %d takes (%d queued)", len(done), len(self.pending) + len(retry))
+        for entry in done + dropped:
+            self._queued.discard(entry["name"])
+        self.stats["uploaded"] += len(done)
+        self.stats["dropped"] += len(dropped)
+        if retry:
+            self.stats["retries"] += 1
+            # maybe sent already, the server is asked before the next attempt
+            for entry in reversed(retry):
+                entry["check"] = True
+                self.pending.appendleft(entry)
+
+    def _back_off(self, retry_after: float | None):
+        cfg = self.upload_cfg
+        self._failures += 1
+        delay = min(cfg.RETRY_MAX_SEC, cfg.RETRY_MIN_SEC * 2 ** (self._failures - 1))
+        # jitter, so a fleet of stations does not come back in lockstep
+        delay *= random.uniform(0.5, 1.0)
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, cfg.RETRY_MAX_SEC))
+        self._retry_at = max(self._retry_at, self.event_loop.time() + delay)
+        logger.info("Retrying uploads in %.0f s", delay)
+
+    def _target(self, name: str) -> str:
+        return f"{self.pool.path}/{quote(self.station)}/{quote(name)}"
+
+    def _headers(self, method: str, name: str, extra: dict) -> bytes:
+        lines = [f"{method} {self._target(name)} HTTP/1.1", f"Host: {self.pool.netloc}",
+                 f"User-Agent: ohrgarten/{self.station}"]
+        if self.upload_cfg.TOKEN:
+            lines.append(f"Authorization: Bearer {self.upload_cfg.TOKEN}")
+        lines += [f"{k}: {v}" for k, v in extra.items()]
+        return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+    async def _upload(self, conn: _Connection, entry: dict) -> _Connection:
+        """Sends one take. A stale keep-alive connection is replaced once, returns the connection to go on with."""
+        try:
+            await self._exchange(conn, entry)
+            return conn
+        except (ConnectionError, asyncio.IncompleteReadError):
+            if not conn.used:
+                raise
+        # the server closed an idle connection, that is no failure yet
+        self.pool.release(conn, reuse=False)
+        conn = await self.pool.acquire()
+        await self._exchange(conn, entry)
+        return conn
+
+    async def _refresh(self, entry: dict):
+        """Re-hashes a take that was rewritten locally (reprocessed) since it was queued."""
+        wav = self.rec_path / entry["name"]
+        size, mtime = await self.event_loop.run_in_executor(None, segstore.clip_stat, wav)
+        if size != entry["size"] or mtime != entry.get("mtime"):
+            entry["sha256"] = await self.event_loop.run_in_executor(None, sha256_file, wav)
+            entry["size"], entry["mtime"] = size, mtime
+
+    async def _exchange(self, conn: _Connection, entry: dict):
+        timeout = self.upload_cfg.TIMEOUT_SEC
+        # the HEAD and the PUT both need the hash of what is on disk now
+        await self._refresh(entry)
+        if entry["check"]:
+            conn.writer.write(self._headers("HEAD", entry["name"], {}))
+            status, headers, _ = await asyncio.wait_for(read_response(conn.reader), timeout)
+            self._check_keep_alive(conn, headers)
+            if status == 200 and headers.get("x-content-sha256") == entry["sha256"]:
+                logger.info("%s is on the server already", entry["name"])
+                self.stats["skipped"] += 1
+                return
+            if conn.writer.is_closing():
+                raise ConnectionResetError("server closed the connection after HEAD")
+
+        # a packed take is sent as a byte range of its segment
+        with segstore.open_clip(self.rec_path / entry["name"]) as (f, base, size):
+            if size != entry["size"]:
+                # rewritten since _refresh(), hashed again on the retry
+                raise UploadError(f"{entry['name']} changed while it was being sent")
+            conn.writer.write(self._headers("PUT", entry["name"], {
+                "Content-Type": "audio/wav", "Transfer-Encoding": "chunked", "X-Content-SHA256": entry["sha256"]}))
+            await self._send_chunked(conn.writer, f, base, size)
+        status, headers, body = await asyncio.wait_for(read_response(conn.reader), timeout)
+        self._check_keep_alive(conn, headers)
+        if 200 <= status < 300:
+            return
+        message = f"HTTP {status} {body[:200].decode('utf-8', 'replace').strip()}"
+        if status in (408, 429) or status >= 500:
+            retry_after = headers.get("retry-after")
+            raise UploadError(message, retry_after=float(retry_after) if retry_after and retry_after.isdigit() else None)
+        raise UploadError(message, retry=False)
+
+    def _check_keep_alive(self, conn: _Connection, headers: dict):
+        if headers.get("connection", "").lower() == "close":
+            conn.writer.close()
+
+    async def _send_chunked(self, writer: asyncio.StreamWriter, f, base: int, size: int):
+        """The body in throttled chunks, zero-copy where the transport allows. Pauses while a take is recorded."""
+        offset = 0
+        while offset < size:
+            if self.cmd is not None:
+                while self.cmd.recorder.is_recording():
+                    await asyncio.sleep(0.5)
+            chunk = min(SLICE, size - offset)
+            await self.bucket.take(chunk)
+            writer.write(f"{chunk:x}\r\n".encode())
+            await self.event_loop.sendfile(writer.transport, f, base + offset, chunk)
+            writer.write(b"\r\n")
+            # the rotation's clips stay in the page cache, not the uploads
+            try:
+                os.posix_fadvise(f.fileno(), base + offset, chunk, os.POSIX_FADV_DONTNEED)
+            except (AttributeError, OSError):
+                pass
+            offset += chunk
+            self.stats["bytes"] += chunk
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+
+    async def drain(self):
+        """Waits until the queue is empty and nothing is in flight."""
+        await self._idle.wait()
+
+
+def not_uploaded(rec_path) -> list[Path]:
+    """Takes without an upload record of their current content. Blocking, hashes every uploaded take."""
+    todo = []
+    for wav in segstore.wav_paths(rec_path):
+        uploaded = sidecar.read(wav).get(SIDECAR_KEY, {}).get("sha256")
+        try:
+            if uploaded is None or uploaded != sha256_file(wav):
+                todo.append(wav)
+        except FileNotFoundError:
+            continue
+    return todo
+
+
+async def _upload_all(settings: Config, everything: bool):
+    uploader = Uploader(settings.upload_cfg, settings.rec_cfg.RECORDING_PATH, asyncio.get_running_loop())
+    await uploader.start()
+    if uploader._task is None:
+        return 1
+    try:
+        if everything:
+            for wav in await asyncio.get_running_loop().run_in_executor(None, not_uploaded,
+                                                                         settings.rec_cfg.RECORDING_PATH):
+                uploader.enqueue(wav)
+            if uploader._adding:
+                await asyncio.wait(list(uploader._adding))
+        await uploader.drain()
+    finally:
+        await uploader.close()
+    logger.info("Upload finished: %s", ", ".join(f"{k} {v}" for k, v in uploader.stats.items()))
+    return 1 if uploader.stats["dropped"] else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Upload queued recordings to the collection server.")
+    parser.add_argument("config", help="station yaml with an enabled upload_config")
+    parser.add_argument("--all", action="store_true", help="also queue every take that was never uploaded")
+    args = parser.parse_args()
+
+    settings: Config = load_config(args.config)
+    log.setup_logging(LogConfig())
+    try:
+        code = asyncio.run(_upload_all(settings, args.all))
+    finally:
+        log.shutdown_logging()
+    raise SystemExit(code)
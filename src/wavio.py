@@ -0,0 +1,318 @@
+import argparse
+import os
+import shutil
+import struct
+import time
+from dataclasses import dataclass, field
+import numpy as np
+import log
+
+logger = log.get_logger("wavio")
+
+# takes are written under <name>.wav.part and renamed once finalized
+PART_SUFFIX = ".part"
+QUARANTINE_DIR = "quarantine"
+
+# headers are expected within the first few KiB, never scan the audio itself
+HEADER_SCAN_LIMIT = 64 * 1024
+# slice size when streaming a PcmBuffer into a pipe
+STREAM_CHUNK = 64 * 1024
+
+
+@dataclass
+class WavInfo:
+    channels: int
+    rate: int
+    sampwidth: int
+    block_align: int
+    data_offset: int
+    data_size: int
+    riff_size: int
+
+
+@dataclass
+class PcmBuffer:
+    """A processed take held in memory, handed from the recorder to the player without copies."""
+    name: str
+    rate: int
+    data: np.ndarray = field(repr=False)
+
+    @property
+    def channels(self) -> int:
+        return 1 if self.data.ndim == 1 else self.data.shape[1]
+
+    @property
+    def duration(self) -> float:
+        return len(self.data) / self.rate
+
+    def wav_stream(self):
+        """Header, then zero-copy slices of the samples, e.g. for aplay reading stdin."""
+        yield pcm_header(self.rate, self.channels, self.data.dtype.itemsize, self.data.nbytes)
+        view = memoryview(np.ascontiguousarray(self.data)).cast("B")
+        for start in range(0, len(view), STREAM_CHUNK):
+            yield view[start:start + STREAM_CHUNK]
+
+
+def pcm_header(rate: int, channels: int, sampwidth: int = 2, data_size: int = 0) -> bytes:
+    """Canonical 44 byte PCM header."""
+    block_align = channels * sampwidth
+    return struct.pack("<4sI4s4sIHHIIHH4sI",
+                       b"RIFF", 36 + data_size, b"WAVE",
+                       b"fmt ", 16, 1, channels, rate, rate * block_align, block_align, sampwidth * 8,
+                       b"data", data_size)
+
+
+def read_header(f) -> WavInfo | None:
+    """Walks the chunk list up to the data chunk. Returns None if the file is not a usable wav."""
+    f.seek(0)
+    head = f.read(12)
+    if len(head) < 12 or head[:4] != b"RIFF" or head[8:12] != b"WAVE":
+        return None
+    riff_size = struct.unpack("<I", head[4:8])[0]
+
+    fmt = None
+    pos = 12
+    while pos < HEADER_SCAN_LIMIT:
+        f.seek(pos)
+        chunk = f.read(8)
+        if len(chunk) < 8:
+            return None
+        chunk_id, size = struct.unpack("<4sI", chunk)
+        if chunk_id == b"fmt ":
+            body = f.read(16)
+            if len(body) < 16:
+                return None
+            _, channels, rate, _, block_align, bits = struct.unpack("<HHIIHH", body)
+            fmt = (channels, rate, bits // 8, block_align)
+        elif chunk_id == b"data":
+            if fmt is None or fmt[3] == 0:
+                return None
+            channels, rate, sampwidth, block_align = fmt
+            return WavInfo(channels, rate, sampwidth, block_align, pos + 8, size, riff_size)
+        pos += 8 + size + (size & 1)
+    return None
+
+
+def _patch_sizes(fd: int, data_offset: int, data_size: int):
+    os.pwrite(fd, struct.pack("<I", data_offset - 8 + data_size), 4)
+    os.pwrite(fd, struct.pack("<I", data_size), data_offset - 4)
+
+
+def header_fits(path) -> bool:
+    """True if the data chunk is not empty and ends within the file. Only the header is read."""
+    with open(path, "rb") as f:
+        info = read_header(f)
+        if info is None:
+            return False
+        available = os.fstat(f.fileno()).st_size - info.data_offset
+    # chunks after the data (LIST, ...) are fine, a data size past the end is not
+    return 0 < info.data_size <= available
+
+
+def repair_header(path, truncate: bool = True, sync: bool = False) -> bool:
+    """Fixes RIFF and data sizes in place from the actual file length.
+
+    Only the header is read and two 4 byte fields are written, so the cost
+    does not depend on the length of the recording. With truncate, a trailing
+    partial frame is cut off. Returns False if the file cannot be recovered.
+    """
+    try:
+        with open(path, "r+b") as f:
+            info = read_header(f)
+            if info is None:
+                return False
+            file_size = os.fstat(f.fileno()).st_size
+            data_size = file_size - info.data_offset
+            data_size -= data_size % info.block_align
+            if data_size <= 0:
+                return False
+
+            if truncate and info.data_offset + data_size != file_size:
+                f.truncate(info.data_offset + data_size)
+            if info.data_size != data_size or info.riff_size != info.data_offset - 8 + data_size:
+                _patch_sizes(f.fileno(), info.data_offset, data_size)
+            if sync:
+                os.fsync(f.fileno())
+        return True
+    except OSError as err:
+        logger.error("Error repairing wav header of %s: %s", path, err)
+        return False
+
+
+def quarantine(path, rec_path) -> str:
+    """Moves an unrecoverable file out of the rotation into RECORDING_PATH/quarantine."""
+    target_dir = os.path.join(rec_path, QUARANTINE_DIR)
+    os.makedirs(target_dir, exist_ok=True)
+    name = os.path.basename(path)
+    if name.endswith(PART_SUFFIX):
+        name = name[:-len(PART_SUFFIX)]
+    target = os.path.join(target_dir, name)
+    # may cross from the staging tmpfs to the sd card
+    shutil.move(path, target)
+    logger.warning("Quarantined unrecoverable recording: %s", target)
+    return target
+
+
+def finalize_partial(part_path, rec_path) -> str | None:
+    """Repairs a .part take and atomically renames it to its final name.
+
+    Returns the final path, or None if the take went to quarantine.
+    """
+    if not repair_header(part_path, truncate=True, sync=True):
+        quarantine(part_path, rec_path)
+        return None
+    final = part_path[:-len(PART_SUFFIX)] if part_path.endswith(PART_SUFFIX) else part_path
+    os.replace(part_path, final)
+    _fsync_dir(os.path.dirname(final) or ".")
+    return final
+
+
+def commit_file(src, dst, chunk: int = 1024 * 1024) -> str:
+    """Durably moves src to another filesystem: copy to <dst>.part, fsync, atomic rename, fsync the directory.
+
+    src is removed only after dst is safe. Blocking, keep off the event loop.
+    """
+    part = dst + PART_SUFFIX
+    with open(src, "rb") as fin, open(part, "wb") as fout:
+        shutil.copyfileobj(fin, fout, chunk)
+        fout.flush()
+        os.fsync(fout.fileno())
+    os.replace(part, dst)
+    _fsync_dir(os.path.dirname(dst) or ".")
+    os.remove(src)
+    return dst
+
+
+def _fsync_dir(path):
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def recover_recordings(rec_path) -> tuple[int, int]:
+    """Startup pass over takes interrupted by SIGKILL or power loss.
+
+    Finished takes never carry the .part suffix, so only interrupted ones are
+    opened and the pass scales with their number, not with the archive.
+    Finished takes with a broken header (written by an older version or
+    copied in) are repaired when reading them fails, see repair_damaged(),
+    or all at once with --repair. Returns (recovered, quarantined).
+    """
+    recovered = quarantined = 0
+    with os.scandir(rec_path) as entries:
+        parts = [e.path for e in entries if e.is_file() and e.name.endswith(".wav" + PART_SUFFIX)]
+
+    for part in parts:
+        if finalize_partial(part, rec_path):
+            recovered += 1
+            logger.warning("Recovered interrupted recording: %s", part)
+        else:
+            quarantined += 1
+    return recovered, quarantined
+
+
+def repair_damaged(path) -> bool:
+    """Repairs a finished take whose header does not fit the file. True if it was repaired.
+
+    For readers that failed on a take, an unrecoverable one is left where it
+    is (it may be in the rotation), --repair quarantines those.
+    """
+    try:
+        if header_fits(path):
+            return False
+    except OSError:
+        return False
+    if not repair_header(path, truncate=True, sync=True):
+        return False
+    logger.warning("Repaired wav header of recording: %s", path)
+    return True
+
+
+def repair_archive(rec_path) -> tuple[int, int]:
+    """Checks the header of every finished take, repairs or quarantines the broken ones.
+
+    Reads one header per take, run it once (station stopped) on an archive
+    from an older version. Returns (repaired, quarantined).
+    """
+    repaired = quarantined = 0
+    with os.scandir(rec_path) as entries:
+        wavs = sorted(e.path for e in entries if e.is_file() and e.name.lower().endswith(".wav"))
+    for wav in wavs:
+        try:
+            if header_fits(wav):
+                continue
+        except OSError as err:
+            logger.error("Error reading wav header of %s: %s", wav, err)
+            continue
+        if repair_header(wav, truncate=True, sync=True):
+            repaired += 1
+            logger.warning("Repaired wav header of recording: %s", wav)
+        else:
+            quarantine(wav, rec_path)
+            quarantined += 1
+    return repaired, quarantined
+
+
+class WavWriter:
+    """Streaming PCM writer that keeps the header valid while the take grows.
+
+    Data goes to <filename>.part, the header sizes are committed every
+    commit_interval seconds and close() renames the file to its final name.
+    """
+
+    def __init__(self, filename, rate: int, channels: int, sampwidth: int = 2,
+                 commit_interval: float = 2.0):
+        self.filename = filename
+        self.part_name = filename + PART_SUFFIX
+        self.block_align = channels * sampwidth
+        self.commit_interval = commit_interval
+        self.data_bytes = 0
+
+        self._f = open(self.part_name, "wb")
+        header = pcm_header(rate, channels, sampwidth)
+        self._f.write(header)
+        self._data_offset = len(header)
+        self._last_commit = time.monotonic()
+
+    def write(self, data: bytes):
+        self._f.write(data)
+        self.data_bytes += len(data)
+        if time.monotonic() - self._last_commit >= self.commit_interval:
+            self.commit_header()
+
+    def commit_header(self):
+        """Makes the on-disk header match the frames written so far (no fsync)."""
+        self._f.flush()
+        _patch_sizes(self._f.fileno(), self._data_offset, self.data_bytes - self.data_bytes % self.block_align)
+        self._last_commit = time.monotonic()
+
+    def close(self) -> str:
+        """Finalizes the header, syncs and renames the take. Blocking, keep off the event loop."""
+        self.commit_header()
+        # drop a trailing partial frame
+        self._f.truncate(self._data_offset + self.data_bytes - self.data_bytes % self.block_align)
+        os.fsync(self._f.fileno())
+        self._f.close()
+        os.replace(self.part_name, self.filename)
+        _fsync_dir(os.path.dirname(self.filename) or ".")
+        return self.filename
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Recover interrupted recordings (what the station does at startup).")
+    parser.add_argument("recording_path")
+    parser.add_argument("--repair", action="store_true",
+                        help="also check the header of every finished take, repair or quarantine the broken ones")
+    args = parser.parse_args()
+    recovered, quarantined = recover_recordings(args.recording_path)
+    print(f"Interrupted takes: {recovered} recovered, {quarantined} quarantined")
+    if args.repair:
+        repaired, quarantined = repair_archive(args.recording_path)
+        print(f"Finished takes: {repaired} repaired, {quarantined} quarantined")
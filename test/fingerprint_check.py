@@ -0,0 +1,94 @@
+"""Checks that src/fingerprint.py finds repeats through noise and keeps unrelated takes apart.
+
+    python test/fingerprint_check.py [--takes 10] [--seed 1] [--sigma 300]
+
+Takes are synthesized like speech: voiced syllables with a gliding pitch,
+harmonics shaped by moving formants and pauses in between, over a quiet
+noise floor. They are as quiet as a visitor speaking from a distance, so
+the noise of the copies buries part of every take. Every take is checked
+against an index of all the others:
+
+- a copy with fresh white noise of --sigma (int16 units) on top must match
+  its original with at least MIN_MATCHES hits
+- a copy that starts half a second later, at half the level, must match too
+- an unrelated take must stay below MIN_MATCHES against every take
+"""
+import argparse
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+from fingerprint import MIN_MATCHES, FingerprintIndex, fingerprint  # noqa: E402
+
+RATE = 44100
+
+
+def synth_take(rng: np.random.Generator, seconds: float = 8.0, floor: float = 30.0) -> np.ndarray:
+    n = int(seconds * RATE)
+    out = np.zeros(n)
+    pos = int(rng.uniform(0.1, 0.4) * RATE)
+    while pos < n:
+        length = int(rng.uniform(0.12, 0.35) * RATE)
+        t = np.arange(min(length, n - pos)) / RATE
+        f0 = rng.uniform(90, 260) * (1 + rng.uniform(-0.15, 0.15) * t / max(t[-1], 1e-3))
+        phase = 2 * np.pi * np.cumsum(f0) / RATE
+        formants = rng.uniform([250, 800, 2300], [850, 2300, 3200])
+        glide = rng.uniform(-200, 200, size=3)
+        syllable = np.zeros(len(t))
+        for k in range(1, int(4000 / f0.max()) + 1):
+            freq = k * f0
+            moving = formants[None, :] + glide[None, :] * (t / max(t[-1], 1e-3))[:, None]
+            gain = np.exp(-((freq[:, None] - moving) / 120) ** 2).sum(axis=1) / k ** 0.5
+            syllable += gain * np.sin(k * phase)
+        envelope = np.sin(np.pi * np.arange(len(t)) / len(t)) ** 0.5
+        out[pos:pos + len(t)] += syllable * envelope * rng.uniform(80, 600) / max(np.abs(syllable).max(), 1e-9)
+        pos += len(t) + int(rng.uniform(0.03, 0.25) * RATE)
+    out += rng.normal(0, floor, n)
+    return np.clip(out, -32768, 32767).astype(np.int16)
+
+
+def noisy(rng: np.random.Generator, take: np.ndarray, sigma: float) -> np.ndarray:
+    return np.clip(take + rng.normal(0, sigma, len(take)), -32768, 32767).astype(np.int16)
+
+
+def check(takes: int, seed: int, sigma: float) -> bool:
+    rng = np.random.default_rng(seed)
+    originals = [synth_take(rng) for _ in range(takes)]
+    index = FingerprintIndex()
+    for i, take in enumerate(originals):
+        index.add(f"take{i}", *fingerprint(take, RATE))
+
+    ok = True
+    worst = {"noise": None, "shifted": None, "unrelated": 0}
+    for i, take in enumerate(originals):
+        copies = {"noise": noisy(rng, take, sigma),
+                  "shifted": (take[int(0.5 * RATE):] // 2).astype(np.int16)}
+        for kind, copy in copies.items():
+            found = {name: hits for name, _, hits in index.match(*fingerprint(copy, RATE), min_matches=1)}
+            hits = found.get(f"take{i}", 0)
+            worst[kind] = hits if worst[kind] is None else min(worst[kind], hits)
+            if hits < MIN_MATCHES:
+                print(f"take{i}: {kind} copy has {hits} hits, needs {MIN_MATCHES}")
+                ok = False
+        other = synth_take(rng)
+        found = index.match(*fingerprint(other, RATE), min_matches=1)
+        hits = max((h for _, _, h in found), default=0)
+        worst["unrelated"] = max(worst["unrelated"], hits)
+        if hits >= MIN_MATCHES:
+            print(f"unrelated take matches {found[0][0]} with {hits} hits")
+            ok = False
+    print(f"{takes} takes: fewest hits of a noisy copy (sigma {sigma:g}) {worst['noise']}, "
+          f"of a shifted copy {worst['shifted']}, most hits of an unrelated take {worst['unrelated']} "
+          f"(MIN_MATCHES {MIN_MATCHES})")
+    return ok
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Repeat detection check for the take fingerprints.")
+    parser.add_argument("--takes", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--sigma", type=float, default=300.0, help="noise added to the copies, int16 units")
+    args = parser.parse_args()
+    sys.exit(0 if check(args.takes, args.seed, args.sigma) else 1)
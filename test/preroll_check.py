@@ -0,0 +1,125 @@
+"""Checks that the pre-roll ring of src/preroll.py stays on frame boundaries.
+
+    python test/preroll_check.py [--seed 1] [--rounds 200]
+
+The capture pipe hands over whatever it has, so the chunks fed to the ring
+don't have to be whole frames. A synthetic stream whose samples count up is
+pushed in chunks of odd sizes (7 bytes, random sizes, a whole period) and
+after every chunk the pre-roll snapshot must be the tail of the stream and
+start on a frame boundary. A take is then recorded through the I/O thread,
+with periods pushed while its file is still being opened, and the finished
+wav file must hold exactly that frame-aligned stretch of the stream.
+"""
+import argparse
+import asyncio
+import os
+import random
+import shutil
+import sys
+import tempfile
+import wave
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+from preroll import PrerollCapture  # noqa: E402
+
+RATE = 1000
+CHANNELS = 2
+PREROLL_MS = 20
+
+
+def stream(frames: int) -> bytes:
+    # sample value = frame number * CHANNELS + channel, so every frame is distinct
+    return np.arange(frames * CHANNELS, dtype="<i2").tobytes()
+
+
+def check_snapshot(capture: PrerollCapture, data: bytes, fed: int) -> str | None:
+    # the snapshot is followed by the next chunk in a take, so it has to be the
+    # tail of the stream and start on a frame, a partial last frame is fine
+    snap = capture._snapshot()
+    start = fed - len(snap)
+    if start % capture.frame_bytes:
+        return f"snapshot starts at byte {start}, in the middle of a frame"
+    if snap != data[start:fed]:
+        return "snapshot is not the tail of the stream"
+    ring = capture._ring.size
+    if fed >= ring and len(snap) <= ring - capture.frame_bytes:
+        return f"snapshot of {len(snap)} bytes drops a whole frame of the {ring} byte ring"
+    return None
+
+
+def check(seed: int, rounds: int) -> bool:
+    rng = random.Random(seed)
+    ok = True
+    sizes = {"7 bytes": lambda: 7, "3 bytes": lambda: 3, "random": lambda: rng.randint(1, 300),
+             "period": lambda: 4096}
+    for label, size in sizes.items():
+        capture = PrerollCapture([], RATE, CHANNELS, PREROLL_MS, 10, None)
+        data = stream(rounds * 1024)
+        fed = 0
+        for _ in range(rounds):
+            chunk = data[fed:fed + size()]
+            capture._push(chunk)
+            fed += len(chunk)
+            error = check_snapshot(capture, data, fed)
+            if error:
+                print(f"{label}: after {fed} bytes: {error}")
+                ok = False
+                break
+        else:
+            print(f"{label}: {rounds} chunks, {fed} bytes, ok")
+    return ok
+
+
+async def check_take(seed: int, rounds: int) -> bool:
+    rng = random.Random(seed)
+    tmp = tempfile.mkdtemp(prefix="preroll_check_")
+    try:
+        capture = PrerollCapture([], RATE, CHANNELS, PREROLL_MS, 10, asyncio.get_running_loop())
+        data = stream(rounds * 1024)
+        fed = 0
+
+        def push(count: int):
+            nonlocal fed
+            for _ in range(count):
+                chunk = data[fed:fed + rng.randint(1, 300)]
+                capture._push(chunk)
+                fed += len(chunk)
+
+        push(rounds // 2)
+        start = fed - len(capture._snapshot())
+        filename = os.path.join(tmp, "take.wav")
+        opening = asyncio.ensure_future(capture.begin_take(filename))
+        # one step: begin_take is now waiting for the I/O thread to open the file,
+        # the take counts as active already
+        await asyncio.sleep(0)
+        if not capture.take_active:
+            print("take: not active right after begin_take()")
+            return False
+        push(10)
+        await opening
+        push(rounds // 2)
+        await capture.end_take()
+        await capture.close()
+
+        with wave.open(filename, "rb") as w:
+            frames = w.readframes(w.getnframes())
+        end = min(fed - (fed - start) % capture.frame_bytes, start + capture.max_take_bytes)
+        if frames != data[start:end]:
+            print(f"take: file holds {len(frames)} bytes, expected stream bytes {start}..{end}")
+            return False
+        print(f"take: {len(frames)} bytes from stream byte {start}, ok")
+        return True
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Frame alignment check for the pre-roll ring.")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--rounds", type=int, default=200)
+    args = parser.parse_args()
+    ok = check(args.seed, args.rounds)
+    ok = asyncio.run(check_take(args.seed, args.rounds)) and ok
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,767 @@
+"""Virtual-time soak test of the station state machine.
+
+The real Station, ButtonManager, Recorder and Player run against simulated buttons,
+LED, capture and playback. A virtual clock replaces time.sleep, monotonic
+and the event loop's clock, and jumps to the next deadline whenever every
+participating thread (event loop, player, confirmation, driver, checker)
+is waiting. Hours of station use then pass in seconds.
+
+A seeded driver presses the button with random taps, holds, takes and
+confirm/delete gestures, including bursts faster than any visitor would
+press. A checker asserts the invariants along the way:
+
+- never two captures at the same time
+- when the station is idle, the rotation buffer matches the wav files on disk
+- the player is never left paused while nobody is recording or holding the button
+- no exception escapes a station action, loop callback or thread
+- the station never has to recover from a failed or timed out state
+
+The press sequence is reproducible from the seed. The exact interleaving of
+threads within one virtual instant is still up to the OS scheduler, and cpu
+work (filtering, loudness) takes no virtual time, so latencies show the
+timing logic of the state machine, not the speed of the Pi.
+
+usage: python test/soak.py [--seed N] [--interactions N] [--stuck-sec S] [--log-level LEVEL]
+Needs gpiozero importable, no pins are touched.
+"""
+from heapq import heappop, heappush
+from pathlib import Path
+import argparse
+import asyncio
+import functools
+import itertools
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import types
+from datetime import datetime
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+import eventlog  # noqa: E402
+import log  # noqa: E402
+import wavio  # noqa: E402
+import player  # noqa: E402
+import recorder  # noqa: E402
+from btn_manager import ButtonManager  # noqa: E402
+from config import ButtonConfig, EventLogConfig, PlayerConfig, RecordingConfig, UploadConfig  # noqa: E402
+from diagnostics import thread_stacks  # noqa: E402
+from player import Player  # noqa: E402
+from recorder import Recorder  # noqa: E402
+import segstore  # noqa: E402
+from station import CONFIRMING, DELETING, FAILED, HOLD, IDLE, PROCESSING, RECORDING, RELEASE, SAVING, \
+    TAKE_DISCARDED, TAKE_READY, TIMEOUT, Station  # noqa: E402
+from upload import Uploader  # noqa: E402
+
+SIM_RATE = 8000
+# virtual time runs from 0 (monotonic) and EPOCH (wall clock), small floats keep timer math exact
+EPOCH = 1_700_000_000.0
+CHECK_SEC = 0.05
+
+# press length ranges per gesture, the thresholds in station sit in between
+GESTURES = {
+    "tap": ((0.06, 0.14), 40),      # skip, or delete while confirming
+    "short": ((0.16, 1.4), 10),     # take too short to keep
+    "take": ((1.6, 6.0), 25),       # kept take, starts the confirmation loop
+    "ignored": ((0.25, 2.7), 8),    # neither confirm nor delete
+    "confirm": ((2.9, 4.0), 16),    # confirm hold
+    "reset": ((0.06, 0.2), 1),      # reset button, wipes the archive
+}
+
+
+# --- virtual clock ---
+
+class _Waiter:
+    __slots__ = ("ready", "deadline", "woken")
+
+    def __init__(self, ready, deadline):
+        self.ready = ready
+        self.deadline = deadline
+        self.woken = False
+
+
+class VirtualClock:
+    """Time only moves when no participant can make progress.
+
+    Participants are counted as active until they block in one of the clock's
+    primitives. When the last one blocks, the clock jumps to the earliest
+    deadline and wakes whoever is due, counting them active again before they
+    run, so no two jumps can happen while a woken thread is still on its way.
+    """
+
+    def __init__(self, start: float):
+        self.now = start
+        self.cond = threading.Condition(threading.RLock())
+        self.active = 0
+        self.steps = 0
+        # set while everyone waits without a deadline, nothing can happen anymore
+        # unless a thread is started or woken from outside
+        self.idle = threading.Event()
+        self._waiters: list[_Waiter] = []
+        self._timers = []
+        self._seq = itertools.count()
+        self._loop_wake = False
+
+    def register(self):
+        with self.cond:
+            self.active += 1
+            self.idle.clear()
+
+    def unregister(self):
+        with self.cond:
+            self.active -= 1
+            self._advance_if_idle()
+
+    def call_at(self, when: float, fn):
+        with self.cond:
+            heappush(self._timers, (when, next(self._seq), fn))
+
+    def sleep(self, seconds: float):
+        with self.cond:
+            self._block(lambda: False, self.now + max(0.0, seconds))
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def time(self) -> float:
+        return EPOCH + self.now
+
+    def wait_loop(self, timeout: float | None):
+        with self.cond:
+            # at least a microsecond, asyncio otherwise spins on timers a rounding error away
+            deadline = None if timeout is None else self.now + (max(timeout, 1e-6) if timeout > 0 else 0)
+            self._block(lambda: self._loop_wake, deadline)
+            self._loop_wake = False
+
+    def wake_loop(self):
+        with self.cond:
+            self._loop_wake = True
+            self._recheck()
+
+    def _block(self, ready, deadline: float | None):
+        if ready() or (deadline is not None and deadline <= self.now):
+            return
+        waiter = _Waiter(ready, deadline)
+        self._waiters.append(waiter)
+        self.active -= 1
+        self._advance_if_idle()
+        while not waiter.woken:
+            self.cond.wait(1.0)
+
+    def _recheck(self):
+        woke = False
+        for waiter in list(self._waiters):
+            if waiter.ready() or (waiter.deadline is not None and waiter.deadline <= self.now):
+                waiter.woken = True
+                self._waiters.remove(waiter)
+                self.active += 1
+                woke = True
+        if woke:
+            self.idle.clear()
+            self.cond.notify_all()
+
+    def _advance_if_idle(self):
+        while self.active == 0:
+            deadlines = [w.deadline for w in self._waiters if w.deadline is not None]
+            if self._timers:
+                deadlines.append(self._timers[0][0])
+            if not deadlines:
+                self.idle.set()
+                return
+            self.now = max(self.now, min(deadlines))
+            self.steps += 1
+            while self._timers and self._timers[0][0] <= self.now:
+                heappop(self._timers)[2]()
+            self._recheck()
+
+
+class VirtualEvent:
+    """threading.Event on the virtual clock."""
+
+    def __init__(self, clock: VirtualClock):
+        self._clock = clock
+        self._flag = False
+
+    def is_set(self) -> bool:
+        return self._flag
+
+    def set(self):
+        with self._clock.cond:
+            self._flag = True
+            self._clock._recheck()
+
+    def clear(self):
+        self._flag = False
+
+    def wait(self, timeout: float | None = None) -> bool:
+        with self._clock.cond:
+            deadline = None if timeout is None else self._clock.now + timeout
+            self._clock._block(lambda: self._flag, deadline)
+            return self._flag
+
+
+def sim_threading(clock: VirtualClock):
+    """Stand-in for the threading module inside player and recorder."""
+
+    class SimThread(threading.Thread):
+        # counted active from start(), so the clock cannot jump before the thread runs
+        def start(self):
+            self._sim_done = VirtualEvent(clock)
+            clock.register()
+            super().start()
+
+        def run(self):
+            try:
+                super().run()
+            finally:
+                self._sim_done.set()
+                clock.unregister()
+
+        def join(self, timeout=None):
+            self._sim_done.wait(timeout)
+
+    return types.SimpleNamespace(Thread=SimThread, Event=lambda: VirtualEvent(clock),
+                                 Lock=threading.Lock, RLock=threading.RLock)
+
+
+def sim_time(clock: VirtualClock):
+    """Stand-in for the time module: sleep, monotonic and time follow the clock."""
+    return types.SimpleNamespace(sleep=clock.sleep, monotonic=clock.monotonic, time=clock.time,
+                                 perf_counter=time.perf_counter)
+
+
+def sim_datetime(clock: VirtualClock):
+    return types.SimpleNamespace(now=lambda: datetime.fromtimestamp(clock.time()))
+
+
+class _VirtualSelector:
+
+    def __init__(self, selector, clock: VirtualClock):
+        self._selector = selector
+        self._clock = clock
+
+    def select(self, timeout=None):
+        events = self._selector.select(0)
+        if events:
+            return events
+        self._clock.wait_loop(timeout)
+        return self._selector.select(0)
+
+    def __getattr__(self, name):
+        return getattr(self._selector, name)
+
+
+class VirtualEventLoop(asyncio.SelectorEventLoop):
+    """Event loop whose timers and idle waits run on the virtual clock."""
+
+    def __init__(self, clock: VirtualClock):
+        super().__init__()
+        self._clock = clock
+        self._selector = _VirtualSelector(self._selector, clock)
+
+    def time(self) -> float:
+        return self._clock.now
+
+    def _write_to_self(self):
+        super()._write_to_self()
+        self._clock.wake_loop()
+
+    def run_in_executor(self, executor, func, *args):
+        # the job counts as active until its result is queued on the loop
+        future = self.create_future()
+
+        def deliver(result, error):
+            if future.cancelled():
+                return
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+        def work():
+            try:
+                self.call_soon_threadsafe(deliver, func(*args), None)
+            except BaseException as err:
+                self.call_soon_threadsafe(deliver, None, err)
+            finally:
+                self._clock.unregister()
+
+        self._clock.register()
+        super().run_in_executor(executor, work)
+        return future
+
+
+# --- simulated hardware ---
+
+class SimButton:
+
+    def __init__(self, pin):
+        self.pin = pin
+        self.is_pressed = False
+        self.when_pressed = None
+        self.when_released = None
+
+    def press(self):
+        self.is_pressed = True
+        # gpiozero calls back from its own thread, here from the driver's
+        if (callback := self.when_pressed) is not None:
+            callback()
+
+    def release(self):
+        self.is_pressed = False
+        if (callback := self.when_released) is not None:
+            callback()
+
+    def close(self):
+        pass
+
+
+class SimButtonManager(ButtonManager):
+
+    def _initialize_button(self, pin) -> SimButton:
+        return SimButton(pin)
+
+
+class SimLed:
+    """LedManager interface without a neopixel, remembers the last color."""
+
+    def __init__(self, event_loop):
+        self.event_loop = event_loop
+        self.color = (0, 0, 0)
+
+    def inject_cmd(self, cmd):
+        self.cmd = cmd
+
+    def _set(self, color):
+        self.color = color
+        return color
+
+    def recording_led_on(self):
+        return self._set((20, 0, 0))
+
+    def replay_led_on(self):
+        return self._set((10, 0, 10))
+
+    def instruction_led_on(self):
+        return self._set((0, 0, 20))
+
+    def led_off(self):
+        self._set((0, 0, 0))
+
+    def led_on(self, color=(10, 10, 10)):
+        self._set(color)
+
+    async def _after(self, duration, color):
+        await asyncio.sleep(duration)
+        self._set(color)
+
+    def start_delayed_led_off(self, duration: float):
+        return self.event_loop.create_task(self._after(duration, (0, 0, 0)))
+
+    def start_deleted_led_seq(self, duration: float, color=(20, 0, 0)):
+        return self.event_loop.create_task(self._after(duration, (0, 0, 0)))
+
+    def start_confirm_led_seq(self, duration: float):
+        return self.event_loop.create_task(self._after(duration, (0, 20, 20)))
+
+    def stop_led_task(self, task):
+        if task and not task.done():
+            task.cancel()
+
+    def shutdown_neopixel(self):
+        pass
+
+
+class SimClip:
+    """A playing clip: exits on its own after its duration, or when terminated."""
+
+    def __init__(self, clock: VirtualClock, duration: float):
+        self.exited = VirtualEvent(clock)
+        self.returncode = None
+        clock.call_at(clock.now + duration, lambda: self._exit(0))
+
+    def _exit(self, code):
+        if self.returncode is None:
+            self.returncode = code
+            self.exited.set()
+
+    def poll(self):
+        return self.returncode
+
+    def terminate(self, timeout=None):
+        self._exit(-15)
+
+    async def stop(self):
+        self._exit(-15)
+
+
+class SimPlayer(Player):
+
+    sim: "Soak"
+
+    def _play_sound_non_blocking(self, filename, prompt=False):
+        return self.sim.clip_started(filename)
+
+
+class SimCapture:
+    """Replaces the arecord process: writes a wav of the held length when stopped."""
+
+    _pids = itertools.count(1000)
+
+    def __init__(self, sim: "Soak", cmd, event_loop, **kwargs):
+        self.sim = sim
+        self.path = cmd[-1]
+        self.pid = None
+        self.returncode = None
+        self.started = 0.0
+
+    async def start(self) -> int:
+        with open(self.path, "wb") as f:
+            f.write(wavio.pcm_header(SIM_RATE, 1))
+        self.started = self.sim.clock.now
+        self.pid = next(self._pids)
+        self.sim.capture_started(self)
+        return self.pid
+
+    async def stop(self):
+        frames = int((self.sim.clock.now - self.started) * SIM_RATE)
+        noise = self.sim.audio_rng.integers(-3000, 3000, size=frames, dtype=np.int16)
+        with open(self.path, "ab") as f:
+            f.write(noise.tobytes())
+        self.returncode = 0
+        self.sim.capture_stopped(self, frames / SIM_RATE)
+
+    def poll(self):
+        return self.returncode
+
+    def stderr_text(self) -> str:
+        return ""
+
+
+class SimRegistry:
+
+    def __init__(self, recorder, player, buttons, led, station, uploader, events):
+        self.recorder = recorder
+        self.button = buttons
+        self.player = player
+        self.led = led
+        self.station = station
+        self.uploader = uploader
+        self.events = events
+        for component in (recorder, player, buttons, led, station, uploader):
+            component.inject_cmd(self)
+
+
+# --- the soak run ---
+
+class _ViolationHandler(logging.Handler):
+    """Logged tracebacks count as violations."""
+
+    def __init__(self, sim: "Soak"):
+        super().__init__(logging.ERROR)
+        self.sim = sim
+
+    def emit(self, record: logging.LogRecord):
+        if record.exc_info:
+            self.sim.violation(f"exception logged by {record.name}", record.getMessage())
+
+
+def percentiles(values: list) -> str:
+    if not values:
+        return "n/a"
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return (f"n={len(values)} p50={p50 * 1000:.0f}ms p95={p95 * 1000:.0f}ms "
+            f"p99={p99 * 1000:.0f}ms max={max(values) * 1000:.0f}ms")
+
+
+class Soak:
+
+    def __init__(self, seed: int, interactions: int, stuck_sec: float, existing: int = 3, staging: bool = False,
+                 segments: bool = False):
+        self.seed = seed
+        self.interactions = interactions
+        self.stuck_sec = stuck_sec
+        self.rng = random.Random(seed)
+        self.audio_rng = np.random.default_rng(seed)
+        self.clock = VirtualClock(0.0)
+        self.tmp = tempfile.mkdtemp(prefix="ohrgarten-soak-", dir="/dev/shm" if os.path.isdir("/dev/shm") else None)
+        self.rec_path = os.path.join(self.tmp, "recordings")
+        os.makedirs(self.rec_path)
+        self.staging = os.path.join(self.tmp, "staging") if staging else None
+        self.storage = "segments" if segments else "files"
+        for i in range(existing):
+            self._write_wav(os.path.join(self.rec_path, f"rec_seed_{i}.wav"), 4.0)
+
+        self.durations: dict[str, float] = {}
+        self.captures: list[SimCapture] = []
+        self.violations: dict[str, dict] = {}
+        self.latency = {"press -> capture": [], "tap -> next clip": [], "release -> confirmation loop": []}
+        self.counts = {name: 0 for name in GESTURES}
+        self.last_press = (None, 0.0)
+        self.pending_tap: float | None = None
+        self.pending_take: float | None = None
+        self.last_release = 0.0
+        self.driver_done = threading.Event()
+        # a real event, the checker reads the archive until it sees driver_done
+        self.checker_done = threading.Event()
+
+    @staticmethod
+    def _write_wav(path, seconds):
+        with open(path, "wb") as f:
+            frames = int(seconds * SIM_RATE)
+            f.write(wavio.pcm_header(SIM_RATE, 1, data_size=frames * 2))
+            f.write(np.zeros(frames, dtype=np.int16).tobytes())
+
+    def violation(self, kind: str, detail: str = ""):
+        entry = self.violations.setdefault(kind, {"count": 0, "first_at": self.clock.now,
+                                                  "detail": detail})
+        entry["count"] += 1
+
+    # --- hooks from the simulated backends ---
+
+    def clip_started(self, source) -> SimClip:
+        thread = threading.current_thread().name
+        if thread == "player" and self.pending_tap is not None:
+            self.latency["tap -> next clip"].append(self.clock.now - self.pending_tap)
+            self.pending_tap = None
+        if thread == "confirmation" and self.pending_take is not None:
+            self.latency["release -> confirmation loop"].append(self.clock.now - self.pending_take)
+            self.pending_take = None
+        if isinstance(source, wavio.PcmBuffer):
+            return SimClip(self.clock, source.duration)
+        filename = str(source)
+        if filename.startswith("sfx/"):
+            duration = 1.0
+        elif filename.startswith("voice/save"):
+            duration = 2.5
+        else:
+            duration = self.durations.get(filename, 4.0)
+        return SimClip(self.clock, duration)
+
+    def capture_started(self, capture: SimCapture):
+        self.captures.append(capture)
+        running = [c for c in self.captures if c.returncode is None]
+        if len(running) > 1:
+            self.violation("two recordings at once", ", ".join(c.path for c in running))
+        kind, at = self.last_press
+        if kind is not None:
+            self.latency["press -> capture"].append(self.clock.now - at)
+
+    def capture_stopped(self, capture: SimCapture, seconds: float):
+        final = capture.path[:-len(wavio.PART_SUFFIX)]
+        self.durations[final] = seconds
+        self.pending_take = self.last_release
+        self.captures = [c for c in self.captures if c.returncode is None]
+
+    # --- setup ---
+
+    def _patch_modules(self):
+        # the station runs on the event loop and its clock, it needs no patching
+        self._saved = {(player, "time"): player.time, (player, "threading"): player.threading,
+                       (recorder, "time"): recorder.time, (recorder, "datetime"): recorder.datetime,
+                       (recorder, "SupervisedProcess"): recorder.SupervisedProcess}
+        player.time = recorder.time = sim_time(self.clock)
+        player.threading = sim_threading(self.clock)
+        recorder.datetime = sim_datetime(self.clock)
+        recorder.SupervisedProcess = functools.partial(SimCapture, self)
+
+    def _restore_modules(self):
+        for (module, name), value in self._saved.items():
+            setattr(module, name, value)
+
+    def _build(self):
+        self.loop = VirtualEventLoop(self.clock)
+        self.loop.set_exception_handler(
+            lambda loop, context: self.violation("exception in event loop", str(context.get("exception")
+                                                                                 or context.get("message"))))
+        rec_cfg = RecordingConfig(RECORDING_PATH=self.rec_path, SFX_PATH="sfx", BEEP_FILE="beep.wav",
+                                  ARECORD_CMD=["arecord", "-f", "cd", "-d", "300"], STAGING_PATH=self.staging,
+                                  STORAGE=self.storage)
+        ply_cfg = PlayerConfig(APLAY_CMD=["aplay"], QUESTION="question.wav", VOICE_PATH="voice")
+        self.recorder = Recorder(rec_cfg=rec_cfg, event_loop=self.loop)
+        self.player = SimPlayer(ply_cfg=ply_cfg, event_loop=self.loop)
+        self.player.sim = self
+        self.buttons = SimButtonManager(button_cfg=ButtonConfig(BUTTON_PIN=17, RST_BUTTON_PIN=27),
+                                        event_loop=self.loop)
+        self.led = SimLed(self.loop)
+        self.station = Station(event_loop=self.loop)
+        # disabled, confirmed takes are only offered to it
+        uploader = Uploader(UploadConfig(), self.rec_path, self.loop)
+        # flushed in real time, its counts are checked against the station's transitions
+        self.events = eventlog.EventLog(EventLogConfig(ENABLED=True, PATH=os.path.join(self.tmp, "events.bin"),
+                                                       FLUSH_SEC=0.05))
+        self.events.start()
+        self.cmd = SimRegistry(self.recorder, self.player, self.buttons, self.led, self.station, uploader,
+                               self.events)
+        self.station.start()
+
+    # --- participants ---
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def _drive(self):
+        gestures = list(GESTURES)
+        weights = [GESTURES[g][1] for g in gestures]
+        for _ in range(self.interactions):
+            mode = self.rng.random()
+            if mode < 0.1:
+                gap = self.rng.uniform(0.06, 0.2)      # bursts
+            elif mode < 0.8:
+                gap = self.rng.uniform(0.2, 3.0)
+            else:
+                gap = self.rng.uniform(3.0, 15.0)
+            self.clock.sleep(gap)
+
+            gesture = self.rng.choices(gestures, weights)[0]
+            low, high = GESTURES[gesture][0]
+            button = self.buttons.reset_button if gesture == "reset" else self.buttons.button
+            self.counts[gesture] += 1
+            self.last_press = (gesture, self.clock.now)
+            if gesture == "tap" and self.station.state == IDLE:
+                self.pending_tap = self.clock.now
+            button.press()
+            self.clock.sleep(self.rng.uniform(low, high))
+            button.release()
+            self.last_release = self.clock.now
+            self.last_press = (None, 0.0)
+        # let the last interaction play out
+        self.clock.sleep(10.0)
+        self.driver_done.set()
+
+    def _idle(self) -> bool:
+        return (self.station.state == IDLE and not self.recorder.is_recording()
+                and not self.buttons.button.is_pressed)
+
+    def _check(self):
+        try:
+            self._check_loop()
+        finally:
+            self.checker_done.set()
+
+    def _check_loop(self):
+        paused_since = None
+        while not self.driver_done.is_set():
+            self.clock.sleep(CHECK_SEC)
+            if self._idle():
+                # loose wavs and packed takes
+                disk = {str(p) for p in segstore.wav_paths(self.rec_path)}
+                buffer = [str(p) for p in self.player.buffer]
+                if len(buffer) != len(set(buffer)):
+                    self.violation("duplicate entries in the rotation buffer")
+                if set(buffer) != disk:
+                    missing = sorted(os.path.basename(p) for p in disk - set(buffer))
+                    gone = sorted(os.path.basename(p) for p in set(buffer) - disk)
+                    self.violation("rotation buffer does not match disk",
+                                   f"on disk only: {missing[:3]}, buffer only: {gone[:3]}")
+                if self.staging is not None and (left := [p.name for p in Path(self.staging).glob("*")]):
+                    self.violation("take left in staging", str(left[:3]))
+
+            stuck = (not self.player._pause_event.is_set() and not self.recorder.is_recording()
+                     and not self.buttons.button.is_pressed)
+            if not stuck:
+                paused_since = None
+            elif paused_since is None:
+                paused_since = self.clock.now
+            elif self.clock.now - paused_since > self.stuck_sec:
+                self.violation("player stuck paused", f"since {paused_since:.1f}s")
+                paused_since = None
+
+    # --- run and report ---
+
+    def run(self) -> bool:
+        self._patch_modules()
+        saved_hook = threading.excepthook
+        threading.excepthook = lambda args: self.violation(
+            f"exception in thread {args.thread.name if args.thread else '?'}", repr(args.exc_value))
+        # the station logs failed actions instead of raising them
+        errors = _ViolationHandler(self)
+        logging.getLogger(log.ROOT).addHandler(errors)
+        started = time.perf_counter()
+        try:
+            self._build()
+            threads = sim_threading(self.clock)
+            threads.Thread(target=self._run_loop, name="event-loop", daemon=True).start()
+            threads.Thread(target=self.player.play_forever, name="player", daemon=True).start()
+            threads.Thread(target=self._check, name="checker", daemon=True).start()
+            threads.Thread(target=self._drive, name="driver", daemon=True).start()
+
+            last_steps = -1
+            while not self.driver_done.wait(5.0):
+                if self.clock.idle.is_set() or self.clock.steps == last_steps:
+                    self.violation("simulation stalled", thread_stacks())
+                    break
+                last_steps = self.clock.steps
+            self.wall = time.perf_counter() - started
+            self.player.stop()
+            self.loop.call_soon_threadsafe(self.station.stop)
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            # the checker may be reading the archive right now, the teardown removes it
+            if not self.checker_done.wait(10.0):
+                self.violation("checker did not finish", thread_stacks())
+            for (source, event, target), (n, _, _) in self.station.timings.items():
+                if event in (FAILED, TIMEOUT):
+                    self.violation(f"station recovered from {source} on {event}", f"{n}x")
+            self._check_events()
+        finally:
+            logging.getLogger(log.ROOT).removeHandler(errors)
+            threading.excepthook = saved_hook
+            self._restore_modules()
+        self.report()
+        shutil.rmtree(self.tmp, ignore_errors=True)
+        return not self.violations
+
+    def _check_events(self):
+        self.events.stop()
+        counts = eventlog.kind_counts(eventlog.load(self.events.events_cfg.PATH))
+        expected = {"record": (IDLE, HOLD, RECORDING), "take": (PROCESSING, TAKE_READY, CONFIRMING),
+                    "discarded": (PROCESSING, TAKE_DISCARDED, IDLE), "saved": (CONFIRMING, RELEASE, SAVING),
+                    "deleted": (CONFIRMING, RELEASE, DELETING)}
+        for kind, transition in expected.items():
+            n = self.station.timings[transition][0] if transition in self.station.timings else 0
+            if counts[kind] != n:
+                self.violation(f"event log has {counts[kind]} {kind} events", f"{n} transitions")
+        self.event_counts = counts
+
+    def report(self):
+        simulated = self.clock.now
+        done = sum(self.counts.values())
+        print(f"seed {self.seed}: {done} interactions, {simulated / 3600:.2f} h simulated "
+              f"in {self.wall:.1f} s ({simulated / self.wall:.0f}x, "
+              f"{done / self.wall * 60:.0f} interactions/min, {self.clock.steps} clock steps)")
+        print("gestures: " + ", ".join(f"{name} {n}" for name, n in self.counts.items()))
+        print(f"recordings on disk at the end: {len(list(Path(self.rec_path).glob('*.wav')))}, "
+              f"in rotation: {len(self.player.buffer)}")
+        print("event log: " + ", ".join(f"{kind} {n}" for kind, n in self.event_counts.items() if n))
+        for name, values in self.latency.items():
+            print(f"latency {name}: {percentiles(values)}")
+        for (source, event, target), (n, total, peak) in sorted(self.station.timings.items()):
+            print(f"time in {source} before {event} -> {target}: n={n} "
+                  f"mean={total / n * 1000:.0f}ms max={peak * 1000:.0f}ms")
+        if not self.violations:
+            print("no invariant violations")
+        for kind, entry in self.violations.items():
+            print(f"VIOLATION {kind}: {entry['count']}x, first at {entry['first_at']:.1f}s {entry['detail']}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Virtual-time soak test of the station state machine.")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--interactions", type=int, default=2000)
+    parser.add_argument("--stuck-sec", type=float, default=30.0,
+                        help="paused longer than this without recording counts as stuck")
+    parser.add_argument("--log-level", default="ERROR")
+    parser.add_argument("--staging", action="store_true", help="record into a RAM staging directory")
+    parser.add_argument("--segments", action="store_true", help="pack confirmed takes into segment files")
+    args = parser.parse_args()
+
+    logging.getLogger(log.ROOT).setLevel(args.log_level)
+    ok = Soak(args.seed, args.interactions, args.stuck_sec, staging=args.staging, segments=args.segments).run()
+    sys.exit(0 if ok else 1)
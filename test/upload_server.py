@@ -0,0 +1,263 @@
+"""Stand-in collection server for src/upload.py, and an end-to-end check against it.
+
+    python test/upload_server.py --dir incoming --port 8000          # serve until Ctrl+C
+    python test/upload_server.py --check [--takes 60] [--seed 1]     # upload, crash, resume, verify
+
+The server speaks the upload protocol: PUT /<prefix>/<station>/<name> with a
+chunked body and X-Content-SHA256 stores the take (the same content twice is
+idempotent), HEAD answers with the stored sha256 or 404. Faults can be
+injected at random: 503 with Retry-After, connections reset in the middle of
+a body, and takes stored but the answer lost.
+
+--check queues takes of random length, cancels the uploader in the middle
+of the run (like a restart), resumes with a new one on the same journal and
+verifies that every take arrived intact, that none was stored twice and
+that the queue is empty.
+"""
+from pathlib import Path
+import argparse
+import asyncio
+import hashlib
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+import log  # noqa: E402
+import sidecar  # noqa: E402
+import wavio  # noqa: E402
+from config import UploadConfig  # noqa: E402
+from upload import JOURNAL, SIDECAR_KEY, Uploader, not_uploaded  # noqa: E402
+
+
+class CollectionServer:
+
+    def __init__(self, root, fail_rate: float = 0.0, reset_rate: float = 0.0, lose_ack_rate: float = 0.0,
+                 seed: int = 0):
+        self.root = Path(root)
+        self.fail_rate = fail_rate
+        self.reset_rate = reset_rate
+        self.lose_ack_rate = lose_ack_rate
+        self.rng = random.Random(seed)
+        self.server: asyncio.AbstractServer | None = None
+        self.stats = {"connections": 0, "requests": 0, "stored": 0, "duplicates": 0, "failed": 0,
+                      "reset": 0, "lost_ack": 0, "heads": 0}
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> int:
+        self.server = await asyncio.start_server(self._handle, host, port)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+
+    def _path(self, target: str) -> Path | None:
+        parts = [p for p in target.split("?")[0].split("/") if p]
+        if len(parts) < 2 or any(p in (".", "..") for p in parts):
+            return None
+        return self.root.joinpath(*parts[-2:])
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.stats["connections"] += 1
+        try:
+            # keep-alive: requests until the client closes
+            while True:
+                try:
+                    head = await reader.readuntil(b"\r\n\r\n")
+                except asyncio.IncompleteReadError:
+                    return
+                lines = head.decode("latin-1").split("\r\n")
+                method, target, _ = lines[0].split(" ", 2)
+                headers = {}
+                for line in lines[1:]:
+                    key, _, value = line.partition(":")
+                    if key:
+                        headers[key.strip().lower()] = value.strip()
+                self.stats["requests"] += 1
+                path = self._path(target)
+                if path is None:
+                    self._respond(writer, 400)
+                elif method == "HEAD":
+                    self.stats["heads"] += 1
+                    digest = sidecar.read(path).get("sha256") if path.exists() else None
+                    self._respond(writer, 200 if digest else 404, {"X-Content-SHA256": digest} if digest else {})
+                elif method == "PUT":
+                    if not await self._put(reader, writer, path, headers):
+                        return
+                else:
+                    self._respond(writer, 405)
+                await writer.drain()
+        except (ConnectionError, ValueError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+    async def _put(self, reader, writer, path: Path, headers: dict) -> bool:
+        """Stores one body. False when the connection was dropped on purpose."""
+        path.parent.mkdir(parents=True, exist_ok=True)
+        part = path.with_name(path.name + ".part")
+        reset_at = self.rng.random() < self.reset_rate
+        digest = hashlib.sha256()
+        with open(part, "wb") as f:
+            while True:
+                size = int((await reader.readuntil(b"\r\n")).split(b";")[0], 16)
+                if size == 0:
+                    await reader.readuntil(b"\r\n")
+                    break
+                data = await reader.readexactly(size)
+                await reader.readexactly(2)
+                if reset_at:
+                    # in the middle of the body, the take never arrives
+                    self.stats["reset"] += 1
+                    os.remove(part)
+                    return False
+                f.write(data)
+                digest.update(data)
+
+        if self.rng.random() < self.fail_rate:
+            os.remove(part)
+            self.stats["failed"] += 1
+            self._respond(writer, 503, {"Retry-After": "1"})
+            return True
+        if headers.get("x-content-sha256") not in (None, digest.hexdigest()):
+            os.remove(part)
+            self._respond(writer, 400, body=b"checksum mismatch")
+            return True
+
+        if sidecar.read(path).get("sha256") == digest.hexdigest():
+            self.stats["duplicates"] += 1
+        os.replace(part, path)
+        sidecar.update(path, "sha256", digest.hexdigest())
+        self.stats["stored"] += 1
+        if self.rng.random() < self.lose_ack_rate:
+            # stored, but the client never learns it
+            self.stats["lost_ack"] += 1
+            return False
+        self._respond(writer, 201)
+        return True
+
+    def _respond(self, writer, status: int, extra: dict | None = None, body: bytes = b""):
+        lines = [f"HTTP/1.1 {status} X", f"Content-Length: {len(body)}"]
+        lines += [f"{k}: {v}" for k, v in (extra or {}).items()]
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + body)
+
+
+# --- end-to-end check ---
+
+async def check(takes: int, seed: int) -> bool:
+    rng = np.random.default_rng(seed)
+    tmp = Path(tempfile.mkdtemp(prefix="ohrgarten-upload-"))
+    rec_path, incoming = tmp / "recordings", tmp / "incoming"
+    rec_path.mkdir()
+    server = CollectionServer(incoming, fail_rate=0.1, reset_rate=0.05, lose_ack_rate=0.05, seed=seed)
+    port = await server.start()
+    cfg = UploadConfig(ENABLED=True, URL=f"http://127.0.0.1:{port}/takes", STATION="soak", BATCH_SIZE=6,
+                       BATCH_WAIT_SEC=0.05, CONNECTIONS=2, RATE_LIMIT_KBPS=64 * 1024,
+                       RETRY_MIN_SEC=0.05, RETRY_MAX_SEC=0.5, TIMEOUT_SEC=5)
+    loop = asyncio.get_running_loop()
+    started = time.perf_counter()
+    try:
+        wavs = []
+        for i in range(takes):
+            wav = rec_path / f"rec_{i:04d}.wav"
+            frames = int(rng.uniform(0.5, 6.0) * 8000)
+            with open(wav, "wb") as f:
+                f.write(wavio.pcm_header(8000, 1, data_size=frames * 2))
+                f.write(rng.integers(-3000, 3000, size=frames, dtype=np.int16).tobytes())
+            wavs.append(wav)
+
+        # first run, cancelled half way
+        first = Uploader(cfg, rec_path, loop)
+        await first.start()
+        for wav in wavs:
+            first.enqueue(wav)
+        while first.stats["uploaded"] < takes // 2:
+            await asyncio.sleep(0.01)
+        await first.close()
+        print(f"first run: {first.stats}")
+
+        # takes still queued are reprocessed to the same length, their queued hash is stale now
+        rewritten = [wav for wav in wavs if not (incoming / "soak" / wav.name).exists()][:3]
+        header = len(wavio.pcm_header(8000, 1))
+        for wav in rewritten:
+            with open(wav, "r+b") as f:
+                f.seek(header)
+                f.write(rng.integers(-3000, 3000, size=(wav.stat().st_size - header) // 2, dtype=np.int16).tobytes())
+            os.utime(wav, (time.time() + 10,) * 2)
+
+        # restart on the same journal, a few new takes on top
+        second = Uploader(cfg, rec_path, loop)
+        await second.start()
+        for wav in wavs[-3:]:
+            second.enqueue(wav)
+        await asyncio.wait_for(second.drain(), 120)
+        await second.close()
+        print(f"second run: {second.stats}")
+        print(f"server: {server.stats}, {time.perf_counter() - started:.1f} s")
+
+        problems = []
+        for wav in wavs:
+            stored = incoming / "soak" / wav.name
+            if not stored.exists():
+                problems.append(f"{wav.name} missing on the server")
+            elif stored.read_bytes() != wav.read_bytes():
+                problems.append(f"{wav.name} differs on the server")
+            if not sidecar.read(wav).get(SIDECAR_KEY):
+                problems.append(f"{wav.name} not marked uploaded")
+        if server.stats["duplicates"]:
+            problems.append(f"{server.stats['duplicates']} takes stored twice")
+        if (rec_path / JOURNAL).read_text().strip():
+            problems.append("journal not empty")
+        if list(incoming.rglob("*.part")):
+            problems.append("partial uploads left on the server")
+        if left := not_uploaded(rec_path):
+            problems.append(f"{len(left)} takes not uploaded by their sidecars")
+        # an uploaded take that changes afterwards counts as not uploaded again
+        with open(wavs[0], "r+b") as f:
+            f.seek(-2, os.SEEK_END)
+            f.write(b"\x01\x02")
+        if not_uploaded(rec_path) != [wavs[0]]:
+            problems.append("a changed take is not listed as not uploaded")
+        for problem in problems:
+            print(f"PROBLEM {problem}")
+        if not problems:
+            print(f"all {takes} takes arrived once and intact")
+        return not problems
+    finally:
+        await server.close()
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+async def serve(root, port: int, fail_rate: float, reset_rate: float, lose_ack_rate: float):
+    server = CollectionServer(root, fail_rate, reset_rate, lose_ack_rate)
+    await server.start("0.0.0.0", port)
+    print(f"collecting into {root} on port {port}")
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stand-in collection server for the uploader.")
+    parser.add_argument("--check", action="store_true", help="run the end-to-end check and exit")
+    parser.add_argument("--takes", type=int, default=60)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--dir", default="incoming")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="share of PUTs answered with 503")
+    parser.add_argument("--reset-rate", type=float, default=0.0, help="share of PUTs reset in the body")
+    parser.add_argument("--lose-ack-rate", type=float, default=0.0, help="share of PUTs stored without an answer")
+    parser.add_argument("--log-level", default="ERROR")
+    args = parser.parse_args()
+
+    log.logging.getLogger(log.ROOT).setLevel(args.log_level)
+    if args.check:
+        sys.exit(0 if asyncio.run(check(args.takes, args.seed)) else 1)
+    try:
+        asyncio.run(serve(args.dir, args.port, args.fail_rate, args.reset_rate, args.lose_ack_rate))
+    except KeyboardInterrupt:
+        pass